@@ -0,0 +1,101 @@
+import numpy as np
+import shapely
+import pyproj
+
+# Elipsoide WGS84
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_E2 = WGS84_F * (2 - WGS84_F)
+
+# Proyección cónica equivalente de Albers para México; se usa en geometrías con gran extensión en latitud
+EQUAL_AREA_CRS = "+proj=aea +lat_0=12 +lon_0=-102 +lat_1=17.5 +lat_2=29.5 +x_0=2500000 +y_0=0 +datum=WGS84 +units=m +no_defs"
+
+# Extensión máxima en latitud (grados) para calcular el área con el factor de escala local del elipsoide.
+# Hasta MIDPOINT_MAX_SPAN basta la latitud media del bbox (error < 0.01%); hasta LOCAL_SCALE_MAX_SPAN se
+# usa la latitud del centroide; por encima se reproyecta densificando los bordes cada DENSIFY_DEGREES grados.
+MIDPOINT_MAX_SPAN = 0.02
+LOCAL_SCALE_MAX_SPAN = 0.25
+DENSIFY_DEGREES = 0.01
+
+_transformer = None
+_geod = None
+
+def _get_transformer():
+    global _transformer
+    if _transformer is None:
+        _transformer = pyproj.Transformer.from_crs('EPSG:4326', EQUAL_AREA_CRS, always_xy=True)
+    return _transformer
+
+def _get_geod():
+    global _geod
+    if _geod is None:
+        _geod = pyproj.Geod(ellps='WGS84')
+    return _geod
+
+def _as_array(geometries):
+    return np.asarray(getattr(geometries, 'values', geometries), dtype=object)
+
+# Función para calcular los m² que corresponden a un grado cuadrado a una latitud dada (radios de curvatura M y N)
+def square_degree_m2(latitude):
+    phi = np.radians(latitude)
+    w = 1 - WGS84_E2 * np.sin(phi) ** 2
+    meridian_radius = WGS84_A * (1 - WGS84_E2) / w ** 1.5
+    normal_radius = WGS84_A / np.sqrt(w)
+    return np.radians(1) ** 2 * meridian_radius * normal_radius * np.cos(phi)
+
+# Función para reproyectar geometrías en grados (EPSG:4326) a la proyección equivalente de Albers
+def to_equal_area(geometries):
+    transformer = _get_transformer()
+    return shapely.transform(
+        _as_array(geometries),
+        lambda coords: np.column_stack(transformer.transform(coords[:, 0], coords[:, 1]))
+    )
+
+# Función para calcular el área en m² de un arreglo de geometrías en grados (EPSG:4326)
+def area_m2(geometries):
+    geoms = _as_array(geometries)
+    result = np.zeros(len(geoms))
+    if len(geoms) == 0:
+        return result
+    areas = shapely.area(geoms)
+    bounds = shapely.bounds(geoms)
+    span = bounds[:, 3] - bounds[:, 1]
+    non_empty = ~np.isnan(span)
+
+    small = non_empty & (span <= MIDPOINT_MAX_SPAN)
+    result[small] = areas[small] * square_degree_m2((bounds[small, 1] + bounds[small, 3]) / 2)
+
+    medium = non_empty & ~small & (span <= LOCAL_SCALE_MAX_SPAN)
+    if medium.any():
+        latitude = shapely.get_y(shapely.centroid(geoms[medium]))
+        result[medium] = areas[medium] * square_degree_m2(latitude)
+
+    large = non_empty & (span > LOCAL_SCALE_MAX_SPAN)
+    if large.any():
+        densified = shapely.segmentize(geoms[large], DENSIFY_DEGREES)
+        result[large] = shapely.area(to_equal_area(densified))
+    return result
+
+# Función para calcular el perímetro geodésico en metros de un arreglo de geometrías en grados (EPSG:4326)
+def perimeter_m(geometries):
+    geoms = _as_array(geometries)
+    result = np.zeros(len(geoms))
+    if len(geoms) == 0:
+        return result
+    rings, geom_index = shapely.get_rings(geoms, return_index=True)
+    if len(rings) == 0:
+        return result
+    coords, ring_index = shapely.get_coordinates(rings, return_index=True)
+    same_ring = ring_index[1:] == ring_index[:-1]
+    start, end = coords[:-1][same_ring], coords[1:][same_ring]
+    _, _, distances = _get_geod().inv(start[:, 0], start[:, 1], end[:, 0], end[:, 1])
+    ring_lengths = np.bincount(ring_index[:-1][same_ring], weights=distances, minlength=len(rings))
+    return np.bincount(geom_index, weights=ring_lengths, minlength=len(geoms))
+
+# Función para dar formato a un área en m² al momento de presentarla
+def format_area_m2(value):
+    return f"{value:,.2f} m²"
+
+# Función para dar formato a una longitud en metros al momento de presentarla
+def format_length_m(value):
+    return f"{value:,.2f} m"
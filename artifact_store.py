@@ -0,0 +1,300 @@
+import contextlib
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+import shapely
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Archivo con el resultado de un análisis terminado; su presencia marca una entrada completa
+RESULT_FILE = 'resultado.json'
+# Directorio oculto con el estado de los trabajos de análisis (jobs.py), compartido por los procesos de la API;
+# no es un directorio de trabajo y el desalojo no lo elimina
+JOBS_DIR = '.trabajos'
+# Precisión (grados) a la que se redondean las coordenadas antes de calcular la clave
+KEY_GRID_SIZE = 1e-9
+# Variantes precomprimidas de los artefactos (codificación HTTP -> sufijo), en orden de preferencia. Se guardan
+# como archivos ocultos junto al artefacto (.<nombre>.br, .<nombre>.gz) con su huella (.<nombre>.sha256).
+PRECOMPRESSED_SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+DIGEST_SUFFIX = '.sha256'
+# Tamaño de bloque para leer los artefactos al comprimirlos o calcular su huella
+READ_CHUNK = 1024 * 1024
+
+# Función para obtener la ruta de un archivo auxiliar oculto de un artefacto (variante o huella)
+def sidecar_path(path, suffix):
+    directory, name = os.path.split(path)
+    return os.path.join(directory, f".{name}{suffix}")
+
+# Función para escribir un archivo pequeño de forma atómica
+def _write_atomic(path, data):
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+# Función para sumar el tamaño de los archivos de un directorio
+def _directory_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except FileNotFoundError:
+                pass
+    return size
+
+# Función para calcular la clave de contenido de un análisis: geometrías normalizadas en su orden,
+# identificadores de predio y subpolígono, y la huella de las capas consultadas
+def analysis_key(polygons_gdf, layers_fingerprint):
+    digest = hashlib.sha256()
+    digest.update(json.dumps(layers_fingerprint, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+    geometries = shapely.normalize(shapely.set_precision(polygons_gdf.geometry.values, KEY_GRID_SIZE))
+    wkbs = shapely.to_wkb(geometries)
+    lengths = np.fromiter((len(wkb) for wkb in wkbs), dtype=np.int64, count=len(wkbs))
+    digest.update(lengths.tobytes())
+    digest.update(b''.join(wkbs))
+    digest.update(json.dumps([polygons_gdf['predio_id'].astype(str).tolist(), polygons_gdf['subpoligono_id'].astype(str).tolist()]).encode('utf-8'))
+    return digest.hexdigest()
+
+# Función para calcular la huella de cada polígono (geometría normalizada y predio), en el orden del GeoDataFrame;
+# sirve para reconocer los polígonos que no cambiaron entre dos envíos
+def feature_hashes(polygons_gdf):
+    geometries = shapely.normalize(shapely.set_precision(polygons_gdf.geometry.values, KEY_GRID_SIZE))
+    return [
+        hashlib.sha256(wkb + b'\0' + str(predio_id).encode('utf-8')).hexdigest()
+        for wkb, predio_id in zip(shapely.to_wkb(geometries), polygons_gdf['predio_id'])
+    ]
+
+# Los artefactos JSON se guardan también precomprimidos (gzip y, si está instalado, brotli) con compress_level
+# (0: sin variantes) y los archivos tienen una huella sha256 para validar descargas (ETag).
+class ArtifactStore:
+    def __init__(self, root, max_bytes=2 * 1024 ** 3, max_age=7 * 24 * 3600, evict_interval=60, compress_level=6, compress_min_bytes=1024):
+        self.root = os.path.realpath(root)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.evict_interval = evict_interval
+        self.compress_level = compress_level
+        self.compress_min_bytes = compress_min_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Entradas y bytes publicados: se calculan al recorrer el almacén (primer stats() o evict) y después se
+        # actualizan con cada commit, archivo agregado y desalojo, para no recorrer el directorio en cada consulta
+        self.entries = None
+        self.total_bytes = None
+        self._last_evict = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def _absolute(self, key, result):
+        directory = self.path(key)
+        return {name: os.path.join(directory, value) if isinstance(value, str) else value for name, value in result.items()}
+
+    # Busca un análisis terminado; devuelve su resultado con rutas absolutas o None. Marca la entrada como usada.
+    def lookup(self, key, count=True):
+        result_file = os.path.join(self.path(key), RESULT_FILE)
+        try:
+            with open(result_file) as f:
+                result = json.load(f)
+            os.utime(result_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            result = None
+        if count:
+            with self._lock:
+                if result is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+        return self._absolute(key, result) if result is not None else None
+
+    # Crea un directorio de trabajo privado para un análisis en curso; se publica con commit
+    def begin(self, key, run_id):
+        work_dir = os.path.join(self.root, f".{key}.{run_id}")
+        os.makedirs(work_dir, exist_ok=True)
+        return work_dir
+
+    # Publica el directorio de trabajo bajo su clave de forma atómica. Si otro análisis idéntico terminó
+    # primero, se descarta este y se devuelve el resultado ya publicado.
+    def commit(self, key, work_dir, result):
+        with open(os.path.join(work_dir, RESULT_FILE), 'w') as f:
+            json.dump(result, f, indent=4)
+        size = _directory_size(work_dir)
+        try:
+            os.rename(work_dir, self.path(key))
+        except OSError:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            published = self.lookup(key, count=False)
+            if published is None:
+                raise
+            return published
+        with self._lock:
+            if self.entries is not None:
+                self.entries += 1
+                self.total_bytes += size
+        self.evict()
+        return self._absolute(key, result)
+
+    # Suma a los bytes del almacén un archivo escrito dentro de una entrada ya publicada (mapa, PDF o exportación)
+    def add_file(self, path):
+        size = os.path.getsize(path)
+        with self._lock:
+            if self.total_bytes is not None:
+                self.total_bytes += size
+
+    # Descarta un directorio de trabajo de un análisis que falló
+    def abort(self, work_dir):
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    # Ruta absoluta de un artefacto publicado a partir de su ruta relativa, o None si queda fuera del almacén
+    # (incluidos los enlaces simbólicos que apuntan fuera) o es un archivo oculto: directorios de trabajo,
+    # temporales, variantes precomprimidas y huellas
+    def resolve(self, relative_path):
+        path = os.path.realpath(os.path.join(self.root, relative_path))
+        if os.path.commonpath([path, self.root]) != self.root or path == self.root:
+            return None
+        if any(part.startswith('.') for part in os.path.relpath(path, self.root).split(os.sep)):
+            return None
+        return path
+
+    # Escribe la huella y las variantes precomprimidas de un artefacto recién escrito, en una sola lectura
+    def precompress(self, path):
+        digest = hashlib.sha256()
+        encodings = []
+        if self.compress_level > 0 and os.path.getsize(path) >= self.compress_min_bytes:
+            encodings = ['gzip', 'br'] if brotli is not None else ['gzip']
+        tmp_paths = {encoding: f"{sidecar_path(path, PRECOMPRESSED_SUFFIXES[encoding])}.{threading.get_ident()}.tmp" for encoding in encodings}
+        try:
+            with contextlib.ExitStack() as stack:
+                files = {encoding: stack.enter_context(open(tmp_path, 'wb')) for encoding, tmp_path in tmp_paths.items()}
+                gzip_file = stack.enter_context(gzip.GzipFile(fileobj=files['gzip'], mode='wb', compresslevel=self.compress_level, mtime=0)) if 'gzip' in files else None
+                compressor = brotli.Compressor(quality=min(self.compress_level, 11)) if 'br' in files else None
+                with open(path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(READ_CHUNK), b''):
+                        digest.update(chunk)
+                        if gzip_file is not None:
+                            gzip_file.write(chunk)
+                        if compressor is not None:
+                            files['br'].write(compressor.process(chunk))
+                if compressor is not None:
+                    files['br'].write(compressor.finish())
+            for encoding, tmp_path in tmp_paths.items():
+                os.replace(tmp_path, sidecar_path(path, PRECOMPRESSED_SUFFIXES[encoding]))
+        finally:
+            for tmp_path in tmp_paths.values():
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        return self._write_digest(path, digest.hexdigest())
+
+    def _write_digest(self, path, hexdigest):
+        stat = os.stat(path)
+        try:
+            _write_atomic(sidecar_path(path, DIGEST_SUFFIX), f"{hexdigest} {stat.st_size} {stat.st_mtime_ns}".encode('ascii'))
+        except OSError as e:
+            logger.warning("No se pudo guardar la huella de %s: %s", path, e)
+        return hexdigest
+
+    # Huella sha256 del contenido de un artefacto. Se lee de su archivo auxiliar si corresponde al tamaño y la
+    # fecha actuales del artefacto; si no, se calcula y se guarda (artefactos generados en la descarga).
+    def digest(self, path):
+        stat = os.stat(path)
+        try:
+            with open(sidecar_path(path, DIGEST_SUFFIX)) as f:
+                hexdigest, size, mtime_ns = f.read().split()
+            if int(size) == stat.st_size and int(mtime_ns) == stat.st_mtime_ns:
+                return hexdigest
+        except (FileNotFoundError, ValueError):
+            pass
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(READ_CHUNK), b''):
+                digest.update(chunk)
+        return self._write_digest(path, digest.hexdigest())
+
+    # Ruta de la variante precomprimida de un artefacto en una codificación, o None si no existe o es anterior
+    # al artefacto (el artefacto se reescribió después de comprimirlo)
+    def variant(self, path, encoding):
+        variant_path = sidecar_path(path, PRECOMPRESSED_SUFFIXES[encoding])
+        try:
+            if os.stat(variant_path).st_mtime_ns >= os.stat(path).st_mtime_ns:
+                return variant_path
+        except FileNotFoundError:
+            pass
+        return None
+
+    # Tamaño en disco y último uso de cada entrada publicada
+    def _entries(self):
+        entries = []
+        for entry in os.scandir(self.root):
+            if entry.name.startswith('.') or not entry.is_dir():
+                continue
+            size = _directory_size(entry.path)
+            try:
+                last_used = os.path.getmtime(os.path.join(entry.path, RESULT_FILE))
+            except FileNotFoundError:
+                last_used = entry.stat().st_mtime
+            entries.append((last_used, entry.name, size))
+        return sorted(entries)
+
+    # Desaloja las entradas más antiguas que max_age y después las menos usadas hasta quedar bajo max_bytes.
+    # Los directorios de trabajo abandonados (más antiguos que max_age) también se eliminan.
+    def evict(self, force=False):
+        now = time.time()
+        with self._lock:
+            if not force and now - self._last_evict < self.evict_interval:
+                return
+            self._last_evict = now
+        entries = self._entries()
+        total = sum(size for _, _, size in entries)
+        count = len(entries)
+        for last_used, key, size in entries:
+            if now - last_used <= self.max_age and total <= self.max_bytes:
+                break
+            shutil.rmtree(self.path(key), ignore_errors=True)
+            total -= size
+            count -= 1
+            with self._lock:
+                self.evictions += 1
+            logger.info("Resultado desalojado del almacén: %s (%d bytes)", key, size)
+        # El recorrido corrige los contadores (p. ej. archivos agregados o borrados por otro proceso)
+        with self._lock:
+            self.entries, self.total_bytes = count, total
+        for entry in os.scandir(self.root):
+            if entry.name.startswith('.') and entry.name != JOBS_DIR and entry.is_dir() and now - entry.stat().st_mtime > self.max_age:
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+    # Contadores del almacén; solo la primera llamada recorre el directorio si aún no hubo un desalojo
+    def stats(self):
+        with self._lock:
+            counted = self.entries is not None
+        if not counted:
+            entries = self._entries()
+            with self._lock:
+                if self.entries is None:
+                    self.entries, self.total_bytes = len(entries), sum(size for _, _, size in entries)
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': self.entries,
+                'bytes': self.total_bytes
+            }
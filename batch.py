@@ -0,0 +1,120 @@
+import json
+import logging
+import threading
+
+import numpy as np
+import pandas as pd
+
+from cruces import load_geojson_features, query_wfs_layers, merge_layer_parts, intersection_pairs, intersection_records, detect_overlaps
+from validator import check_feature_collection
+from wfs_cache import tiles_for_bbox, tile_bbox, DEFAULT_TILE_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Capas de un lote: las teselas descargadas se conservan en memoria durante todo el lote y cada fuente
+# mantiene un solo GeoDataFrame (con su índice espacial) que solo se reconstruye cuando llegan teselas nuevas.
+# Si se rebasa max_features se descarta todo y se vuelve a descargar lo necesario.
+class BatchLayers:
+    def __init__(self, capas, fetch, crs='EPSG:4326', tile_size=DEFAULT_TILE_SIZE, max_features=2_000_000):
+        self.capas = capas
+        self.fetch = fetch
+        self.crs = crs
+        self.tile_size = tile_size
+        self.max_features = max_features
+        self.fetches = 0
+        self._tiles = {}
+        self._layers = {}
+        self._lock = threading.Lock()
+
+    def _sources(self):
+        return sorted({(capa["wfs_url"], capa["layer_name"]) for capa in self.capas})
+
+    # Devuelve fuente -> GeoDataFrame con todas las teselas necesarias para cubrir los polígonos
+    def layers_for(self, polygons_gdf):
+        tiles = set()
+        for bounds in polygons_gdf.geometry.bounds.to_numpy():
+            tiles.update(tiles_for_bbox(bounds, self.tile_size))
+
+        with self._lock:
+            if sum(len(layer) for layer in self._layers.values()) > self.max_features:
+                logger.info("Capas del lote rebasan %d características; se descartan", self.max_features)
+                self._tiles.clear()
+                self._layers.clear()
+            missing = {(source, tile) for source in self._sources() for tile in tiles if (source, tile) not in self._tiles}
+            if missing:
+                self.fetches += len(missing)
+                parts = query_wfs_layers(
+                    {(source, tile): (source[0], source[1], tile_bbox(tile, self.tile_size), self.crs) for source, tile in missing},
+                    fetch=self.fetch
+                )
+                self._tiles.update(parts)
+                for source in {source for source, _ in missing}:
+                    # Las características que cruzan varias teselas se deduplican por id
+                    source_parts = [self._layers[source]] if source in self._layers else []
+                    source_parts += [part for (part_source, _), part in parts.items() if part_source == source]
+                    self._layers[source] = merge_layer_parts(source_parts, self.crs)
+            return {source: self._layers.get(source, merge_layer_parts([], self.crs)) for source in self._sources()}
+
+# Función para interpretar una línea NDJSON: un FeatureCollection o un solo Feature
+def parse_batch_line(line):
+    try:
+        data = json.loads(line)
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        raise ValueError('La línea no es JSON válido.')
+    if isinstance(data, dict) and data.get('type') == 'Feature':
+        data = {'type': 'FeatureCollection', 'features': [data]}
+    return check_feature_collection(data)
+
+# Función para analizar un grupo de líneas de un lote con las capas compartidas. lines es una lista de
+# (número de línea, texto). Devuelve los registros de salida en orden: cruces y superposiciones de cada
+# línea seguidos de su resumen, o un registro de error para las líneas que no se pudieron leer.
+def analyze_batch_lines(lines, batch_layers, repair=False):
+    output = {}
+    validations = {}
+    frames = []
+    for line_number, text in lines:
+        try:
+            polygons_gdf = load_geojson_features(parse_batch_line(text), repair=repair)
+        except Exception as e:
+            output[line_number] = [{"line": line_number, "error": str(e)}]
+            continue
+        frames.append(polygons_gdf.assign(line=line_number))
+        validations[line_number] = polygons_gdf.attrs.get("validation")
+        output[line_number] = []
+
+    if frames:
+        polygons_gdf = pd.concat(frames, ignore_index=True)
+        line_numbers = polygons_gdf['line'].to_numpy()
+        layers = batch_layers.layers_for(polygons_gdf)
+        pairs_by_source = {}
+        for capa in batch_layers.capas:
+            source = (capa["wfs_url"], capa["layer_name"])
+            if source not in pairs_by_source:
+                pairs_by_source[source] = intersection_pairs(polygons_gdf, layers[source])
+            pairs = pairs_by_source[source]
+            records = intersection_records(polygons_gdf, layers[source], pairs, capa["nombre"], capa["campos"], capa.get("tipo"))
+            for line_number, record in zip(line_numbers[pairs[0]].tolist(), records):
+                output[line_number].append({"line": line_number, "capa": capa["clave"], **record})
+
+        for line_number, line_gdf in polygons_gdf.groupby('line', sort=False):
+            line_gdf = line_gdf.drop(columns='line').reset_index(drop=True)
+            for overlap in detect_overlaps(line_gdf):
+                output[line_number].append({"line": line_number, "capa": "superposiciones", **overlap})
+            output[line_number].append({
+                "line": line_number,
+                "estado": "terminado",
+                "poligonos": len(line_gdf),
+                "registros": len(output[line_number]),
+                "validation": validations[line_number]
+            })
+
+    return [record for line_number, _ in lines for record in output[line_number]]
+
+# Función para convertir registros a líneas NDJSON
+def to_ndjson(records):
+    return ''.join(json.dumps(record, ensure_ascii=False, default=_json_default) + '\n' for record in records).encode('utf-8')
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
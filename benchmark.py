@@ -0,0 +1,428 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+import numpy as np
+import geopandas as gpd
+import shapely
+from shapely.geometry import box
+
+from cruces import calculate_intersections, intersection_pairs, detect_overlaps, load_geojson_from_text, generate_map_image
+from areas import area_m2
+from report import generate_pdf
+from wfs_local import LocalWFSServer
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Extensión aproximada de la zona de prueba (grados)
+BBOX_PRUEBA = (-100.0, 16.0, -99.0, 17.0)
+
+# Función para generar una capa sintética de celdas cuadradas tipo uso de suelo
+def synthetic_layer(n_features, bbox=BBOX_PRUEBA):
+    minx, miny, maxx, maxy = bbox
+    side = int(np.ceil(np.sqrt(n_features)))
+    dx, dy = (maxx - minx) / side, (maxy - miny) / side
+    geometries = []
+    for k in range(n_features):
+        i, j = divmod(k, side)
+        geometries.append(box(minx + j * dx, miny + i * dy, minx + (j + 1) * dx, miny + (i + 1) * dy))
+    return gpd.GeoDataFrame({
+        'id': [f"capa.{k + 1}" for k in range(n_features)],
+        'tip_veg': ['BOSQUE' if k % 2 else 'AGRICOLA' for k in range(n_features)],
+        'des_veg': [f"Descripción {k % 7}" for k in range(n_features)],
+        'geometry': geometries
+    }, crs='EPSG:4326')
+
+# Función para generar una capa sintética de pocas características enormes (polígonos estrellados con
+# muchos vértices, como los de uso de suelo o ANP)
+def synthetic_high_vertex_layer(n_features, vertices, bbox=BBOX_PRUEBA, seed=1):
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = bbox
+    side = int(np.ceil(np.sqrt(n_features)))
+    dx, dy = (maxx - minx) / side, (maxy - miny) / side
+    angles = np.linspace(0, 2 * np.pi, vertices, endpoint=False)
+    geometries = []
+    for k in range(n_features):
+        i, j = divmod(k, side)
+        cx, cy = minx + (j + 0.5) * dx, miny + (i + 0.5) * dy
+        radius = 0.6 * dx * (1 + 0.08 * np.sin(37 * angles) + 0.04 * rng.random(vertices))
+        geometries.append(shapely.Polygon(np.c_[cx + radius * np.cos(angles), cy + radius * np.sin(angles)]))
+    return gpd.GeoDataFrame({
+        'id': [f"capa.{k + 1}" for k in range(n_features)],
+        'geometry': geometries
+    }, crs='EPSG:4326')
+
+# Función para generar predios sintéticos dispersos dentro de la zona de prueba. Con vertices=4 son cuadrados;
+# con más vértices, polígonos de contorno ondulado inscritos en el mismo cuadrado. prefix antecede a los predio_id.
+def synthetic_parcels(n_parcels, size=0.01, bbox=BBOX_PRUEBA, seed=0, vertices=4, prefix='predio'):
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = bbox
+    xs = rng.uniform(minx, maxx - size, n_parcels)
+    ys = rng.uniform(miny, maxy - size, n_parcels)
+    if vertices <= 4:
+        geometries = [box(x, y, x + size, y + size) for x, y in zip(xs, ys)]
+    else:
+        angles = np.linspace(0, 2 * np.pi, vertices, endpoint=False)
+        radius = size / 2 * (0.85 + 0.15 * np.sin(7 * angles))
+        offsets = np.c_[radius * np.cos(angles), radius * np.sin(angles)]
+        geometries = [shapely.Polygon(offsets + (x + size / 2, y + size / 2)) for x, y in zip(xs, ys)]
+    gdf = gpd.GeoDataFrame({
+        'geometry': geometries,
+        'predio_id': [f"{prefix}_{k // 4}" for k in range(n_parcels)],
+        'subpoligono_id': [f"{prefix}_{k // 4}_subpoligono_{k + 1}" for k in range(n_parcels)]
+    }, crs='EPSG:4326')
+    gdf['id'] = range(1, len(gdf) + 1)
+    return gdf
+
+# Función para generar el texto de un FeatureCollection de predios sintéticos, como lo recibe /analyze/
+def synthetic_feature_collection(n_parcels, vertices=4, size=0.01, seed=0, prefix='predio'):
+    parcels = synthetic_parcels(n_parcels, size=size, seed=seed, vertices=vertices, prefix=prefix)
+    return parcels.drop(columns=['id']).rename(columns={'subpoligono_id': 'poligono'}).to_json(drop_id=True)
+
+# Función para medir el tiempo de una llamada
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+# Función para medir una llamada: el mejor tiempo de `repeat` ejecuciones y, con memory=True, el pico de
+# memoria en una ejecución aparte con tracemalloc (memoria de Python y numpy; no incluye la de GEOS), para
+# que el rastreo no altere el tiempo. make_args devuelve los argumentos de cada ejecución.
+def measure(make_args, func, repeat=1, memory=True):
+    seconds = []
+    for run in range(repeat):
+        args, kwargs = make_args(run)
+        result, elapsed = timed(func, *args, **kwargs)
+        seconds.append(elapsed)
+    row = {'seconds': round(min(seconds), 4)}
+    if memory:
+        args, kwargs = make_args(repeat)
+        tracemalloc.start()
+        try:
+            func(*args, **kwargs)
+            row['peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 1e6, 2)
+        finally:
+            tracemalloc.stop()
+    return result, row
+
+# Función para medir una llamada con los mismos argumentos en cada ejecución
+def measure_call(func, *args, repeat=1, memory=True, **kwargs):
+    return measure(lambda run: (args, kwargs), func, repeat, memory)
+
+# Benchmark del motor de intersecciones contra el ciclo original
+def bench_intersections(sizes, loop_limit):
+    rows = []
+    for n_parcels, n_features in sizes:
+        parcels = synthetic_parcels(n_parcels)
+        layer = synthetic_layer(n_features)
+        fields = ['tip_veg', 'des_veg']
+        strtree, t_strtree = timed(calculate_intersections, parcels, layer, 'Usos de Suelo Serie VII', fields, engine='strtree')
+        row = {'parcels': n_parcels, 'features': n_features, 'intersections': len(strtree), 'strtree_s': round(t_strtree, 4)}
+        if n_parcels * n_features <= loop_limit:
+            loop, t_loop = timed(calculate_intersections, parcels, layer, 'Usos de Suelo Serie VII', fields, engine='loop')
+            row['loop_s'] = round(t_loop, 4)
+            row['speedup'] = round(t_loop / t_strtree, 1) if t_strtree else None
+            row['same_records'] = loop == strtree
+        rows.append(row)
+    return rows
+
+# Verificación de los campos ausentes: una capa sin los campos configurados (o con solo algunos) debe producir
+# los mismos registros que el ciclo original, con 'Desconocido' en los campos que faltan
+def check_missing_fields(n_parcels=100, n_features=1_000):
+    rows = []
+    parcels = synthetic_parcels(n_parcels, size=0.05)
+    layer = synthetic_layer(n_features)
+    for fields in (['no_existe'], ['tip_veg', 'no_existe'], ['nombre', 'cat_manejo', 'superficie']):
+        strtree = calculate_intersections(parcels, layer, 'Capa sintética', fields, engine='strtree')
+        loop = calculate_intersections(parcels, layer, 'Capa sintética', fields, engine='loop')
+        rows.append({'fields': fields, 'intersections': len(strtree), 'loop_intersections': len(loop), 'same_records': loop == strtree})
+    return rows
+
+# Benchmark de los atajos del cruce (geometrías preparadas, predios contenidos y características enormes
+# por partes) contra la intersección completa de cada par. La segunda llamada reutiliza las geometrías
+# preparadas y las particiones de la primera, como ocurre con las capas residentes.
+def bench_fast_paths(cases):
+    rows = []
+    for n_features, vertices, n_parcels in cases:
+        parcels = synthetic_parcels(n_parcels)
+        full, t_full = timed(intersection_pairs, parcels, synthetic_high_vertex_layer(n_features, vertices), fast_paths=False)
+        layer = synthetic_high_vertex_layer(n_features, vertices)
+        fast, t_fast = timed(intersection_pairs, parcels, layer)
+        _, t_warm = timed(intersection_pairs, parcels, layer)
+        rows.append({
+            'features': n_features,
+            'vertices': vertices,
+            'parcels': n_parcels,
+            'intersections': len(full[0]),
+            'full_overlay_s': round(t_full, 4),
+            'fast_paths_s': round(t_fast, 4),
+            'fast_paths_warm_s': round(t_warm, 4),
+            'speedup': round(t_full / t_fast, 1) if t_fast else None,
+            'same_pairs': bool(np.array_equal(full[0], fast[0]) and np.array_equal(full[1], fast[1])),
+            'max_rel_diff_m2': float(np.max(np.abs(full[3] - fast[3]) / np.maximum(full[3], 1))) if len(full[3]) else 0.0
+        })
+    return rows
+
+# Benchmark de la detección de superposiciones contra el ciclo original
+def bench_overlaps(sizes, loop_limit):
+    rows = []
+    for n_parcels in sizes:
+        parcels = synthetic_parcels(n_parcels)
+        strtree, t_strtree = timed(detect_overlaps, parcels, engine='strtree')
+        row = {'parcels': n_parcels, 'overlaps': len(strtree), 'strtree_s': round(t_strtree, 4)}
+        if n_parcels * n_parcels // 2 <= loop_limit:
+            loop, t_loop = timed(detect_overlaps, parcels, engine='loop')
+            row['loop_s'] = round(t_loop, 4)
+            row['speedup'] = round(t_loop / t_strtree, 1) if t_strtree else None
+            row['same_records'] = loop == strtree
+        rows.append(row)
+    return rows
+
+# Benchmark del cálculo de áreas en m²: multiplicación por fila (anterior) contra el cálculo por lotes
+def bench_areas(sizes):
+    rows = []
+    for n_geometries in sizes:
+        geometries = synthetic_parcels(n_geometries, size=0.005, bbox=(-117.0, 14.0, -86.0, 32.0)).geometry.values
+
+        def per_row():
+            return [f"{geometry.area * 12321000000:.2f} m² (estimado)" for geometry in geometries]
+
+        _, t_row = timed(per_row)
+        _, t_batch = timed(area_m2, geometries)
+        rows.append({'geometries': n_geometries, 'per_row_s': round(t_row, 4), 'batch_s': round(t_batch, 4)})
+    return rows
+
+# Secciones del PDF para la capa sintética
+SYNTHETIC_SECTIONS = [{'clave': 'sintetica', 'titulo': 'Intersecciones con la capa sintética', 'campos': [('tip_veg', 'Tipo'), ('des_veg', 'Descripción')]}]
+
+# Benchmark de cada etapa del análisis por separado (lectura del GeoJSON, cruces, superposiciones, mapa y PDF)
+# para cada número de predios y de vértices por predio
+def bench_functions(sizes, vertices_list, n_features, repeat=1, memory=True):
+    rows = []
+    layer = synthetic_layer(n_features)
+    with tempfile.TemporaryDirectory() as tmp:
+        output_image = os.path.join(tmp, 'mapa.png')
+        output_pdf = os.path.join(tmp, 'reporte.pdf')
+        for vertices in vertices_list:
+            for n_parcels in sizes:
+                text = synthetic_feature_collection(n_parcels, vertices=vertices)
+                row = {'parcels': n_parcels, 'vertices': vertices, 'features': n_features, 'geojson_bytes': len(text)}
+                parcels, row['load_geojson_from_text'] = measure_call(load_geojson_from_text, text, repeat=repeat, memory=memory)
+                records, row['calculate_intersections'] = measure_call(calculate_intersections, parcels, layer, 'Capa sintética', ['tip_veg', 'des_veg'], repeat=repeat, memory=memory)
+                overlaps, row['detect_overlaps'] = measure_call(detect_overlaps, parcels, repeat=repeat, memory=memory)
+                _, row['generate_map_image'] = measure_call(generate_map_image, parcels, output_image, repeat=repeat, memory=memory)
+                stats, row['generate_pdf'] = measure_call(generate_pdf, parcels, output_pdf, output_image, {'sintetica': records}, overlaps,
+                                                          sections=SYNTHETIC_SECTIONS, repeat=repeat, memory=memory)
+                row.update(intersections=len(records), overlaps=len(overlaps), pdf_pages=stats['pages'])
+                rows.append(row)
+    return rows
+
+# Función para enviar un FeatureCollection a /analyze/ y esperar a que termine el trabajo
+def _analyze_and_wait(client, text, query):
+    response = client.post(f'/analyze/?{query}', content=text, headers={'Content-Type': 'application/json'})
+    response.raise_for_status()
+    job_id = response.json()['job_id']
+    while True:
+        job = client.get(f'/jobs/{job_id}').json()
+        if job['state'] == 'terminado':
+            return job['result']
+        if job['state'] == 'error':
+            raise RuntimeError(f"El análisis falló: {job['error']}")
+        time.sleep(0.01)
+
+# Benchmark de extremo a extremo de POST /analyze/ con eager=true (ingesta, descarga de las capas, cruces,
+# superposiciones, guardado, mapa y PDF) contra un WFS local que sirve una capa sintética en lugar de cada capa
+# de capas.json. Cada ejecución usa otros predio_id para que no se reutilice un resultado del almacén.
+def bench_analyze(sizes, vertices_list, n_features, repeat=1, memory=True):
+    # La API se importa aquí porque lee la configuración del entorno al importarse: sin caché de teselas
+    # (cada análisis descarga las capas del WFS local) y con un almacén de resultados temporal
+    os.environ.setdefault('CRUCES_WFS_CACHE', '0')
+    os.environ.setdefault('CRUCES_ARTIFACT_DIR', tempfile.mkdtemp(prefix='cruces_benchmark_'))
+    from fastapi.testclient import TestClient
+    from capas import CAPAS
+    import main as api
+
+    rows = []
+    layer = synthetic_layer(n_features)
+    wfs_urls = [capa['wfs_url'] for capa in CAPAS]
+    with LocalWFSServer({capa['layer_name']: layer for capa in CAPAS}) as server, TestClient(api.app) as client:
+        for capa in CAPAS:
+            capa['wfs_url'] = server.url
+        try:
+            for vertices in vertices_list:
+                for n_parcels in sizes:
+                    def make_args(run):
+                        text = synthetic_feature_collection(n_parcels, vertices=vertices, prefix=f"ejecucion{run}_{n_parcels}_{vertices}")
+                        return (client, text, 'eager=true'), {}
+                    result, row = measure(make_args, _analyze_and_wait, repeat=repeat, memory=memory)
+                    rows.append({'parcels': n_parcels, 'vertices': vertices, 'features': n_features, 'layers': len(CAPAS),
+                                 'analyze': row, 'pdf_pages': result['report_stats']['pages']})
+        finally:
+            for capa, wfs_url in zip(CAPAS, wfs_urls):
+                capa['wfs_url'] = wfs_url
+    return rows
+
+# Código que mide el arranque en un intérprete nuevo: importación de la API, precalentamiento (con "precalentado")
+# y dos veces el trabajo de una solicitud pequeña (áreas, mapa y PDF): la primera paga la inicialización diferida
+STARTUP_PROBE = """
+import json, os, sys, tempfile, time
+start = time.perf_counter()
+import main
+timings = {'import_main': time.perf_counter() - start}
+if sys.argv[1] == 'precalentado':
+    from warmup import warm_up
+    start = time.perf_counter()
+    warm_up()
+    timings['warm_up'] = time.perf_counter() - start
+from areas import area_m2
+from cruces import generate_map_image
+from report import generate_pdf
+from benchmark import synthetic_parcels
+parcels = synthetic_parcels(20)
+with tempfile.TemporaryDirectory() as tmp:
+    for name in ('first_request', 'second_request'):
+        start = time.perf_counter()
+        area_m2(parcels.geometry.values)
+        generate_map_image(parcels, os.path.join(tmp, 'mapa.png'))
+        generate_pdf(parcels, os.path.join(tmp, 'reporte.pdf'), os.path.join(tmp, 'mapa.png'), {}, [])
+        timings[name] = time.perf_counter() - start
+timings['modules'] = len(sys.modules)
+print(json.dumps(timings))
+"""
+
+# Función para obtener los módulos de primer nivel que más tardan en importarse con la API (python -X importtime)
+def _import_profile(top=10):
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import main'], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__))).stderr
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line.split('|')
+        if cumulative.strip().isdigit() and name.startswith('   ') and not name.startswith('    '):
+            modules.append({'module': name.strip(), 'seconds': round(int(cumulative) / 1e6, 4)})
+    return sorted(modules, key=lambda module: -module['seconds'])[:top]
+
+# Benchmark del arranque de un proceso de la API, en un intérprete nuevo por ejecución: sin precalentar (la
+# primera solicitud inicializa matplotlib, pyproj y las fuentes) y precalentado con warmup.warm_up
+def bench_startup(repeat=1):
+    rows = []
+    for scenario in ('frio', 'precalentado'):
+        runs = []
+        for _ in range(repeat):
+            completed = subprocess.run([sys.executable, '-c', STARTUP_PROBE, scenario], capture_output=True, text=True, check=True,
+                                       cwd=os.path.dirname(os.path.abspath(__file__)))
+            runs.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+        row = {'scenario': scenario, 'modules': runs[0]['modules']}
+        for name in runs[0]:
+            if name != 'modules':
+                row[name] = {'seconds': round(min(run[name] for run in runs), 4)}
+        rows.append(row)
+    rows.append({'scenario': 'importaciones', 'slowest_imports': _import_profile()})
+    return rows
+
+# Función para describir el entorno de la medición (versión del código, Python, GEOS, CPUs)
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'shapely': shapely.__version__,
+        'geos': shapely.geos_version_string
+    }
+
+# Campos que identifican una fila al comparar dos resultados
+ROW_KEYS = ('parcels', 'features', 'vertices', 'geometries', 'scenario')
+
+# Función para comparar los tiempos de dos archivos de resultados: por cada benchmark, fila (mismos
+# parámetros) y medición presentes en ambos, el tiempo anterior, el actual y su cociente (< 1: más rápido)
+def compare_results(before, after):
+    rows = []
+    for name, new_rows in after['results'].items():
+        old_rows = {tuple(row.get(key) for key in ROW_KEYS): row for row in before['results'].get(name, [])}
+        for new_row in new_rows:
+            params = tuple(new_row.get(key) for key in ROW_KEYS)
+            old_row = old_rows.get(params)
+            if old_row is None:
+                continue
+            for metric, value in new_row.items():
+                old_value = old_row.get(metric)
+                if isinstance(value, dict) and isinstance(old_value, dict) and 'seconds' in value:
+                    value, old_value = value['seconds'], old_value['seconds']
+                elif not (metric.endswith('_s') and isinstance(value, (int, float)) and isinstance(old_value, (int, float))):
+                    continue
+                rows.append({'benchmark': name, **{key: param for key, param in zip(ROW_KEYS, params) if param is not None},
+                             'metric': metric, 'before_s': old_value, 'after_s': value,
+                             'ratio': round(value / old_value, 3) if old_value else None})
+    return rows
+
+def _int_list(value):
+    return [int(item) for item in value.split(',') if item.strip()]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de los cruces espaciales")
+    parser.add_argument('--suite', choices=['motores', 'funciones', 'analyze', 'arranque', 'todo'], default='motores',
+                        help="motores: cruces y superposiciones contra los ciclos originales; funciones: cada etapa del análisis; "
+                             "analyze: POST /analyze/ de extremo a extremo con un WFS local; arranque: importación y primera "
+                             "solicitud de un proceso nuevo, con y sin precalentamiento; todo: las cuatro")
+    parser.add_argument('--loop-limit', type=int, default=1_000_000,
+                        help="Máximo de pares predio×característica para ejecutar también el ciclo original")
+    parser.add_argument('--sizes', type=_int_list, default=[100, 1_000, 5_000], help="Números de predios, separados por comas")
+    parser.add_argument('--vertices', type=_int_list, default=[4, 64], help="Vértices por predio, separados por comas")
+    parser.add_argument('--features', type=int, default=10_000, help="Características de la capa sintética")
+    parser.add_argument('--repeat', type=int, default=3, help="Ejecuciones por medición (se informa la más rápida)")
+    parser.add_argument('--no-memory', action='store_true', help="No medir el pico de memoria")
+    parser.add_argument('--output', help="Archivo JSON donde guardar los resultados")
+    parser.add_argument('--compare', help="Archivo JSON de una medición anterior con el que comparar los tiempos")
+    args = parser.parse_args()
+
+    results = {}
+    if args.suite in ('motores', 'todo'):
+        sizes = [(10, 1_000), (100, 1_000), (100, 10_000), (500, 10_000), (500, 50_000)]
+        results.update({
+            'calculate_intersections': bench_intersections(sizes, args.loop_limit),
+            'missing_fields': check_missing_fields(),
+            'intersection_fast_paths': bench_fast_paths([(4, 50_000, 2_000), (16, 20_000, 2_000), (400, 200, 2_000)]),
+            'detect_overlaps': bench_overlaps([100, 500, 1_000, 5_000, 20_000], args.loop_limit),
+            'area_m2': bench_areas([10_000, 100_000])
+        })
+    if args.suite in ('funciones', 'todo'):
+        results['functions'] = bench_functions(args.sizes, args.vertices, args.features, args.repeat, not args.no_memory)
+    if args.suite in ('analyze', 'todo'):
+        results['analyze'] = bench_analyze(args.sizes, args.vertices, args.features, args.repeat, not args.no_memory)
+    if args.suite in ('arranque', 'todo'):
+        results['startup'] = bench_startup(args.repeat)
+
+    output = {'environment': environment(), 'params': vars(args), 'results': results}
+    if resource is not None:
+        # ru_maxrss está en KB en Linux
+        output['environment']['max_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    if args.compare:
+        with open(args.compare) as f:
+            output['comparison'] = compare_results(json.load(f), output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=4)
+    print(json.dumps(output, indent=4))
+    # Cualquier diferencia con el ciclo original es una regresión: el script termina con error
+    if any(row.get('same_records') is False for rows in results.values() for row in rows):
+        sys.exit("Los registros del motor no coinciden con los del ciclo original (same_records: false)")
+
+if __name__ == "__main__":
+    main()
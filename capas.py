@@ -0,0 +1,49 @@
+import json
+import os
+
+# Archivo con la descripción de las capas de referencia (CRUCES_CAPAS_CONFIG para usar otro)
+CAPAS_CONFIG = os.environ.get("CRUCES_CAPAS_CONFIG", os.path.join(os.path.dirname(os.path.abspath(__file__)), "capas.json"))
+
+REQUIRED_KEYS = ("clave", "nombre", "wfs_url", "layer_name", "campos")
+
+# Función para cargar y validar la descripción de las capas. Cada capa tiene clave, nombre, wfs_url,
+# layer_name y campos ([campo, etiqueta]); opcionalmente tipo, seccion (título en el PDF), ttl (segundos
+# en la caché de teselas) y version. Devuelve la lista de capas con campos como lista de nombres y
+# etiquetas como lista de (campo, etiqueta).
+def load_layer_config(path=CAPAS_CONFIG):
+    with open(path, encoding='utf-8') as f:
+        config = json.load(f)
+    capas = []
+    claves = set()
+    for k, capa in enumerate(config):
+        missing = [key for key in REQUIRED_KEYS if key not in capa]
+        if missing:
+            raise ValueError(f"Capa {k} de {path}: faltan {', '.join(missing)}")
+        if capa["clave"] in claves:
+            raise ValueError(f"Capa {k} de {path}: clave repetida {capa['clave']}")
+        claves.add(capa["clave"])
+        etiquetas = [(campo, etiqueta) for campo, etiqueta in capa["campos"]]
+        capas.append({
+            **capa,
+            "campos": [campo for campo, _ in etiquetas],
+            "etiquetas": etiquetas,
+            "seccion": capa.get("seccion", f"Intersecciones con {capa['nombre']}")
+        })
+    return capas
+
+# Función para elegir las capas de una solicitud a partir de sus claves separadas por comas
+# (None o vacío: todas). Conserva el orden de la configuración.
+def select_layers(capas, claves=None):
+    if not claves:
+        return capas
+    requested = {clave.strip() for clave in claves.split(',') if clave.strip()}
+    unknown = requested - {capa["clave"] for capa in capas}
+    if unknown:
+        raise ValueError(f"Capas desconocidas: {', '.join(sorted(unknown))}. Disponibles: {', '.join(capa['clave'] for capa in capas)}")
+    return [capa for capa in capas if capa["clave"] in requested]
+
+# Función para obtener la descripción de las secciones de intersecciones del PDF
+def report_sections(capas):
+    return [{"clave": capa["clave"], "titulo": capa["seccion"], "campos": capa["etiquetas"]} for capa in capas]
+
+CAPAS = load_layer_config()
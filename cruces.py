@@ -1,66 +1,346 @@
 import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
 import json
-from shapely.geometry import shape, Polygon, MultiPolygon
-from owslib.wfs import WebFeatureService
-import matplotlib.pyplot as plt
-from fpdf import FPDF
+from shapely.geometry import shape
+from validator import check_topology_bulk
+from metrics import RateLimitFilter, WFS_PAGES, WFS_BYTES, WFS_FEATURES
+from areas import area_m2
+import io
 import os
+import re
+import logging
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-
-# Función para realizar la consulta WFS y convertir a GeoDataFrame
-def query_wfs_layer(wfs_url, layer_name, bbox, crs):
-    wfs = WebFeatureService(url=wfs_url, version='1.1.0')
-    response = wfs.getfeature(
-        typename=layer_name,
+import requests
+
+# Configuración del cliente HTTP compartido para las consultas WFS
+WFS_MAX_WORKERS = int(os.environ.get("CRUCES_WFS_MAX_WORKERS", "6"))
+WFS_TIMEOUT = int(os.environ.get("CRUCES_WFS_TIMEOUT", "120"))
+WFS_PAGE_SIZE = int(os.environ.get("CRUCES_WFS_PAGE_SIZE", "1000"))
+# Propiedad por la que se ordenan las páginas (sortBy) para que el orden sea estable entre consultas
+WFS_SORT_BY = os.environ.get("CRUCES_WFS_SORT_BY", "id")
+
+# Parámetros del planificador de consultas por grupos de polígonos
+QUERY_WASTE_THRESHOLD = float(os.environ.get("CRUCES_QUERY_WASTE_THRESHOLD", "1.0"))
+QUERY_CELL_SIZE = float(os.environ.get("CRUCES_QUERY_CELL_SIZE", "0.5"))
+
+# Vértices a partir de los cuales una característica se cruza por partes (subdivide_geometry)
+SUBDIVIDE_VERTICES = int(os.environ.get("CRUCES_SUBDIVIDE_VERTICES", "256"))
+
+logger = logging.getLogger(__name__)
+# Registro de cada intersección encontrada (nivel DEBUG), limitado a CRUCES_DEBUG_LOG_RATE mensajes por segundo
+intersection_logger = logging.getLogger(__name__ + '.intersecciones')
+intersection_logger.addFilter(RateLimitFilter(rate=int(os.environ.get("CRUCES_DEBUG_LOG_RATE", "20"))))
+
+_wfs_services = {}
+_wfs_services_lock = threading.Lock()
+_http_session = None
+_http_session_lock = threading.Lock()
+_fetch_pool = None
+_inflight = {}
+_inflight_lock = threading.Lock()
+wfs_stats = {'pages': 0, 'bytes': 0, 'features': 0}
+_wfs_stats_lock = threading.Lock()
+_subdivisions = {}
+_subdivisions_lock = threading.Lock()
+
+# Función para obtener el servicio WFS de una URL; el GetCapabilities se descarga una sola vez por URL.
+# owslib se importa aquí y no al importar el módulo (arranque más rápido de la API)
+def get_wfs(wfs_url, version='1.1.0'):
+    from owslib.wfs import WebFeatureService
+    with _wfs_services_lock:
+        entry = _wfs_services.setdefault((wfs_url, version), {'lock': threading.Lock(), 'wfs': None})
+    with entry['lock']:
+        if entry['wfs'] is None:
+            entry['wfs'] = WebFeatureService(url=wfs_url, version=version, timeout=WFS_TIMEOUT)
+        return entry['wfs']
+
+# Función para obtener la sesión HTTP compartida con conexiones persistentes (keep-alive)
+def get_http_session():
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=WFS_MAX_WORKERS, pool_maxsize=WFS_MAX_WORKERS)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _http_session = session
+        return _http_session
+
+# Función para sumar páginas y bytes descargados a los contadores de ingesta WFS y a las métricas por capa
+def _count_download(n_bytes, n_features, layer_name=''):
+    with _wfs_stats_lock:
+        wfs_stats['pages'] += 1
+        wfs_stats['bytes'] += n_bytes
+        wfs_stats['features'] += n_features
+    WFS_PAGES.inc(layer=layer_name)
+    WFS_BYTES.inc(n_bytes, layer=layer_name)
+    WFS_FEATURES.inc(n_features, layer=layer_name)
+
+# Función para copiar los contadores de ingesta WFS
+def get_wfs_stats():
+    with _wfs_stats_lock:
+        return dict(wfs_stats)
+
+# Función para leer los conteos de una respuesta GeoJSON de GetFeature (numberReturned, numberMatched,
+# totalFeatures). Los servidores los escriben antes o después de la lista de características, así que solo
+# se revisan los extremos de la respuesta.
+def _page_counts(content):
+    counts = {}
+    for chunk in (content[:512], content[-1024:]):
+        for name, value in re.findall(rb'"(numberReturned|numberMatched|totalFeatures)"\s*:\s*(\d+)', chunk):
+            counts[name.decode()] = int(value)
+    return counts
+
+# Función para descargar una respuesta GetFeature en GeoJSON; devuelve el GeoDataFrame y los conteos de la respuesta
+def _get_feature_response(wfs, layer_name, bbox, crs, maxfeatures=None, startindex=None, sortby=None):
+    request_url = wfs.getGETGetFeatureRequest(
+        typename=[layer_name],
         bbox=bbox,
-        outputFormat='application/json'
+        outputFormat='application/json',
+        maxfeatures=maxfeatures,
+        startindex=startindex,
+        sortby=sortby
     )
-    gdf = gpd.read_file(response)
-    print(f"Descargado {len(gdf)} características de {layer_name}")
+    response = get_http_session().get(request_url, timeout=WFS_TIMEOUT)
+    response.raise_for_status()
+    if response.content.lstrip().startswith(b'<'):
+        raise ValueError(f"El servicio WFS devolvió un error para {layer_name}: {response.text[:500]}")
+    gdf = gpd.read_file(io.BytesIO(response.content))
+    _count_download(len(response.content), len(gdf), layer_name)
     gdf.crs = crs  # Establece el CRS a EPSG:4326
+    return gdf, _page_counts(response.content)
+
+# Función para descargar una respuesta GetFeature en GeoJSON y convertirla a GeoDataFrame
+def _get_feature_page(wfs, layer_name, bbox, crs, maxfeatures=None, startindex=None):
+    return _get_feature_response(wfs, layer_name, bbox, crs, maxfeatures, startindex)[0]
+
+# Función para realizar la consulta WFS y convertir a GeoDataFrame
+def query_wfs_layer(wfs_url, layer_name, bbox, crs):
+    gdf = _get_feature_page(get_wfs(wfs_url), layer_name, bbox, crs)
+    logger.info("Descargado %d características de %s", len(gdf), layer_name)
     return gdf
 
+# Función para recorrer una capa WFS por páginas (startIndex/maxFeatures, ordenadas por sort_by); la memoria queda
+# acotada por el tamaño de página. Termina cuando los conteos del servidor (numberMatched/totalFeatures) indican que
+# no hay más características o, si no los informa, con una página incompleta. Si el servidor ignora startIndex (la
+# página repite el primer id de la anterior) el resto se descarga en una sola consulta sin paginar. Si el servidor
+# rechaza sort_by se pagina sin orden.
+def iter_wfs_pages(wfs_url, layer_name, bbox, crs, page_size=None, sort_by=WFS_SORT_BY):
+    page_size = page_size or WFS_PAGE_SIZE
+    wfs = get_wfs(wfs_url)
+    start = 0
+    first_ids = None
+    while True:
+        try:
+            page, counts = _get_feature_response(wfs, layer_name, bbox, crs, maxfeatures=page_size, startindex=start,
+                                                 sortby=[sort_by] if sort_by else None)
+        except ValueError as e:
+            # La capa no tiene la propiedad de ordenamiento; se pagina en el orden del servidor
+            if not sort_by or start:
+                raise
+            logger.warning("No se pudo ordenar %s por %s: %s", layer_name, sort_by, e)
+            sort_by = None
+            continue
+        ids = page['id'].tolist() if 'id' in page.columns else None
+        if start and ids and first_ids and ids[0] == first_ids[0]:
+            logger.warning("El servicio WFS ignora startIndex para %s; se descarga el resto sin paginar", layer_name)
+            seen = set(first_ids)
+            rest = _get_feature_page(wfs, layer_name, bbox, crs)
+            rest = rest[~rest['id'].isin(seen)] if 'id' in rest.columns else rest.iloc[0:0]
+            if len(rest):
+                yield rest.reset_index(drop=True)
+            break
+        if len(page):
+            yield page
+        # El servidor puede devolver menos de page_size por su propio límite por consulta: con un total informado
+        # se sigue hasta alcanzarlo y la siguiente página empieza después de lo recibido
+        total = counts.get('numberMatched', counts.get('totalFeatures'))
+        if len(page) == 0 or (total is not None and start + len(page) >= total) or (total is None and len(page) < page_size):
+            break
+        first_ids = ids
+        start += len(page)
+
+def _get_fetch_pool():
+    global _fetch_pool
+    with _inflight_lock:
+        if _fetch_pool is None:
+            _fetch_pool = ThreadPoolExecutor(max_workers=WFS_MAX_WORKERS, thread_name_prefix='wfs')
+        return _fetch_pool
+
+# Función para programar una descarga; las consultas idénticas en curso comparten el mismo resultado
+def submit_layer_fetch(wfs_url, layer_name, bbox, crs, fetch=query_wfs_layer):
+    key = (fetch, wfs_url, layer_name, tuple(float(v) for v in bbox), crs)
+    pool = _get_fetch_pool()
+    with _inflight_lock:
+        future = _inflight.get(key)
+        if future is not None:
+            return future
+        future = pool.submit(fetch, wfs_url, layer_name, bbox, crs)
+        _inflight[key] = future
+
+    def release(done):
+        with _inflight_lock:
+            if _inflight.get(key) is done:
+                del _inflight[key]
+
+    future.add_done_callback(release)
+    return future
+
+# Función para descargar varias capas en paralelo; recibe un diccionario clave -> (wfs_url, layer_name, bbox, crs)
+def query_wfs_layers(layer_requests, fetch=query_wfs_layer):
+    futures = {key: submit_layer_fetch(*request, fetch=fetch) for key, request in layer_requests.items()}
+    return {key: future.result() for key, future in futures.items()}
+
 # Función para calcular el bounding box de los polígonos
 def calculate_bbox(polygons_gdf):
     minx, miny, maxx, maxy = polygons_gdf.total_bounds
     return (minx, miny, maxx, maxy)
 
-# Función para cargar GeoJSON desde un texto y soportar múltiples tipos de geometrías
+# Función para agrupar los polígonos en cajas de consulta. Los polígonos se agrupan primero por celda de una malla;
+# después el conjunto de celdas se divide recursivamente por el mayor hueco (o por la mediana) hasta que en cada caja
+# el área desperdiciada sea aceptable: área de la caja <= área de sus celdas × (1 + waste_threshold)
+def plan_query_bboxes(polygons_gdf, waste_threshold=QUERY_WASTE_THRESHOLD, cell_size=QUERY_CELL_SIZE):
+    bounds = polygons_gdf.geometry.bounds.to_numpy()
+    if len(bounds) == 0:
+        return []
+    centers = np.stack([(bounds[:, 0] + bounds[:, 2]) / 2, (bounds[:, 1] + bounds[:, 3]) / 2], axis=1)
+    _, cell_index = np.unique(np.floor(centers / cell_size), axis=0, return_inverse=True)
+    cell_index = cell_index.ravel()
+    cells = np.tile([np.inf, np.inf, -np.inf, -np.inf], (cell_index.max() + 1, 1))
+    np.minimum.at(cells[:, 0], cell_index, bounds[:, 0])
+    np.minimum.at(cells[:, 1], cell_index, bounds[:, 1])
+    np.maximum.at(cells[:, 2], cell_index, bounds[:, 2])
+    np.maximum.at(cells[:, 3], cell_index, bounds[:, 3])
+
+    boxes = []
+    pending = [cells]
+    while pending:
+        group = pending.pop()
+        bbox = (group[:, 0].min(), group[:, 1].min(), group[:, 2].max(), group[:, 3].max())
+        bbox_area = (bbox[2] - bbox[0]) * (bbox[3] - bbox[1])
+        cells_area = ((group[:, 2] - group[:, 0]) * (group[:, 3] - group[:, 1])).sum()
+        if len(group) == 1 or bbox_area <= cells_area * (1 + waste_threshold) + 1e-12:
+            boxes.append(tuple(float(v) for v in bbox))
+            continue
+        # Se busca el hueco vacío más ancho entre celdas en cada eje
+        best_gap, best_split = 0.0, None
+        for axis in (0, 1):
+            order = np.argsort(group[:, axis], kind='stable')
+            running_max = np.maximum.accumulate(group[order, axis + 2])
+            gaps = group[order[1:], axis] - running_max[:-1]
+            k = int(np.argmax(gaps))
+            if gaps[k] > best_gap:
+                best_gap, best_split = gaps[k], (order[:k + 1], order[k + 1:])
+        if best_split is None:
+            # Sin huecos: se divide por la mediana de los centros en el eje más largo
+            axis = 0 if bbox[2] - bbox[0] >= bbox[3] - bbox[1] else 1
+            order = np.argsort((group[:, axis] + group[:, axis + 2]) / 2, kind='stable')
+            half = len(order) // 2
+            best_split = (order[:half], order[half:])
+        pending.extend(group[part] for part in best_split)
+
+    total_area = float(sum((b[2] - b[0]) * (b[3] - b[1]) for b in boxes))
+    minx, miny, maxx, maxy = calculate_bbox(polygons_gdf)
+    global_area = float((maxx - minx) * (maxy - miny))
+    logger.info("Plan de consulta: %d cajas, área consultada %.6f grados cuadrados frente a %.6f del bbox global (%.1f%%)",
+                len(boxes), total_area, global_area, (total_area / global_area * 100) if global_area else 100)
+    return sorted(boxes)
+
+# Función para eliminar características repetidas entre consultas o teselas vecinas
+def deduplicate_features(gdf):
+    if 'id' in gdf.columns:
+        return gdf.drop_duplicates(subset='id').reset_index(drop=True)
+    wkb = pd.Series(shapely.to_wkb(gdf.geometry.values), index=gdf.index)
+    return gdf[~wkb.duplicated()].reset_index(drop=True)
+
+# Función para ordenar las características de una capa por id, de modo que el orden (y el de los registros de
+# intersección de cada polígono) no dependa de cómo se dividió la descarga ni de la caché de teselas
+def sort_features(gdf):
+    if 'id' not in gdf.columns or gdf['id'].is_monotonic_increasing:
+        return gdf
+    return gdf.sort_values('id', kind='stable').reset_index(drop=True)
+
+# Función para unir las partes descargadas de una misma capa sin duplicados, ordenadas por id
+def merge_layer_parts(parts, crs):
+    parts = [part for part in parts if not part.empty]
+    if not parts:
+        return gpd.GeoDataFrame({'id': []}, geometry=[], crs=crs)
+    if len(parts) == 1:
+        return sort_features(parts[0])
+    merged = sort_features(deduplicate_features(pd.concat(parts, ignore_index=True)))
+    return merged.set_crs(crs, allow_override=True)
+
+# Función para construir por lotes las geometrías Polygon y MultiPolygon a partir de sus coordenadas GeoJSON
+def polygons_from_geojson(geometries):
+    result = np.empty(len(geometries), dtype=object)
+    for geometry_type, depth in (('Polygon', 1), ('MultiPolygon', 2)):
+        positions = [k for k, geometry in enumerate(geometries) if geometry['type'] == geometry_type]
+        if not positions:
+            continue
+        coords = []
+        offsets = [[0] for _ in range(depth + 1)]
+        for k in positions:
+            parts = geometries[k]['coordinates'] if depth == 2 else [geometries[k]['coordinates']]
+            for polygon in parts:
+                for ring in polygon:
+                    coords.extend(ring)
+                    offsets[0].append(len(coords))
+                offsets[1].append(len(offsets[0]) - 1)
+            if depth == 2:
+                offsets[2].append(len(offsets[1]) - 1)
+        try:
+            result[positions] = shapely.from_ragged_array(
+                shapely.GeometryType.POLYGON if depth == 1 else shapely.GeometryType.MULTIPOLYGON,
+                np.asarray(coords, dtype=float).reshape(-1, len(coords[0]) if coords else 2),
+                tuple(np.asarray(offset, dtype=np.int64) for offset in offsets)
+            )
+        except (ValueError, TypeError, IndexError):
+            # Coordenadas con dimensiones mezcladas: se construyen una por una
+            result[positions] = [shape(geometries[k]) for k in positions]
+    return result
+
+# Función para construir el GeoDataFrame de polígonos a partir de un FeatureCollection ya decodificado.
+# Solo se conservan los Polygon/MultiPolygon con topología válida (o reparada con repair=True);
+# el reporte de validación queda en gdf.attrs['validation'].
+def load_geojson_features(geojson_dict, repair=False):
+    features = geojson_dict["features"]
+    supported = [k for k, feature in enumerate(features) if feature["geometry"]["type"] in ('Polygon', 'MultiPolygon')]
+    if len(supported) < len(features):
+        logger.warning("Tipo de geometría no soportado en %d features; se omiten.", len(features) - len(supported))
+    geometries = polygons_from_geojson([features[k]["geometry"] for k in supported])
+    geometries, valid, report = check_topology_bulk(geometries, repair=repair, positions=supported)
+    geometries = geometries[valid]
+
+    predio_ids = []
+    subpoligono_ids = []
+    for k in np.asarray(supported, dtype=np.int64)[valid]:
+        properties = features[k]["properties"]
+        predio_id = properties.get("predio_id", "Desconocido")
+        subpoligono_id = properties.get("poligono", None)
+        if subpoligono_id is None:
+            subpoligono_id = f"{predio_id}_subpoligono_{len(predio_ids)+1}"
+        predio_ids.append(predio_id)
+        subpoligono_ids.append(subpoligono_id)
+
+    gdf = gpd.GeoDataFrame({"geometry": geometries, "predio_id": predio_ids, "subpoligono_id": subpoligono_ids}, crs='EPSG:4326')
+    gdf['id'] = range(1, len(gdf) + 1)
+    gdf.attrs['validation'] = {'features': len(features), 'unsupported': len(features) - len(supported), **report}
+    return gdf
+
+# Función para cargar GeoJSON desde un texto
 def load_geojson_from_text(geojson_text):
     try:
         geojson_dict = json.loads(geojson_text)
-        geometries = []
-        predio_ids = []
-        subpoligono_ids = []
-
-        for feature in geojson_dict["features"]:
-            geom = shape(feature["geometry"])
-            predio_id = feature["properties"].get("predio_id", "Desconocido")
-            subpoligono_id = feature["properties"].get("poligono", None)
-            
-            if subpoligono_id is None:
-                subpoligono_id = f"{predio_id}_subpoligono_{len(geometries)+1}"
-                feature["properties"]["poligono"] = subpoligono_id
-
-            if isinstance(geom, (Polygon, MultiPolygon)):
-                geometries.append(geom)
-                predio_ids.append(predio_id)
-                subpoligono_ids.append(subpoligono_id)
-            else:
-                geometries.extend([g for g in geom if isinstance(g, (Polygon, MultiPolygon))])
-                predio_ids.append(predio_id)
-                subpoligono_ids.append(subpoligono_id)
-
-        gdf = gpd.GeoDataFrame({"geometry": geometries, "predio_id": predio_ids, "subpoligono_id": subpoligono_ids})
-        gdf.crs = 'EPSG:4326'
-        
-        if 'id' not in gdf.columns:
-            gdf['id'] = range(1, len(gdf) + 1)
-        
-        return gdf
     except json.JSONDecodeError as e:
         print(f"Error al decodificar JSON: {e}")
         raise ValueError("El texto GeoJSON no es válido")
+    return load_geojson_features(geojson_dict)
 
 # Función para asegurar que todas las capas tienen el mismo CRS
 def ensure_same_crs(gdf, crs):
@@ -69,7 +349,173 @@ def ensure_same_crs(gdf, crs):
     return gdf
 
 # Función para realizar el cruce espacial y calcular el área de intersección
-def calculate_intersections(polygons_gdf, layer, layer_name, fields, tipo_ordenamiento=None):
+def calculate_intersections(polygons_gdf, layer, layer_name, fields, tipo_ordenamiento=None, engine='strtree', fast_paths=True):
+    if engine == 'loop':
+        return calculate_intersections_loop(polygons_gdf, layer, layer_name, fields, tipo_ordenamiento)
+    if engine != 'strtree':
+        raise ValueError(f"Motor de intersección no soportado: {engine}")
+
+    logger.debug("Procesando intersecciones con la capa: %s", layer_name)
+    pairs = intersection_pairs(polygons_gdf, layer, fast_paths=fast_paths)
+    return intersection_records(polygons_gdf, layer, pairs, layer_name, fields, tipo_ordenamiento)
+
+# Función para obtener los pares (polígono, característica) que se intersecan, ordenados por posición,
+# con el área de cada intersección en grados cuadrados y en m². Con fast_paths=True las características
+# candidatas se preparan (una sola vez por geometría), los predios contenidos en una característica usan su
+# propia área sin calcular la intersección, y las características con más de SUBDIVIDE_VERTICES vértices
+# se cruzan por partes (subdivide_geometry) en lugar de completas; su área es la suma de las áreas por parte.
+def intersection_pairs(polygons_gdf, layer, fast_paths=True):
+    if polygons_gdf.empty or layer.empty:
+        empty = np.array([], dtype=np.intp)
+        return empty, empty, np.array([]), np.array([])
+
+    polygons = polygons_gdf.geometry.values
+    features = layer.geometry.values
+    if not fast_paths:
+        # Filtrado de candidatos con el índice espacial (STRtree) de la capa
+        poly_pos, feature_pos = layer.sindex.query(polygons, predicate='intersects')
+        order = np.lexsort((feature_pos, poly_pos))
+        poly_pos, feature_pos = poly_pos[order], feature_pos[order]
+
+        # Intersección y área por lotes sobre los pares candidatos
+        intersections = shapely.intersection(polygons[poly_pos], features[feature_pos])
+        non_empty = ~shapely.is_empty(intersections)
+        poly_pos, feature_pos = poly_pos[non_empty], feature_pos[non_empty]
+        areas = shapely.area(intersections[non_empty])
+        areas_m2 = area_m2(intersections[non_empty])
+        return poly_pos, feature_pos, areas, areas_m2
+
+    # Candidatos por bbox; el predicado se evalúa con la característica preparada
+    poly_pos, feature_pos = layer.sindex.query(polygons)
+    order = np.lexsort((feature_pos, poly_pos))
+    poly_pos, feature_pos = poly_pos[order], feature_pos[order]
+    shapely.prepare(features[np.unique(feature_pos)])
+    hits = shapely.intersects(features[feature_pos], polygons[poly_pos])
+    poly_pos, feature_pos = poly_pos[hits], feature_pos[hits]
+
+    # Predios cubiertos por completo: la intersección es el propio predio
+    covered = shapely.covers(features[feature_pos], polygons[poly_pos])
+    areas = np.empty(len(poly_pos))
+    areas_m2 = np.empty(len(poly_pos))
+    if covered.any():
+        covered_polygons = np.unique(poly_pos[covered])
+        polygon_areas = np.zeros(len(polygons))
+        polygon_areas_m2 = np.zeros(len(polygons))
+        polygon_areas[covered_polygons] = shapely.area(polygons[covered_polygons])
+        polygon_areas_m2[covered_polygons] = area_m2(polygons[covered_polygons])
+        areas[covered] = polygon_areas[poly_pos[covered]]
+        areas_m2[covered] = polygon_areas_m2[poly_pos[covered]]
+
+    # Cruce con la característica completa, o por partes si es demasiado grande
+    partial = np.flatnonzero(~covered)
+    giant = shapely.get_num_coordinates(features[feature_pos[partial]]) > SUBDIVIDE_VERTICES
+    whole = partial[~giant]
+    if len(whole):
+        intersections = shapely.intersection(polygons[poly_pos[whole]], features[feature_pos[whole]])
+        areas[whole] = shapely.area(intersections)
+        areas_m2[whole] = area_m2(intersections)
+    if giant.any():
+        by_parts = partial[giant]
+        areas[by_parts], areas_m2[by_parts] = _intersect_by_parts(polygons, features, poly_pos[by_parts], feature_pos[by_parts])
+    return poly_pos, feature_pos, areas, areas_m2
+
+# Función para dividir una geometría en partes con a lo más max_vertices vértices, partiendo su bbox en
+# cuadrantes de forma recursiva. Las partes no se traslapan, así que la intersección con la geometría
+# es la unión de las intersecciones con las partes. Las particiones se conservan mientras viva la geometría.
+def subdivide_geometry(geometry, max_vertices=None, max_depth=12):
+    max_vertices = max_vertices or SUBDIVIDE_VERTICES
+    key = (id(geometry), max_vertices)
+    with _subdivisions_lock:
+        entry = _subdivisions.get(key)
+        if entry is not None and entry[0]() is geometry:
+            return entry[1]
+
+    # Cada parte se acompaña del rectángulo con el que se recortó
+    pieces = np.array([geometry], dtype=object)
+    rects = np.array([shapely.bounds(geometry)])
+    done, done_rects = [], []
+    for _ in range(max_depth):
+        large = shapely.get_num_coordinates(pieces) > max_vertices
+        done.append(pieces[~large])
+        done_rects.append(rects[~large])
+        pieces, rects = pieces[large], rects[large]
+        if not len(pieces):
+            break
+        minx, miny, maxx, maxy = rects.T
+        midx, midy = (minx + maxx) / 2, (miny + maxy) / 2
+        rects = np.concatenate([np.c_[minx, miny, midx, midy], np.c_[midx, miny, maxx, midy], np.c_[minx, midy, midx, maxy], np.c_[midx, midy, maxx, maxy]])
+        # Recorte rápido por rectángulo (clip_by_rect), que no garantiza partes válidas; se verifica al final
+        pieces = np.array([shapely.clip_by_rect(piece, *rect) for piece, rect in zip(np.concatenate([pieces] * 4), rects)], dtype=object)
+        keep = ~shapely.is_empty(pieces) & (shapely.area(pieces) > 0)
+        pieces, rects = pieces[keep], rects[keep]
+    done.append(pieces)
+    done_rects.append(rects)
+    pieces, rects = np.concatenate(done), np.concatenate(done_rects)
+    # Las partes inválidas se recalculan con la intersección exacta de la geometría original con su rectángulo
+    invalid = ~shapely.is_valid(pieces)
+    if invalid.any():
+        pieces[invalid] = shapely.intersection(geometry, shapely.box(*rects[invalid].T))
+    shapely.prepare(pieces)
+    tree = shapely.STRtree(pieces)
+
+    def release(_, key=key):
+        with _subdivisions_lock:
+            _subdivisions.pop(key, None)
+
+    with _subdivisions_lock:
+        _subdivisions[key] = (weakref.ref(geometry, release), (pieces, tree))
+    return pieces, tree
+
+# Función para calcular el área de intersección de cada par (polígono, característica grande) como la suma
+# de las áreas de sus intersecciones con las partes de la característica que toca
+def _intersect_by_parts(polygons, features, poly_pos, feature_pos):
+    areas = np.zeros(len(poly_pos))
+    areas_m2 = np.zeros(len(poly_pos))
+    for feature in np.unique(feature_pos):
+        positions = np.flatnonzero(feature_pos == feature)
+        pieces, tree = subdivide_geometry(features[feature])
+        pair_idx, piece_idx = tree.query(polygons[poly_pos[positions]], predicate='intersects')
+        parts = shapely.intersection(polygons[poly_pos[positions[pair_idx]]], pieces[piece_idx])
+        areas[positions] = np.bincount(pair_idx, weights=shapely.area(parts), minlength=len(positions))
+        areas_m2[positions] = np.bincount(pair_idx, weights=area_m2(parts), minlength=len(positions))
+    return areas, areas_m2
+
+# Función para construir los registros de intersección a partir de los pares calculados
+def intersection_records(polygons_gdf, layer, pairs, layer_name, fields, tipo_ordenamiento=None):
+    poly_pos, feature_pos, areas, areas_m2 = pairs
+    results = []
+    log_records = intersection_logger.isEnabledFor(logging.DEBUG)
+    if len(poly_pos) == 0:
+        return results
+
+    polygons = polygons_gdf[['id', 'predio_id', 'subpoligono_id']].iloc[poly_pos].to_dict('records')
+    feature_ids = layer['id'].iloc[feature_pos].tolist()
+    # Los campos que no existen en la capa quedan como 'Desconocido'; sin ningún campo presente, to_dict
+    # devolvería una lista vacía y zip descartaría todas las intersecciones
+    present_fields = [field for field in fields if field in layer.columns]
+    attributes = layer[present_fields].iloc[feature_pos].to_dict('records') if present_fields else [{}] * len(feature_pos)
+
+    for polygon, feature_id, feature_attrs, area, intersection_m2 in zip(polygons, feature_ids, attributes, areas.tolist(), areas_m2.tolist()):
+        record = {
+            'Polygon_ID': polygon['id'],
+            'Predio_ID': polygon['predio_id'],
+            'Subpoligono_ID': polygon['subpoligono_id'],
+            'Layer': layer_name,
+            'Feature_ID': feature_id,
+            'Intersection_Area_Degrees': area,
+            'Intersection_Area_M2': intersection_m2
+        }
+        if tipo_ordenamiento:
+            record['Tipo'] = tipo_ordenamiento
+        for field in fields:
+            record[field] = feature_attrs.get(field, 'Desconocido')
+        results.append(record)
+        if log_records:
+            intersection_logger.debug("interseccion polygon_id=%s layer=%s feature_id=%s area_deg=%.6f area_m2=%.2f", polygon['id'], layer_name, feature_id, area, intersection_m2)
+    return results
+
+# Función original de cruce fila por fila, se conserva como referencia para comparaciones
+def calculate_intersections_loop(polygons_gdf, layer, layer_name, fields, tipo_ordenamiento=None):
     results = []
     print(f"Procesando intersecciones con la capa: {layer_name}")
     for poly_index, polygon in polygons_gdf.iterrows():
@@ -80,8 +526,7 @@ def calculate_intersections(polygons_gdf, layer, layer_name, fields, tipo_ordena
                 intersection = poly_geom.intersection(feature_geom)
                 if not intersection.is_empty:
                     area = intersection.area
-                    # Estimación en metros cuadrados
-                    area_m2 = area * 12321000000  # Estimación basada en un grado cuadrado en el ecuador
+                    intersection_m2 = float(area_m2([intersection])[0])
                     record = {
                         'Polygon_ID': polygon['id'],
                         'Predio_ID': polygon['predio_id'],
@@ -89,18 +534,168 @@ def calculate_intersections(polygons_gdf, layer, layer_name, fields, tipo_ordena
                         'Layer': layer_name,
                         'Feature_ID': feature['id'],
                         'Intersection_Area_Degrees': area,
-                        'Intersection_Area_M2': f"{area_m2:.2f} m² (estimado)"
+                        'Intersection_Area_M2': intersection_m2
                     }
                     if tipo_ordenamiento:
                         record['Tipo'] = tipo_ordenamiento
                     for field in fields:
                         record[field] = feature.get(field, 'Desconocido')
                     results.append(record)
-                    print(f"Intersección encontrada: Polígono ID {polygon['id']} con {layer_name}, Área: {area:.6f} grados cuadrados ≈ {area_m2:.2f} m² (estimado)")
+                    intersection_logger.debug("interseccion polygon_id=%s layer=%s feature_id=%s area_deg=%.6f area_m2=%.2f", polygon['id'], layer_name, feature['id'], area, intersection_m2)
     return results
 
-# Función para detectar superposiciones
-def detect_overlaps(polygons_gdf):
+# Función para cruzar una capa WFS página por página; cada página se cruza y se libera antes de pedir la siguiente.
+# layers es una lista de (layer_name, fields, tipo_ordenamiento) que comparten la misma capa remota; las
+# características repetidas entre cajas de consulta se cruzan una sola vez. Devuelve los registros de cada capa
+# y el costo: características recibidas, segundos de descarga y segundos de cruce de cada capa.
+def stream_intersections(polygons_gdf, wfs_url, wfs_layer_name, bboxes, crs, layers, page_size=None):
+    results = [[] for _ in layers]
+    cost = {'features': 0, 'fetch_seconds': 0.0, 'intersect_seconds': [0.0] * len(layers)}
+    pages = 0
+    seen_ids = set()
+    for bbox in bboxes:
+        page_iter = iter_wfs_pages(wfs_url, wfs_layer_name, bbox, crs, page_size)
+        while True:
+            start = time.perf_counter()
+            page = next(page_iter, None)
+            cost['fetch_seconds'] += time.perf_counter() - start
+            if page is None:
+                break
+            pages += 1
+            page = ensure_same_crs(page, crs)
+            if len(bboxes) > 1 and 'id' in page.columns:
+                page = page[~page['id'].isin(seen_ids)]
+                seen_ids.update(page['id'])
+            cost['features'] += len(page)
+            for k, (records, (layer_name, fields, tipo_ordenamiento)) in enumerate(zip(results, layers)):
+                start = time.perf_counter()
+                records.extend(calculate_intersections(polygons_gdf, page, layer_name, fields, tipo_ordenamiento))
+                cost['intersect_seconds'][k] += time.perf_counter() - start
+    logger.info("Procesadas %d páginas de %s", pages, wfs_layer_name)
+    # El cruce sobre la capa completa (ordenada por id, merge_layer_parts) da los registros por polígono y id de
+    # la característica; las páginas llegan en el orden del servidor, así que se reordenan con la misma clave
+    for records in results:
+        records.sort(key=lambda record: (record['Polygon_ID'], record['Feature_ID']))
+    return results, cost
+
+# Función para cruzar varias capas en modo streaming y en paralelo; las capas remotas repetidas se recorren una sola vez.
+# layer_requests es un diccionario clave -> (wfs_url, wfs_layer_name, layer_name, fields, tipo_ordenamiento).
+# Devuelve clave -> registros y clave -> costo (features, fetch_seconds e intersect_seconds)
+def stream_layer_intersections(polygons_gdf, layer_requests, bboxes, crs, page_size=None):
+    groups = {}
+    for key, (wfs_url, wfs_layer_name, layer_name, fields, tipo_ordenamiento) in layer_requests.items():
+        group = groups.setdefault((wfs_url, wfs_layer_name), {'keys': [], 'layers': []})
+        group['keys'].append(key)
+        group['layers'].append((layer_name, fields, tipo_ordenamiento))
+
+    pool = _get_fetch_pool()
+    futures = {
+        source: pool.submit(stream_intersections, polygons_gdf, source[0], source[1], bboxes, crs, group['layers'], page_size)
+        for source, group in groups.items()
+    }
+    intersections = {}
+    costs = {}
+    for source, group in groups.items():
+        results, cost = futures[source].result()
+        for k, (key, records) in enumerate(zip(group['keys'], results)):
+            intersections[key] = records
+            costs[key] = {'features': cost['features'], 'fetch_seconds': cost['fetch_seconds'], 'intersect_seconds': cost['intersect_seconds'][k]}
+    return intersections, costs
+
+# Función para detectar superposiciones; con positions solo se calculan los pares que incluyen esos polígonos
+def detect_overlaps(polygons_gdf, engine='strtree', clusters=False, positions=None):
+    if engine == 'loop':
+        overlaps = detect_overlaps_loop(polygons_gdf)
+    elif engine == 'strtree':
+        overlaps = []
+        if len(polygons_gdf) > 1:
+            if positions is None:
+                # Autocruce con el índice espacial, conservando solo los pares i < j
+                left, right = polygons_gdf.sindex.query(polygons_gdf.geometry.values, predicate='intersects')
+                upper = left < right
+                left, right = left[upper], right[upper]
+            else:
+                # Solo los pares en los que participa alguno de los polígonos en positions
+                positions = np.asarray(positions, dtype=np.intp)
+                k, other = polygons_gdf.sindex.query(polygons_gdf.geometry.values[positions], predicate='intersects')
+                pairs = np.unique(np.sort(np.c_[positions[k], other], axis=1), axis=0).reshape(-1, 2)
+                pairs = pairs[pairs[:, 0] < pairs[:, 1]]
+                left, right = pairs[:, 0], pairs[:, 1]
+            order = np.lexsort((right, left))
+            left, right = left[order], right[order]
+
+            intersections = shapely.intersection(polygons_gdf.geometry.values[left], polygons_gdf.geometry.values[right])
+            non_empty = ~shapely.is_empty(intersections)
+            left, right = left[non_empty], right[non_empty]
+            areas = shapely.area(intersections[non_empty])
+            areas_m2 = area_m2(intersections[non_empty])
+
+            attributes = polygons_gdf[['id', 'predio_id', 'subpoligono_id']]
+            polys1 = attributes.iloc[left].to_dict('records')
+            polys2 = attributes.iloc[right].to_dict('records')
+            for poly1, poly2, area, overlap_m2 in zip(polys1, polys2, areas.tolist(), areas_m2.tolist()):
+                overlaps.append({
+                    'Polygon1_ID': poly1['id'],
+                    'Polygon1_Predio_ID': poly1['predio_id'],
+                    'Polygon1_Subpoligono_ID': poly1['subpoligono_id'],
+                    'Polygon2_ID': poly2['id'],
+                    'Polygon2_Predio_ID': poly2['predio_id'],
+                    'Polygon2_Subpoligono_ID': poly2['subpoligono_id'],
+                    'Overlap_Area_Degrees': area,
+                    'Overlap_Area_M2': overlap_m2
+                })
+    else:
+        raise ValueError(f"Motor de superposición no soportado: {engine}")
+
+    if clusters:
+        return overlap_clusters(overlaps)
+    return overlaps
+
+# Función para agrupar las superposiciones en componentes conexas, resumidas por predio
+def overlap_clusters(overlaps):
+    parent = {}
+
+    def find(node):
+        parent.setdefault(node, node)
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    for overlap in overlaps:
+        root1, root2 = find(overlap['Polygon1_ID']), find(overlap['Polygon2_ID'])
+        if root1 != root2:
+            parent[max(root1, root2)] = min(root1, root2)
+
+    members = {}
+    for overlap in overlaps:
+        cluster = members.setdefault(find(overlap['Polygon1_ID']), {'polygons': {}, 'area': 0.0, 'area_m2': 0.0, 'pairs': 0})
+        cluster['polygons'][overlap['Polygon1_ID']] = (overlap['Polygon1_Predio_ID'], overlap['Polygon1_Subpoligono_ID'])
+        cluster['polygons'][overlap['Polygon2_ID']] = (overlap['Polygon2_Predio_ID'], overlap['Polygon2_Subpoligono_ID'])
+        cluster['area'] += overlap['Overlap_Area_Degrees']
+        cluster['area_m2'] += overlap['Overlap_Area_M2']
+        cluster['pairs'] += 1
+
+    clusters = []
+    for cluster_id, root in enumerate(sorted(members), start=1):
+        cluster = members[root]
+        polygon_ids = sorted(cluster['polygons'])
+        predios = {}
+        for polygon_id in polygon_ids:
+            predio_id, subpoligono_id = cluster['polygons'][polygon_id]
+            predios.setdefault(predio_id, []).append(subpoligono_id)
+        clusters.append({
+            'Cluster_ID': cluster_id,
+            'Predios': predios,
+            'Polygon_IDs': polygon_ids,
+            'Overlap_Pairs': cluster['pairs'],
+            'Overlap_Area_Degrees': cluster['area'],
+            'Overlap_Area_M2': cluster['area_m2']
+        })
+    return clusters
+
+# Función original de superposiciones por pares, se conserva como referencia para comparaciones
+def detect_overlaps_loop(polygons_gdf):
     overlaps = []
     for i, poly1 in polygons_gdf.iterrows():
         for j, poly2 in polygons_gdf.iterrows():
@@ -118,7 +713,7 @@ def detect_overlaps(polygons_gdf):
                         'Polygon2_Predio_ID': poly2['predio_id'],
                         'Polygon2_Subpoligono_ID': poly2['subpoligono_id'],
                         'Overlap_Area_Degrees': area,
-                        'Overlap_Area_M2': f"{area * 12321000000:.2f} m² (estimado)"
+                        'Overlap_Area_M2': float(area_m2([intersection])[0])
                     })
     return overlaps
 
@@ -127,252 +722,16 @@ def save_json(data, filename):
     with open(filename, 'w') as f:
         json.dump(data, f, indent=4)
 
-# Función para sanitizar el texto
-def sanitize_text(text):
-    return text.encode('latin-1', 'replace').decode('latin-1')
-
 # Función para generar y guardar la imagen del mapa
+# Se usa una Figure independiente (sin el estado global de pyplot) con el lienzo Agg explícito, para poder generar
+# mapas desde varios hilos y sin pantalla. matplotlib se importa en el primer mapa y no al importar el módulo.
 def generate_map_image(polygons_gdf, output_image):
-    plt.figure(figsize=(10, 8))
-    ax = polygons_gdf.plot(column='id', cmap='tab20', legend=True)
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure(figsize=(10, 8))
+    FigureCanvasAgg(fig)
+    ax = fig.subplots()
+    polygons_gdf.plot(ax=ax, column='id', cmap='tab20', legend=True)
     ax.set_title('Mapa de Polígonos')
-    plt.axis('equal')
-    plt.savefig(output_image)
-    plt.close()
-
-# Clase personalizada para el PDF
-class PDF(FPDF):
-    def header(self):
-        self.set_font('Arial', 'B', 12)
-        self.cell(0, 10, 'Reporte de Polígonos GeoJSON y Cruce Espacial', 0, 1, 'C')
-
-    def footer(self):
-        self.set_y(-15)
-        self.set_font('Arial', 'I', 8)
-        self.cell(0, 10, f'Página {self.page_no()}', 0, 0, 'C')
-
-# Función para generar el PDF
-def generate_pdf(polygons_gdf, output_pdf, output_image, intersections_uso_suelo, intersections_federales, intersections_estatales, intersections_municipales, intersections_locales, intersections_regionales, overlaps):
-    pdf = PDF()
-    pdf.set_auto_page_break(auto=True, margin=10)
-    pdf.set_font("Arial", size=10)
-
-    # Verificar si el archivo de imagen existe antes de agregarlo
-    if os.path.exists(output_image):
-        pdf.add_page()
-        pdf.image(output_image, x=10, y=20, w=180)
-        pdf.add_page()
-    else:
-        print(f"Error: El archivo de imagen '{output_image}' no se encontró.")
-
-    predios = polygons_gdf.groupby('predio_id')
-
-    for predio_id, predio_df in predios:
-        pdf.add_page()
-        pdf.set_font("Arial", 'B', 12)
-        pdf.cell(0, 10, f"Predio: {predio_id}", 0, 1, 'C')
-        pdf.ln(5)
-
-        pdf.set_font("Arial", 'B', 10)
-        pdf.cell(0, 10, "Coordenadas del predio:", 0, 1, 'C')
-        pdf.set_font("Arial", size=8)
-
-        predio_geom = predio_df.unary_union
-        if isinstance(predio_geom, Polygon):
-            for coord in predio_geom.exterior.coords:
-                coord_text = f"{coord}"
-                cell_height = 5
-                pdf.multi_cell(0, cell_height, sanitize_text(coord_text), border=1)
-        elif isinstance(predio_geom, MultiPolygon):
-            for poly in predio_geom.geoms:
-                pdf.ln(5)
-                pdf.set_font("Arial", 'I', 10)
-                pdf.cell(0, 10, "Sub-polígono:", ln=True)
-                pdf.set_font("Arial", size=8)
-                for coord in poly.exterior.coords:
-                    coord_text = f"{coord}"
-                    cell_height = 5
-                    pdf.multi_cell(0, cell_height, sanitize_text(coord_text), border=1)
-
-        for i, polygon in predio_df.iterrows():
-            pdf.ln(10)
-            pdf.set_font("Arial", 'B', 12)
-            pdf.cell(0, 10, f"Subpolígono {polygon['subpoligono_id']}", 0, 1, 'C')
-            pdf.ln(5)
-
-            pdf.set_font("Arial", size=10)
-            pdf.cell(50, 10, "Área (grados cuadrados):", border=1)
-            pdf.cell(0, 10, f"{polygon['geometry'].area:.6f}", border=1, ln=True)
-            pdf.cell(50, 10, "Área estimada (m²):", border=1)
-            pdf.cell(0, 10, f"{polygon['geometry'].area * 12321000000:.2f} m² (estimado)", border=1, ln=True)
-            pdf.cell(50, 10, "Perímetro:", border=1)
-            pdf.cell(0, 10, f"{polygon['geometry'].length:.2f} unidades", border=1, ln=True)
-
-            pdf.ln(5)
-            pdf.set_font("Arial", 'B', 10)
-            pdf.cell(0, 10, "Coordenadas del subpolígono:", border=1, ln=True, align='C')
-            pdf.set_font("Arial", size=8)
-
-            geometry = polygon['geometry']
-            if isinstance(geometry, Polygon):
-                for coord in geometry.exterior.coords:
-                    coord_text = f"{coord}"
-                    cell_height = 5
-                    pdf.multi_cell(0, cell_height, sanitize_text(coord_text), border=1)
-            elif isinstance(geometry, MultiPolygon):
-                for poly in geometry.geoms:
-                    pdf.ln(5)
-                    pdf.set_font("Arial", 'I', 10)
-                    pdf.cell(0, 10, "Sub-polígono:", ln=True)
-                    pdf.set_font("Arial", size=8)
-                    for coord in poly.exterior.coords:
-                        coord_text = f"{coord}"
-                        cell_height = 5
-                        pdf.multi_cell(0, cell_height, sanitize_text(coord_text), border=1)
-
-    # Detalles de las intersecciones con Usos de Suelo
-    if intersections_uso_suelo:
-        pdf.add_page()
-        pdf.set_font("Arial", 'B', 12)
-        pdf.cell(0, 10, "Intersecciones con Usos de Suelo", 0, 1, 'C')
-        pdf.ln(5)
-
-        pdf.set_font("Arial", size=10)
-        for intersection in intersections_uso_suelo:
-            if pdf.get_y() > 260:
-                pdf.add_page()
-            pdf.cell(0, 10, f"Polígono ID: {intersection['Polygon_ID']} (Predio: {intersection['Predio_ID']}, Subpolígono: {intersection['Subpoligono_ID']})", ln=True)
-            pdf.cell(0, 10, f"ID de Característica: {intersection['Feature_ID']}", ln=True)
-            pdf.cell(0, 10, f"Área de Intersección (grados cuadrados): {intersection['Intersection_Area_Degrees']:.6f}", ln=True)
-            pdf.cell(0, 10, f"Área de Intersección (m²): {intersection['Intersection_Area_M2']}", ln=True)
-            pdf.cell(0, 10, f"Tipo de Vegetación: {intersection.get('tip_veg', 'N/A')}", ln=True)
-            pdf.cell(0, 10, f"Descripción de Vegetación: {intersection.get('des_veg', 'N/A')}", ln=True)
-            pdf.ln(5)
-
-    # Detalles de las intersecciones con ANP Federales
-    if intersections_federales:
-        pdf.add_page()
-        pdf.set_font("Arial", 'B', 12)
-        pdf.cell(0, 10, "Intersecciones con ANP Federales", 0, 1, 'C')
-        pdf.ln(5)
-
-        pdf.set_font("Arial", size=10)
-        for intersection in intersections_federales:
-            if pdf.get_y() > 260:
-                pdf.add_page()
-            pdf.cell(0, 10, f"Polígono ID: {intersection['Polygon_ID']} (Predio: {intersection['Predio_ID']}, Subpolígono: {intersection['Subpoligono_ID']})", ln=True)
-            pdf.cell(0, 10, f"ID de Característica: {intersection['Feature_ID']}", ln=True)
-            pdf.cell(0, 10, f"Área de Intersección (grados cuadrados): {intersection['Intersection_Area_Degrees']:.6f}", ln=True)
-            pdf.cell(0, 10, f"Área de Intersección (m²): {intersection['Intersection_Area_M2']}", ln=True)
-            pdf.cell(0, 10, f"ID_ANP: {intersection.get('id_anp', 'N/A')}", ln=True)
-            pdf.cell(0, 10, f"Nombre del ANP: {intersection.get('nombre', 'N/A')}", ln=True)
-            pdf.cell(0, 10, f"Categoría de Manejo: {intersection.get('cat_manejo', 'N/A')}", ln=True)
-            pdf.cell(0, 10, f"Superficie del ANP: {intersection.get('superficie', 'N/A')}", ln=True)
-            pdf.cell(0, 10, f"Región: {intersection.get('region', 'N/A')}", ln=True)
-            pdf.ln(5)
-
-    # Detalles de las intersecciones con ANP Estatales
-    if intersections_estatales:
-        pdf.add_page()
-        pdf.set_font("Arial", 'B', 12)
-        pdf.cell(0, 10, "Intersecciones con ANP Estatales", 0, 1, 'C')
-        pdf.ln(5)
-
-        pdf.set_font("Arial", size=10)
-        for intersection in intersections_estatales:
-            if pdf.get_y() > 260:
-                pdf.add_page()
-            pdf.cell(0, 10, f"Polígono ID: {intersection['Polygon_ID']} (Predio: {intersection['Predio_ID']}, Subpolígono: {intersection['Subpoligono_ID']})", ln=True)
-            pdf.cell(0, 10, f"ID de Característica: {intersection['Feature_ID']}", ln=True)
-            pdf.cell(0, 10, f"Área de Intersección (grados cuadrados): {intersection['Intersection_Area_Degrees']:.6f}", ln=True)
-            pdf.cell(0, 10, f"Área de Intersección (m²): {intersection['Intersection_Area_M2']}", ln=True)
-            pdf.cell(0, 10, f"Nombre del ANP: {intersection.get('nombre', 'N/A')}", ln=True)
-            pdf.cell(0, 10, f"Entidad: {intersection.get('entidad', 'N/A')}", ln=True)
-            pdf.cell(0, 10, f"Municipio: {intersection.get('mun_dec', 'N/A')}", ln=True)
-            pdf.cell(0, 10, f"Área: {intersection.get('area', 'N/A')}", ln=True)
-            pdf.cell(0, 10, f"Enlace: {intersection.get('enlace_dec', 'N/A')}", ln=True)
-            pdf.ln(5)
-
-    # Detalles de las intersecciones con ANP Municipales
-    if intersections_municipales:
-        pdf.add_page()
-        pdf.set_font("Arial", 'B', 12)
-        pdf.cell(0, 10, "Intersecciones con ANP Municipales", 0, 1, 'C')
-        pdf.ln(5)
-
-        pdf.set_font("Arial", size=10)
-        for intersection in intersections_municipales:
-            if pdf.get_y() > 260:
-                pdf.add_page()
-            pdf.cell(0, 10, f"Polígono ID: {intersection['Polygon_ID']} (Predio: {intersection['Predio_ID']}, Subpolígono: {intersection['Subpoligono_ID']})", ln=True)
-            pdf.cell(0, 10, f"ID de Característica: {intersection['Feature_ID']}", ln=True)
-            pdf.cell(0, 10, f"Área de Intersección (grados cuadrados): {intersection['Intersection_Area_Degrees']:.6f}", ln=True)
-            pdf.cell(0, 10, f"Área de Intersección (m²): {intersection['Intersection_Area_M2']}", ln=True)
-            pdf.cell(0, 10, f"Nombre del ANP: {intersection.get('nombre', 'N/A')}", ln=True)
-            pdf.cell(0, 10, f"Entidad: {intersection.get('entidad', 'N/A')}", ln=True)
-            pdf.cell(0, 10, f"Municipio: {intersection.get('mun_dec', 'N/A')}", ln=True)
-            pdf.cell(0, 10, f"Área: {intersection.get('area', 'N/A')}", ln=True)
-            pdf.cell(0, 10, f"Enlace: {intersection.get('enlace_dec', 'N/A')}", ln=True)
-            pdf.ln(5)
-
-    # Detalles de las intersecciones con Ordenamientos Locales
-    if intersections_locales:
-        pdf.add_page()
-        pdf.set_font("Arial", 'B', 12)
-        pdf.cell(0, 10, "Intersecciones con Ordenamientos Locales", 0, 1, 'C')
-        pdf.ln(5)
-
-        pdf.set_font("Arial", size=10)
-        for intersection in intersections_locales:
-            if pdf.get_y() > 260:
-                pdf.add_page()
-            pdf.cell(0, 10, f"Polígono ID: {intersection['Polygon_ID']} (Predio: {intersection['Predio_ID']}, Subpolígono: {intersection['Subpoligono_ID']})", ln=True)
-            pdf.cell(0, 10, f"ID de Característica: {intersection['Feature_ID']}", ln=True)
-            pdf.cell(0, 10, f"Área de Intersección (grados cuadrados): {intersection['Intersection_Area_Degrees']:.6f}", ln=True)
-            pdf.cell(0, 10, f"Área de Intersección (m²): {intersection['Intersection_Area_M2']}", ln=True)
-            pdf.cell(0, 10, f"Nombre del Municipio: {intersection.get('nom_mun', 'N/A')}", ln=True)
-            pdf.cell(0, 10, f"Ordenamiento: {intersection.get('ordenamine', 'N/A')}", ln=True)
-            pdf.cell(0, 10, f"Situación: {intersection.get('situacion', 'N/A')}", ln=True)
-            pdf.cell(0, 10, f"Decreto: {intersection.get('decreto', 'N/A')}", ln=True)
-            pdf.cell(0, 10, f"Convenio: {intersection.get('concenio', 'N/A')}", ln=True)
-            pdf.ln(5)
-
-    # Detalles de las intersecciones con Ordenamientos Regionales
-    if intersections_regionales:
-        pdf.add_page()
-        pdf.set_font("Arial", 'B', 12)
-        pdf.cell(0, 10, "Intersecciones con Ordenamientos Regionales", 0, 1, 'C')
-        pdf.ln(5)
-
-        pdf.set_font("Arial", size=10)
-        for intersection in intersections_regionales:
-            if pdf.get_y() > 260:
-                pdf.add_page()
-            pdf.cell(0, 10, f"Polígono ID: {intersection['Polygon_ID']} (Predio: {intersection['Predio_ID']}, Subpolígono: {intersection['Subpoligono_ID']})", ln=True)
-            pdf.cell(0, 10, f"ID de Característica: {intersection['Feature_ID']}", ln=True)
-            pdf.cell(0, 10, f"Área de Intersección (grados cuadrados): {intersection['Intersection_Area_Degrees']:.6f}", ln=True)
-            pdf.cell(0, 10, f"Área de Intersección (m²): {intersection['Intersection_Area_M2']}", ln=True)
-            pdf.cell(0, 10, f"Nombre de la Entidad: {intersection.get('nom_ent', 'N/A')}", ln=True)
-            pdf.cell(0, 10, f"Situación: {intersection.get('situacion', 'N/A')}", ln=True)
-            pdf.cell(0, 10, f"Ordenamiento: {intersection.get('ordenamien', 'N/A')}", ln=True)
-            pdf.cell(0, 10, f"Fecha del Decreto: {intersection.get('f_decreto', 'N/A')}", ln=True)
-            pdf.ln(5)
-
-    # Detalles de las superposiciones
-    if overlaps:
-        pdf.add_page()
-        pdf.set_font("Arial", 'B', 12)
-        pdf.cell(0, 10, "Superposiciones entre Polígonos", 0, 1, 'C')
-        pdf.ln(5)
-
-        pdf.set_font("Arial", size=10)
-        for overlap in overlaps:
-            if pdf.get_y() > 260:
-                pdf.add_page()
-            pdf.cell(0, 10, f"Polígono 1 ID: {overlap['Polygon1_ID']} (Predio: {overlap['Polygon1_Predio_ID']}, Subpolígono: {overlap['Polygon1_Subpoligono_ID']})", ln=True)
-            pdf.cell(0, 10, f"Polígono 2 ID: {overlap['Polygon2_ID']} (Predio: {overlap['Polygon2_Predio_ID']}, Subpolígono: {overlap['Polygon2_Subpoligono_ID']})", ln=True)
-            pdf.cell(0, 10, f"Área de Superposición (grados cuadrados): {overlap['Overlap_Area_Degrees']:.6f}", ln=True)
-            pdf.cell(0, 10, f"Área de Superposición (m²): {overlap['Overlap_Area_M2']}", ln=True)
-            pdf.ln(5)
-
-    pdf.output(output_pdf)
+    ax.axis('equal')
+    fig.savefig(output_image)
@@ -0,0 +1,91 @@
+import gzip
+import importlib.util
+import json
+
+import geopandas as gpd
+import pandas as pd
+
+try:
+    from compression import zstd
+except ImportError:
+    try:
+        import zstandard as zstd
+    except ImportError:
+        zstd = None
+
+# Parquet y GeoParquet requieren pyarrow; solo se comprueba que esté instalado (se importa al escribir)
+PARQUET_AVAILABLE = importlib.util.find_spec("pyarrow") is not None
+
+# Formatos de exportación de los resultados: nombre -> sufijo que reemplaza a ".json" en el archivo.
+# "json" (el archivo original con indentación) se conserva siempre para los consumidores existentes.
+EXPORT_FORMATS = {
+    "json_gz": ".json.gz",
+    "json_zst": ".json.zst",
+    "parquet": ".parquet",
+    "geoparquet": ".geo.parquet",
+}
+
+# Tipo de contenido de cada formato para /download/
+EXPORT_MEDIA_TYPES = {
+    "json_gz": "application/gzip",
+    "json_zst": "application/zstd",
+    "parquet": "application/vnd.apache.parquet",
+    "geoparquet": "application/vnd.apache.parquet",
+}
+
+# Columnas fijas de cada tipo de resultado, para escribir tablas vacías con el mismo esquema
+INTERSECTION_COLUMNS = ['Polygon_ID', 'Predio_ID', 'Subpoligono_ID', 'Layer', 'Feature_ID', 'Intersection_Area_Degrees', 'Intersection_Area_M2']
+OVERLAP_COLUMNS = ['Polygon1_ID', 'Polygon1_Predio_ID', 'Polygon1_Subpoligono_ID', 'Polygon2_ID', 'Polygon2_Predio_ID',
+                   'Polygon2_Subpoligono_ID', 'Overlap_Area_Degrees', 'Overlap_Area_M2']
+
+# Función para saber si un formato se puede escribir en este entorno (json_zst requiere zstandard o Python 3.14;
+# parquet y geoparquet, pyarrow)
+def export_available(export_format):
+    if export_format == "json_zst":
+        return zstd is not None
+    if export_format in ("parquet", "geoparquet"):
+        return PARQUET_AVAILABLE
+    return export_format in EXPORT_FORMATS
+
+# Función para obtener el nombre del archivo exportado a partir del nombre del archivo JSON
+def export_name(json_name, export_format):
+    return json_name[:-len('.json')] + EXPORT_FORMATS[export_format]
+
+# Función para reconocer un archivo exportado: devuelve (nombre del JSON, formato) o None
+def parse_export_name(name):
+    # Los sufijos más largos primero (".geo.parquet" antes que ".parquet")
+    for export_format, suffix in sorted(EXPORT_FORMATS.items(), key=lambda item: -len(item[1])):
+        if name.endswith(suffix):
+            return name[:-len(suffix)] + '.json', export_format
+    return None
+
+# Función para convertir registros en una tabla con identificadores y áreas numéricos; los campos mixtos de
+# las capas se guardan como texto y las columnas con valores repetidos quedan codificadas por diccionario en Parquet
+def records_frame(records, columns):
+    frame = pd.DataFrame.from_records(records) if records else pd.DataFrame(columns=columns)
+    for column in frame.columns:
+        if column in ('Polygon_ID', 'Polygon1_ID', 'Polygon2_ID'):
+            frame[column] = pd.to_numeric(frame[column], errors='coerce').astype('Int64')
+        elif column.endswith(('_Degrees', '_M2')):
+            frame[column] = pd.to_numeric(frame[column], errors='coerce').astype('float64')
+        elif frame[column].dtype == object:
+            frame[column] = frame[column].astype('string')
+    return frame
+
+# Función para escribir registros de resultados en un formato de exportación. geometries (solo para
+# geoparquet) son las geometrías de cada registro, en el mismo orden.
+def write_export(records, path, export_format, columns, geometries=None):
+    if export_format in ("json_gz", "json_zst"):
+        data = json.dumps(records, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+        if export_format == "json_gz":
+            with gzip.open(path, 'wb', compresslevel=6) as f:
+                f.write(data)
+        else:
+            with open(path, 'wb') as f:
+                f.write(zstd.compress(data) if hasattr(zstd, 'compress') else zstd.ZstdCompressor().compress(data))
+    elif export_format == "parquet":
+        records_frame(records, columns).to_parquet(path, compression='zstd', index=False)
+    elif export_format == "geoparquet":
+        gpd.GeoDataFrame(records_frame(records, columns), geometry=list(geometries), crs='EPSG:4326').to_parquet(path, compression='zstd', index=False)
+    else:
+        raise ValueError(f"Formato de exportación no soportado: {export_format}")
@@ -0,0 +1,19 @@
+import gc
+import os
+
+# Despliegue con varios procesos: gunicorn -c gunicorn.conf.py main:app
+# La aplicación se importa y se precalienta una sola vez en el proceso principal; los procesos de trabajo se
+# crean después con fork y comparten esa memoria (capas residentes, pyproj, matplotlib) en copy-on-write.
+# El estado de los trabajos de análisis se guarda en CRUCES_ARTIFACT_DIR (jobs.py), así que GET /jobs/{id} y el
+# límite de la cola funcionan desde cualquier proceso; las métricas de /metrics siguen siendo de cada proceso.
+bind = os.environ.get("CRUCES_BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("CRUCES_WORKERS", "4"))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+
+def on_starting(server):
+    from warmup import warm_up
+    warm_up()
+    # Los objetos creados hasta aquí quedan fuera del recolector de basura, que de otro modo escribiría en
+    # sus páginas y las copiaría en cada proceso de trabajo
+    gc.freeze()
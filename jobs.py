@@ -0,0 +1,233 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Estados posibles de un trabajo
+QUEUED = "en_cola"
+RUNNING = "en_proceso"
+DONE = "terminado"
+FAILED = "error"
+STATES = (QUEUED, RUNNING, DONE, FAILED)
+
+JOB_ID_PATTERN = re.compile(r"[0-9a-f]{32}")
+
+# Excepción cuando la cola de trabajos está llena y no se admiten más solicitudes
+class JobQueueFull(Exception):
+    pass
+
+# Función para saber si un proceso de este equipo sigue vivo
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+# Administrador de trabajos de análisis: un grupo acotado de hilos ejecuta el pipeline fuera del event loop.
+# Con state_dir el estado de cada trabajo se guarda además en <state_dir>/<id>.json (escrito de forma atómica) y
+# cada trabajo tiene un marcador vacío en <state_dir>/<estado>/, de modo que varios procesos de la API (gunicorn)
+# comparten la consulta de trabajos, el límite de admisión y los conteos por estado sin leer todos los archivos.
+# Los marcadores de los trabajos activos llevan el pid del proceso; si ese proceso ya no existe, el trabajo se
+# registra como fallido.
+class JobManager:
+    def __init__(self, max_workers=2, max_queue=8, max_finished=1000, state_dir=None):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.max_finished = max_finished
+        self.state_dir = state_dir
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='analisis')
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        if state_dir:
+            for state in STATES:
+                os.makedirs(os.path.join(state_dir, state), exist_ok=True)
+
+    # Encola func(*args, report_stage=..., run_id=<id del trabajo>, **kwargs); lanza JobQueueFull si se rebasa el límite de admisión
+    def submit(self, func, *args, **kwargs):
+        with self._lock:
+            active = self._active_count()
+            if active >= self.max_workers + self.max_queue:
+                raise JobQueueFull(f"Hay {active} trabajos activos; intente más tarde.")
+            job_id = uuid.uuid4().hex
+            job = {
+                'id': job_id,
+                'state': QUEUED,
+                'stage': None,
+                'created': time.time(),
+                'started': None,
+                'finished': None,
+                'result': None,
+                'error': None
+            }
+            self._jobs[job_id] = job
+            self._save(job)
+            self._prune()
+        self._executor.submit(self._run, job, func, args, kwargs)
+        return job_id
+
+    # Registra como terminado un trabajo cuyo resultado ya existe (por ejemplo, en el almacén de resultados)
+    def add_finished(self, result):
+        now = time.time()
+        with self._lock:
+            job_id = uuid.uuid4().hex
+            job = self._jobs[job_id] = {
+                'id': job_id,
+                'state': DONE,
+                'stage': None,
+                'created': now,
+                'started': now,
+                'finished': now,
+                'result': result,
+                'error': None
+            }
+            self._save(job)
+            self._prune()
+        return job_id
+
+    def _run(self, job, func, args, kwargs):
+        def report_stage(stage):
+            with self._lock:
+                job['stage'] = stage
+                self._save(job, previous=job['state'])
+            logger.info("Trabajo %s: etapa %s", job['id'], stage)
+
+        with self._lock:
+            job['state'] = RUNNING
+            job['started'] = time.time()
+            self._save(job, previous=QUEUED)
+        try:
+            result = func(*args, report_stage=report_stage, run_id=job['id'], **kwargs)
+            with self._lock:
+                job['result'] = result
+                job['state'] = DONE
+        except Exception as e:
+            logger.error("Trabajo %s falló en la etapa %s: %s", job['id'], job['stage'], e)
+            with self._lock:
+                job['error'] = str(e)
+                job['state'] = FAILED
+        finally:
+            with self._lock:
+                job['finished'] = time.time()
+                self._save(job, previous=RUNNING)
+
+    def _job_path(self, job_id):
+        return os.path.join(self.state_dir, f"{job_id}.json")
+
+    def _marker_path(self, state, job_id):
+        name = f"{job_id}.{os.getpid()}" if state in (QUEUED, RUNNING) else job_id
+        return os.path.join(self.state_dir, state, name)
+
+    # Escribe el estado del trabajo y mueve su marcador si cambió de estado (previous)
+    def _save(self, job, previous=None):
+        if not self.state_dir:
+            return
+        path = self._job_path(job['id'])
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(job, f, default=str)
+            os.replace(tmp_path, path)
+        except (OSError, TypeError) as e:
+            logger.warning("No se pudo guardar el estado del trabajo %s: %s", job['id'], e)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        if previous == job['state']:
+            return
+        open(self._marker_path(job['state'], job['id']), 'w').close()
+        if previous is not None:
+            try:
+                os.remove(self._marker_path(previous, job['id']))
+            except FileNotFoundError:
+                pass
+
+    # Marcadores de los trabajos activos de todos los procesos: [(estado, id, pid)]. Los de procesos que ya no
+    # existen se registran como fallidos y se descartan.
+    def _active_markers(self):
+        markers = []
+        for state in (QUEUED, RUNNING):
+            for name in os.listdir(os.path.join(self.state_dir, state)):
+                job_id, _, pid = name.partition('.')
+                if not pid.isdigit():
+                    continue
+                if _process_alive(int(pid)):
+                    markers.append((state, job_id, int(pid)))
+                    continue
+                job = self._read(job_id) or {'id': job_id, 'stage': None, 'created': None, 'started': None, 'result': None}
+                job.update(state=FAILED, finished=time.time(), error="El proceso que ejecutaba el trabajo terminó")
+                self._save(job)
+                try:
+                    os.remove(os.path.join(self.state_dir, state, name))
+                except FileNotFoundError:
+                    pass
+                logger.warning("Trabajo %s del proceso %s que ya no existe; se registra como fallido", job_id, pid)
+        return markers
+
+    def _active_count(self):
+        if self.state_dir:
+            return len(self._active_markers())
+        return sum(1 for job in self._jobs.values() if job['state'] in (QUEUED, RUNNING))
+
+    # Descarta los trabajos terminados más antiguos cuando se rebasa max_finished
+    def _prune(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job['state'] in (DONE, FAILED)]
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self._jobs[job_id]
+        if not self.state_dir:
+            return
+        markers = []
+        for state in (DONE, FAILED):
+            for entry in os.scandir(os.path.join(self.state_dir, state)):
+                try:
+                    markers.append((entry.stat().st_mtime, entry.name, entry.path))
+                except FileNotFoundError:
+                    pass
+        markers.sort()
+        for _, job_id, marker in markers[:max(0, len(markers) - self.max_finished)]:
+            for path in (self._job_path(job_id), marker):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def _read(self, job_id):
+        try:
+            with open(self._job_path(job_id)) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    # Estado de un trabajo: de la memoria si lo ejecuta este proceso, o de su archivo si lo recibió otro
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                return dict(job)
+        if not self.state_dir or not JOB_ID_PATTERN.fullmatch(job_id):
+            return None
+        return self._read(job_id)
+
+    def stats(self):
+        with self._lock:
+            states = {}
+            if self.state_dir:
+                for state, _, _ in self._active_markers():
+                    states[state] = states.get(state, 0) + 1
+                for state in (DONE, FAILED):
+                    count = len(os.listdir(os.path.join(self.state_dir, state)))
+                    if count:
+                        states[state] = count
+            else:
+                for job in self._jobs.values():
+                    states[job['state']] = states.get(job['state'], 0) + 1
+            return {'max_workers': self.max_workers, 'max_queue': self.max_queue, 'states': states}
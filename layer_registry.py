@@ -0,0 +1,169 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+from cruces import iter_wfs_pages, merge_layer_parts, sort_features
+
+logger = logging.getLogger(__name__)
+
+# Extensiones de las instantáneas, en orden de preferencia
+SNAPSHOT_EXTENSIONS = ('.parquet', '.fgb')
+# Extensión nacional usada para descargar una capa completa del WFS (México, EPSG:4326)
+NATIONAL_BBOX = (-118.6, 14.3, -86.5, 32.8)
+
+# Función para obtener el nombre de archivo de la instantánea de una capa (sin extensión)
+def snapshot_name(layer_name):
+    return layer_name.replace(':', '__').replace('/', '_')
+
+# Función para leer una instantánea GeoParquet (mapeada en memoria) o FlatGeobuf
+def read_snapshot(path, crs):
+    if path.endswith('.parquet'):
+        gdf = gpd.read_parquet(path, memory_map=True)
+    else:
+        gdf = gpd.read_file(path)
+    if gdf.crs is None:
+        gdf = gdf.set_crs(crs)
+    elif gdf.crs != crs:
+        gdf = gdf.to_crs(crs)
+    # Mismo orden por id que las capas descargadas (merge_layer_parts)
+    return sort_features(gdf)
+
+# Registro de capas residentes: al iniciar se cargan instantáneas nacionales de cada capa desde
+# <snapshot_dir>/<capa>.parquet|.fgb, con su índice espacial ya construido, y las consultas por bbox
+# se resuelven en memoria. Las capas sin instantánea se consultan con fallback (caché de teselas o WFS).
+class LayerRegistry:
+    def __init__(self, snapshot_dir, sources, crs='EPSG:4326', fallback=None):
+        self.snapshot_dir = snapshot_dir
+        self.sources = sorted(set(sources))
+        self.crs = crs
+        self.fallback = fallback
+        self.hits = 0
+        self.fallbacks = 0
+        self.reloads = 0
+        self._layers = {}
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+
+    def _snapshot_path(self, layer_name):
+        if not self.snapshot_dir:
+            return None
+        for extension in SNAPSHOT_EXTENSIONS:
+            path = os.path.join(self.snapshot_dir, snapshot_name(layer_name) + extension)
+            if os.path.exists(path):
+                return path
+        return None
+
+    # Lee una instantánea y construye su índice espacial; la versión es el hash de tamaño, fecha y ruta del archivo
+    def _load_source(self, source, path):
+        start = time.time()
+        stat = os.stat(path)
+        layer = read_snapshot(path, self.crs)
+        layer.sindex
+        version = hashlib.sha256(f"{path}:{stat.st_size}:{stat.st_mtime_ns}".encode('utf-8')).hexdigest()[:16]
+        logger.info("Capa residente cargada: %s (%d características, %.1f s)", source[1], len(layer), time.time() - start)
+        return {'layer': layer, 'version': version, 'path': path, 'loaded': time.time()}
+
+    # Carga (o recarga) las instantáneas disponibles. Cada capa se lee y se indexa fuera del candado y se
+    # reemplaza de forma atómica: las consultas en curso terminan con la versión anterior.
+    # layer_name limita la recarga a una capa. Devuelve el estado de las capas recargadas.
+    def load(self, layer_name=None):
+        with self._reload_lock:
+            loaded = {}
+            for source in self.sources:
+                if layer_name is not None and source[1] != layer_name:
+                    continue
+                path = self._snapshot_path(source[1])
+                if path is None:
+                    with self._lock:
+                        if self._layers.pop(source, None) is not None:
+                            logger.info("Instantánea eliminada, la capa vuelve al WFS: %s", source[1])
+                    continue
+                entry = self._load_source(source, path)
+                with self._lock:
+                    self._layers[source] = entry
+                    self.reloads += 1
+                loaded[source[1]] = self._describe(entry)
+            return loaded
+
+    # Descarga una capa completa del WFS por páginas, la guarda como instantánea GeoParquet y la recarga
+    def refresh(self, layer_name, bbox=NATIONAL_BBOX):
+        if not self.snapshot_dir:
+            raise ValueError("No hay directorio de instantáneas configurado (CRUCES_LAYER_SNAPSHOT_DIR).")
+        sources = [source for source in self.sources if source[1] == layer_name]
+        if not sources:
+            raise KeyError(layer_name)
+        wfs_url = sources[0][0]
+        layer = merge_layer_parts(list(iter_wfs_pages(wfs_url, layer_name, bbox, self.crs)), self.crs)
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        path = os.path.join(self.snapshot_dir, snapshot_name(layer_name) + '.parquet')
+        tmp_path = os.path.join(self.snapshot_dir, f".{threading.get_ident()}.{snapshot_name(layer_name)}.parquet")
+        try:
+            layer.to_parquet(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        logger.info("Instantánea actualizada desde el WFS: %s (%d características)", layer_name, len(layer))
+        return self.load(layer_name)
+
+    def is_resident(self, wfs_url, layer_name):
+        with self._lock:
+            return (wfs_url, layer_name) in self._layers
+
+    # Versión de la instantánea cargada de una capa, o None si se consulta al WFS
+    def version(self, wfs_url, layer_name):
+        with self._lock:
+            entry = self._layers.get((wfs_url, layer_name))
+        return entry['version'] if entry is not None else None
+
+    # Consulta por bbox con la misma firma que query_wfs_layer: características que intersectan el bbox,
+    # desde memoria si la capa es residente o con el fallback en otro caso
+    def query(self, wfs_url, layer_name, bbox, crs):
+        with self._lock:
+            entry = self._layers.get((wfs_url, layer_name))
+        if entry is None or crs != self.crs:
+            with self._lock:
+                self.fallbacks += 1
+            return self.fallback(wfs_url, layer_name, bbox, crs)
+        layer = entry['layer']
+        positions = np.sort(layer.sindex.query(shapely.box(*bbox), predicate='intersects'))
+        with self._lock:
+            self.hits += 1
+        return layer.iloc[positions].reset_index(drop=True)
+
+    # Consulta varios bbox de una capa residente con una sola consulta al índice; None si no es residente
+    def query_many(self, wfs_url, layer_name, bboxes):
+        with self._lock:
+            entry = self._layers.get((wfs_url, layer_name))
+            if entry is not None:
+                self.hits += 1
+        if entry is None:
+            return None
+        layer = entry['layer']
+        _, positions = layer.sindex.query(shapely.box(*np.asarray(bboxes, dtype=float).T), predicate='intersects')
+        return layer.iloc[np.unique(positions)].reset_index(drop=True)
+
+    def _describe(self, entry):
+        return {
+            'features': len(entry['layer']),
+            'version': entry['version'],
+            'path': entry['path'],
+            'loaded': pd.Timestamp(entry['loaded'], unit='s').isoformat()
+        }
+
+    def stats(self):
+        with self._lock:
+            return {
+                'snapshot_dir': self.snapshot_dir,
+                'hits': self.hits,
+                'fallbacks': self.fallbacks,
+                'reloads': self.reloads,
+                'layers': {source[1]: self._describe(entry) for source, entry in self._layers.items()}
+            }
@@ -1,132 +1,298 @@
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import FileResponse
-from validator import GeoJSONInput, check_topology
-from cruces import load_geojson_from_text, ensure_same_crs, calculate_bbox, query_wfs_layer, calculate_intersections, generate_map_image, generate_pdf, save_json, detect_overlaps
-from datetime import datetime
+from fastapi import FastAPI, HTTPException, Request, Header
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, StreamingResponse, Response
+from cruces import get_wfs_stats
+from validator import REPAIR_GEOMETRIES
+from batch import BatchLayers, analyze_batch_lines, to_ndjson
+from capas import select_layers
+from export import EXPORT_FORMATS, EXPORT_MEDIA_TYPES, export_available, parse_export_name
+from artifact_store import PRECOMPRESSED_SUFFIXES, JOBS_DIR
+from pipeline import CAPAS_WFS, fetch_layer, load_polygons, result_key, run_analysis, add_exports, add_overlap_clusters, is_pending_artifact, render_artifact, artifact_store, wfs_cache, layer_registry, EAGER_ARTIFACTS
+from jobs import JobManager, JobQueueFull
+from metrics import register_collector, render_metrics
+from warmup import warm_up
 import os
-import json
+import re
+import mimetypes
 import logging
-from shapely.geometry import shape
+import tempfile
+from typing import Optional
+from contextlib import asynccontextmanager
 
 # Configuración básica del logger
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+# Al iniciar se cargan en memoria las instantáneas de las capas de referencia y se precalienta el proceso
+# (pyproj, matplotlib, fpdf); con gunicorn.conf.py ya se hizo antes de crear el proceso y no se repite
+@asynccontextmanager
+async def lifespan(app):
+    await run_in_threadpool(warm_up)
+    yield
 
-@app.post("/analyze/")
-async def analyze_geojson(data: GeoJSONInput):
+app = FastAPI(lifespan=lifespan)
+
+# Token para los endpoints de administración (encabezado X-Admin-Token); sin token quedan desactivados
+ADMIN_TOKEN = os.environ.get("CRUCES_ADMIN_TOKEN")
+
+# Trabajos de análisis: hilos de ejecución y límite de trabajos en espera. El estado se guarda en el almacén de
+# resultados para que cualquier proceso de la API responda GET /jobs/{id}
+job_manager = JobManager(
+    max_workers=int(os.environ.get("CRUCES_JOB_WORKERS", "2")),
+    max_queue=int(os.environ.get("CRUCES_JOB_QUEUE", "8")),
+    state_dir=os.path.join(artifact_store.root, JOBS_DIR)
+)
+
+# Función para exponer en /metrics los contadores de las cachés, del registro de capas y de los trabajos
+def _service_metrics():
+    results = artifact_store.stats()
+    layers = layer_registry.stats()
+    jobs = job_manager.stats()
+    collected = [
+        ("cruces_result_cache_hits_total", "counter", "Análisis resueltos con un resultado ya calculado", [({}, results["hits"])]),
+        ("cruces_result_cache_misses_total", "counter", "Análisis sin resultado previo en el almacén", [({}, results["misses"])]),
+        ("cruces_result_cache_bytes", "gauge", "Bytes ocupados por el almacén de resultados", [({}, results["bytes"])]),
+        ("cruces_layer_registry_hits_total", "counter", "Consultas resueltas con capas residentes", [({}, layers["hits"])]),
+        ("cruces_layer_registry_fallbacks_total", "counter", "Consultas de capas no residentes", [({}, layers["fallbacks"])]),
+        ("cruces_jobs", "gauge", "Trabajos de análisis por estado", [({"state": state}, count) for state, count in sorted(jobs["states"].items())]),
+    ]
+    if wfs_cache is not None:
+        tiles = wfs_cache.stats()
+        collected += [
+            ("cruces_wfs_cache_hits_total", "counter", "Teselas WFS servidas desde la caché", [({}, tiles["hits"])]),
+            ("cruces_wfs_cache_misses_total", "counter", "Teselas WFS descargadas", [({}, tiles["misses"])]),
+        ]
+    return collected
+
+register_collector(_service_metrics)
+
+# Función para cargar los polígonos y buscar un resultado idéntico en el almacén
+def _load_and_lookup(body, repair, capas):
+    polygons_gdf = load_polygons(body, repair)
+    key = result_key(polygons_gdf, capas)
+    return polygons_gdf, key, artifact_store.lookup(key)
+
+# Función para interpretar el parámetro layers (claves de capas.json separadas por comas)
+def _requested_layers(layers):
+    try:
+        return select_layers(CAPAS_WFS, layers)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# El cuerpo es el FeatureCollection como JSON nativo (también se acepta el formato anterior {"geojson": "<texto>"})
+# layers=federales,estatales limita el análisis a esas capas; por defecto se consultan todas.
+# base=<result_key de un análisis anterior> recalcula solo los polígonos que cambiaron y devuelve las diferencias.
+# format=parquet|geoparquet|json_gz|json_zst agrega enlaces a los resultados en ese formato (los JSON se conservan)
+# overlaps=clusters agrega un enlace a los grupos de polígonos que se superponen (overlap_clusters)
+@app.post("/analyze/", status_code=202)
+async def analyze_geojson(request: Request, repair: Optional[bool] = None, eager: Optional[bool] = None, layers: Optional[str] = None, base: Optional[str] = None, format: Optional[str] = None, overlaps: Optional[str] = None):
+    capas = _requested_layers(layers)
+    if overlaps not in (None, "pairs", "clusters"):
+        raise HTTPException(status_code=400, detail=f"Valor no válido para overlaps: {overlaps}. Valores: pairs, clusters")
+    if format not in (None, "json") and not export_available(format):
+        raise HTTPException(status_code=400, detail=f"Formato no disponible: {format}. Formatos: json, {', '.join(f for f in EXPORT_FORMATS if export_available(f))}")
+    if base is not None and (not re.fullmatch(r"[0-9a-f]{64}", base) or artifact_store.lookup(base, count=False) is None):
+        raise HTTPException(status_code=404, detail=f"No existe el resultado base {base}")
     try:
         logger.info("Recibido GeoJSON para análisis.")
-        
-        # Parsear el GeoJSON usando la clase de validador
-        geojson_dict = GeoJSONInput.parse_geojson(data)
-        
-        valid_features = []
-        for feature in geojson_dict["features"]:
-            geometry = shape(feature["geometry"])
-            if check_topology(geometry):
-                valid_features.append(feature)
-
-        valid_geojson_data = {
-            "type": "FeatureCollection",
-            "features": valid_features
-        }
-
-        geojson_text = json.dumps(valid_geojson_data)
-        polygons_gdf = load_geojson_from_text(geojson_text)
-
-        logger.info("Polígonos válidos cargados: %d", len(polygons_gdf))
-
-        today = datetime.today().strftime('%Y-%m-%d')
-        geojson_filename = "input_geojson"
-
-        output_image = f"/tmp/mapa_{geojson_filename}_{today}.png"
-        output_pdf = f"/tmp/reporte_{geojson_filename}_{today}.pdf"
-        json_uso_suelo = f"/tmp/intersecciones_uso_suelo_{geojson_filename}_{today}.json"
-        json_federales = f"/tmp/intersecciones_federales_{geojson_filename}_{today}.json"
-        json_estatales = f"/tmp/intersecciones_estatales_{geojson_filename}_{today}.json"
-        json_municipales = f"/tmp/intersecciones_municipales_{geojson_filename}_{today}.json"
-        json_locales = f"/tmp/intersecciones_locales_{geojson_filename}_{today}.json"
-        json_regionales = f"/tmp/intersecciones_regionales_{geojson_filename}_{today}.json"
-
-        crs_target = 'EPSG:4326'
-        polygons_gdf = ensure_same_crs(polygons_gdf, crs_target)
-        bbox = calculate_bbox(polygons_gdf)
-
-        wfs_url_uso_suelo = "https://app.semarnat.gob.mx/geoserver/DGPEE/wfs"
-        layer_name_uso_suelo = "DGPEE:usuev250sVII"
-        usos_suelo = query_wfs_layer(wfs_url_uso_suelo, layer_name_uso_suelo, bbox, crs_target)
-
-        wfs_url_federales = "https://app.semarnat.gob.mx/geoserver/DGPEE_Biodiversidad_Ecosistemas/wfs"
-        layer_name_federales = "DGPEE_Biodiversidad_Ecosistemas:anp186_itrf08_19012023"
-        anp_federales = query_wfs_layer(wfs_url_federales, layer_name_federales, bbox, crs_target)
-
-        wfs_url_estatales = "https://app.semarnat.gob.mx/geoserver/DGPEE_Biodiversidad_Ecosistemas/wfs"
-        layer_name_estatales = "DGPEE_Biodiversidad_Ecosistemas:anpest15gw"
-        anp_estatales = query_wfs_layer(wfs_url_estatales, layer_name_estatales, bbox, crs_target)
-
-        wfs_url_municipales = "https://app.semarnat.gob.mx/geoserver/DGPEE_Biodiversidad_Ecosistemas/wfs"
-        layer_name_municipales = "DGPEE_Biodiversidad_Ecosistemas:anpest15gw"
-        anp_municipales = query_wfs_layer(wfs_url_municipales, layer_name_municipales, bbox, crs_target)
-
-        wfs_url_locales = "https://app.semarnat.gob.mx/geoserver/DGPEE_Ordenamientos/wfs"
-        layer_name_locales = "DGPEE_Ordenamientos:LOCALES_107_221231"
-        locales = query_wfs_layer(wfs_url_locales, layer_name_locales, bbox, crs_target)
-
-        wfs_url_regionales = "https://app.semarnat.gob.mx/geoserver/DGPEE_Ordenamientos/wfs"
-        layer_name_regionales = "DGPEE_Ordenamientos:REGIONALES_53220930"
-        regionales = query_wfs_layer(wfs_url_regionales, layer_name_regionales, bbox, crs_target)
-
-        usos_suelo = ensure_same_crs(usos_suelo, crs_target)
-        anp_federales = ensure_same_crs(anp_federales, crs_target)
-        anp_estatales = ensure_same_crs(anp_estatales, crs_target)
-        anp_municipales = ensure_same_crs(anp_municipales, crs_target)
-        locales = ensure_same_crs(locales, crs_target)
-        regionales = ensure_same_crs(regionales, crs_target)
-
-        intersections_uso_suelo = calculate_intersections(polygons_gdf, usos_suelo, 'Usos de Suelo Serie VII', ['tip_veg','des_veg'])
-        intersections_federales = calculate_intersections(polygons_gdf, anp_federales, 'Áreas Naturales Protegidas Federales', ['id_anp', 'nombre', 'cat_manejo', 'superficie', 'region'])
-        intersections_estatales = calculate_intersections(polygons_gdf, anp_estatales, 'Áreas Naturales Protegidas Estatales', ['nombre', 'entidad', 'mun_dec', 'area', 'enlace_dec'])
-        intersections_municipales = calculate_intersections(polygons_gdf, anp_municipales, 'Áreas Naturales Protegidas Municipales', ['nombre', 'entidad', 'mun_dec', 'area', 'enlace_dec'])
-        intersections_locales = calculate_intersections(polygons_gdf, locales, 'Ordenamientos Locales', ['nom_mun', 'ordenamine', 'situacion', 'decreto', 'concenio'], tipo_ordenamiento="Ordenamiento Local")
-        intersections_regionales = calculate_intersections(polygons_gdf, regionales, 'Ordenamientos Regionales', ['nom_ent', 'situacion', 'ordenamien', 'f_decreto'], tipo_ordenamiento="Ordenamiento Regional")
-
-        overlaps = detect_overlaps(polygons_gdf)
-
-        save_json(intersections_uso_suelo, json_uso_suelo)
-        save_json(intersections_federales, json_federales)
-        save_json(intersections_estatales, json_estatales)
-        save_json(intersections_municipales, json_municipales)
-        save_json(intersections_locales, json_locales)
-        save_json(intersections_regionales, json_regionales)
-
-        generate_map_image(polygons_gdf, output_image)
-        generate_pdf(polygons_gdf, output_pdf, output_image, intersections_uso_suelo, intersections_federales, intersections_estatales, intersections_municipales, intersections_locales, intersections_regionales, overlaps)
-
-        return {
-            "map_image": output_image,
-            "report_pdf": output_pdf,
-            "intersections_uso_suelo": json_uso_suelo,
-            "intersections_federales": json_federales,
-            "intersections_estatales": json_estatales,
-            "intersections_municipales": json_municipales,
-            "intersections_locales": json_locales,
-            "intersections_regionales": json_regionales
-        }
+
+        # Una sola decodificación del cuerpo y construcción por lotes de los polígonos, fuera del event loop
+        # repair=true repara con make_valid las geometrías inválidas en lugar de descartarlas
+        polygons_gdf, key, cached = await run_in_threadpool(_load_and_lookup, await request.body(), REPAIR_GEOMETRIES if repair is None else repair, capas)
+        # eager=true genera el mapa y el PDF al terminar el análisis en lugar de en la primera descarga
+        eager = EAGER_ARTIFACTS if eager is None else eager
+        if cached is not None and not eager and base is None:
+            # Resultado idéntico ya calculado: el trabajo se registra terminado sin pasar por la cola
+            job_id = job_manager.add_finished(add_overlap_clusters(add_exports(cached, format), overlaps))
+        else:
+            job_id = job_manager.submit(run_analysis, polygons_gdf, eager=eager, key=key, capas=capas, base=base, export_format=format, overlaps=overlaps)
+    except JobQueueFull as e:
+        logger.warning("Solicitud rechazada: %s", e)
+        raise HTTPException(status_code=503, detail=f"Servicio saturado: {e}", headers={"Retry-After": "30"})
     except Exception as e:
         logger.error("Error al analizar el GeoJSON: %s", e)
         raise HTTPException(status_code=400, detail=f"Error al analizar el GeoJSON: {e}")
 
+    return {
+        "job_id": job_id,
+        "status_url": f"/jobs/{job_id}",
+        "result_key": key,
+        "cache": "hit" if cached is not None else "miss",
+        "layers": [capa["clave"] for capa in capas],
+        "validation": polygons_gdf.attrs.get("validation")
+    }
+
+# Líneas por grupo en /analyze/batch: el primer grupo es de una línea para entregar resultados pronto
+# y el tamaño se duplica hasta CRUCES_BATCH_CHUNK
+BATCH_CHUNK = int(os.environ.get("CRUCES_BATCH_CHUNK", "256"))
+
+# Función para recibir el cuerpo NDJSON en un archivo temporal (en memoria hasta 8 MB, después en disco).
+# El cuerpo se recibe completo antes de responder porque la respuesta en streaming también escucha el canal
+# de la petición (desconexión del cliente) y no puede compartirlo con la lectura del cuerpo.
+async def _spool_body(request):
+    spool = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+    async for chunk in request.stream():
+        spool.write(chunk)
+    spool.seek(0)
+    return spool
+
+# Lote NDJSON: cada línea es un FeatureCollection (o un Feature) independiente. Las capas se descargan
+# una vez para todo el lote y los registros se devuelven como NDJSON conforme se calculan.
+@app.post("/analyze/batch")
+async def analyze_batch(request: Request, repair: Optional[bool] = None, layers: Optional[str] = None):
+    repair = REPAIR_GEOMETRIES if repair is None else repair
+    batch_layers = BatchLayers(_requested_layers(layers), fetch=fetch_layer)
+    spool = await _spool_body(request)
+
+    # Un error al analizar un grupo (p. ej. el WFS no responde) se informa en cada una de sus líneas y el
+    # lote continúa con el siguiente grupo
+    async def analyze_chunk(lines):
+        try:
+            return await run_in_threadpool(analyze_batch_lines, lines, batch_layers, repair)
+        except Exception as e:
+            logger.exception("Error al analizar las líneas %d a %d del lote", lines[0][0], lines[-1][0])
+            return [{"line": line_number, "error": str(e)} for line_number, _ in lines]
+
+    async def results():
+        chunk_size = 1
+        lines = []
+        try:
+            for line_number, line in enumerate(spool, start=1):
+                if not line.strip():
+                    continue
+                lines.append((line_number, line))
+                if len(lines) >= chunk_size:
+                    yield to_ndjson(await analyze_chunk(lines))
+                    lines = []
+                    chunk_size = min(chunk_size * 2, BATCH_CHUNK)
+            if lines:
+                yield to_ndjson(await analyze_chunk(lines))
+        finally:
+            spool.close()
+        logger.info("Lote terminado: %d teselas de capas descargadas", batch_layers.fetches)
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
+
+@app.get("/jobs/stats")
+async def job_stats():
+    return job_manager.stats()
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    response = {
+        "job_id": job["id"],
+        "state": job["state"],
+        "stage": job["stage"],
+        "created": job["created"],
+        "started": job["started"],
+        "finished": job["finished"]
+    }
+    if job["error"] is not None:
+        response["error"] = job["error"]
+    if job["result"] is not None:
+        response["result"] = job["result"]
+        response["downloads"] = {name: f"/download/{os.path.relpath(path, artifact_store.root)}" for name, path in job["result"].items() if isinstance(path, str)}
+    return response
+
+# Función para obtener las codificaciones aceptadas por el cliente (encabezado Accept-Encoding), sin las de q=0
+def _accepted_encodings(accept_encoding):
+    accepted = set()
+    for item in (accept_encoding or "").split(","):
+        coding, _, params = item.strip().partition(";")
+        quality = params.strip()
+        if quality.startswith("q="):
+            try:
+                if float(quality[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        if coding:
+            accepted.add(coding.strip().lower())
+    return accepted
+
+# Función para saber si la ETag del archivo está en If-None-Match (comparación débil, como indica RFC 9110)
+def _etag_matches(if_none_match, etag):
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+# Descarga de artefactos del almacén con ETag fuerte (huella sha256 del contenido), respuesta 304 con
+# If-None-Match, rangos de bytes (Range/If-Range) y las variantes precomprimidas de los JSON (brotli o gzip,
+# según Accept-Encoding). Solo se sirven archivos publicados dentro de CRUCES_ARTIFACT_DIR.
 @app.get("/download/{file_path:path}")
-async def download_file(file_path: str):
-    file_location = os.path.join("/tmp", file_path)
-    
-    if not os.path.exists(file_location):
+async def download_file(file_path: str, request: Request):
+    file_location = artifact_store.resolve(file_path)
+    if file_location is None:
         raise HTTPException(status_code=404, detail="File not found")
-    
-    return FileResponse(file_location)
 
+    # El mapa, el PDF y los archivos derivados se generan en la primera descarga y quedan en disco para las siguientes
+    if not os.path.exists(file_location) and is_pending_artifact(file_location):
+        await run_in_threadpool(render_artifact, file_location)
+
+    if not os.path.isfile(file_location):
+        raise HTTPException(status_code=404, detail="File not found")
+
+    # Los archivos exportados se sirven con su tipo (y no como JSON en el caso de .json.gz)
+    export = parse_export_name(os.path.basename(file_location))
+    media_type = EXPORT_MEDIA_TYPES[export[1]] if export else mimetypes.guess_type(file_location)[0] or "application/octet-stream"
+
+    accepted = _accepted_encodings(request.headers.get("accept-encoding"))
+    served, encoding = file_location, None
+    for candidate in PRECOMPRESSED_SUFFIXES:
+        variant = artifact_store.variant(file_location, candidate) if candidate in accepted else None
+        if variant is not None:
+            served, encoding = variant, candidate
+            break
+    digest = await run_in_threadpool(artifact_store.digest, file_location)
+    # Cada codificación es una representación distinta y tiene su propia ETag
+    headers = {"ETag": f'"{digest}-{encoding}"' if encoding else f'"{digest}"'}
+    if artifact_store.variant(file_location, "gzip") is not None:
+        headers["Vary"] = "Accept-Encoding"
+    if _etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return FileResponse(served, media_type=media_type, headers=headers)
+
+# Recarga en caliente de las instantáneas de las capas (todas o solo layer). Con refresh=true la capa
+# se descarga completa del WFS y se guarda como nueva instantánea antes de recargarla.
+@app.post("/admin/layers/reload")
+async def reload_layers(layer: Optional[str] = None, refresh: bool = False, x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN or x_admin_token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Forbidden")
+    try:
+        if refresh:
+            if layer is None:
+                raise HTTPException(status_code=400, detail="refresh=true requiere el parámetro layer")
+            loaded = await run_in_threadpool(layer_registry.refresh, layer)
+        else:
+            loaded = await run_in_threadpool(layer_registry.load, layer)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Capa desconocida: {layer}")
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error("Error al recargar las capas: %s", e)
+        raise HTTPException(status_code=500, detail=f"Error al recargar las capas: {e}")
+    return {"reloaded": loaded, **layer_registry.stats()}
+
+# Métricas en formato de exposición de Prometheus: duración de cada etapa, descargas WFS, intersecciones y cachés
+@app.get("/metrics")
+async def metrics():
+    return Response(await run_in_threadpool(render_metrics), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/cache/stats")
+async def cache_stats():
+    results = await run_in_threadpool(artifact_store.stats)
+    if wfs_cache is None:
+        return {"enabled": False, "wfs": get_wfs_stats(), "results": results, "layers": layer_registry.stats()}
+    return {"enabled": True, **wfs_cache.stats(), "wfs": get_wfs_stats(), "results": results, "layers": layer_registry.stats()}
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
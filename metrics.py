@@ -0,0 +1,152 @@
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+# Límites (segundos) de los histogramas de duración de las etapas
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_metrics = []
+_collectors = []
+_registry_lock = threading.Lock()
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+# Contador monotónico con etiquetas (el nombre termina en _total, como en el formato de Prometheus)
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in sorted(self._values.items())]
+
+# Histograma con etiquetas: cuenta las observaciones por límite superior, con su suma y total
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _metrics.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labels)
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = {'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0}
+            entry['counts'][position] += 1
+            entry['sum'] += value
+            entry['count'] += 1
+
+    # Mide la duración del bloque y la registra en el histograma
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, entry in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), entry['counts']):
+                    cumulative += count
+                    samples.append((self.name + '_bucket', key + (_format_value(bound),), cumulative))
+                samples.append((self.name + '_sum', key, entry['sum']))
+                samples.append((self.name + '_count', key, entry['count']))
+        return samples
+
+# Registra una función que devuelve métricas calculadas al momento de la consulta (contadores de las cachés,
+# trabajos por estado): una lista de (nombre, tipo, descripción, [(etiquetas, valor)])
+def register_collector(collector):
+    with _registry_lock:
+        _collectors.append(collector)
+
+# Función para generar el texto de /metrics en formato de exposición de Prometheus (versión 0.0.4)
+def render_metrics():
+    lines = []
+    with _registry_lock:
+        metrics, collectors = list(_metrics), list(_collectors)
+    for metric in metrics:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        label_names = metric.labels + (('le',) if metric.kind == 'histogram' else ())
+        for name, key, value in metric.samples():
+            names = label_names if name.endswith('_bucket') else metric.labels
+            lines.append(f"{name}{_format_labels(names, key)} {_format_value(value)}")
+    for collector in collectors:
+        for name, kind, documentation, samples in collector():
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{_format_labels(tuple(labels), tuple(labels.values()))} {_format_value(value)}")
+    return '\n'.join(lines) + '\n'
+
+# Filtro de logging que deja pasar a lo más `rate` mensajes por segundo de cada plantilla; los omitidos se
+# cuentan y se informan en el siguiente mensaje que pasa
+class RateLimitFilter(logging.Filter):
+    def __init__(self, rate=10, interval=1.0):
+        super().__init__()
+        self.rate = rate
+        self.interval = interval
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(record.msg)
+            if window is None or now - window['start'] >= self.interval:
+                suppressed = window['suppressed'] if window else 0
+                window = self._windows[record.msg] = {'start': now, 'count': 0, 'suppressed': 0}
+                if suppressed:
+                    record.msg = f"{record.msg} (%d mensajes omitidos)"
+                    record.args = tuple(record.args or ()) + (suppressed,)
+            if window['count'] >= self.rate:
+                window['suppressed'] += 1
+                return False
+            window['count'] += 1
+            return True
+
+# Métricas del análisis
+STAGE_SECONDS = Histogram('cruces_stage_seconds', 'Duración de cada etapa del análisis', labels=('stage', 'capa'))
+WFS_PAGES = Counter('cruces_wfs_pages_total', 'Páginas WFS descargadas', labels=('layer',))
+WFS_BYTES = Counter('cruces_wfs_bytes_total', 'Bytes descargados del WFS', labels=('layer',))
+WFS_FEATURES = Counter('cruces_wfs_features_total', 'Características descargadas del WFS', labels=('layer',))
+INTERSECTIONS = Counter('cruces_intersections_total', 'Registros de intersección producidos', labels=('capa',))
+OVERLAPS = Counter('cruces_overlaps_total', 'Superposiciones entre polígonos encontradas')
+POLYGONS = Counter('cruces_polygons_total', 'Polígonos analizados')
@@ -0,0 +1,142 @@
+import logging
+import math
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import geopandas as gpd
+import numpy as np
+import shapely
+from shapely.geometry import box
+
+from cruces import intersection_pairs, intersection_records
+
+logger = logging.getLogger(__name__)
+
+# Configuración del cruce en paralelo por procesos
+PROCESS_WORKERS = int(os.environ.get("CRUCES_PROCESS_WORKERS", str(os.cpu_count() or 1)))
+# Las capas con más características que este valor se dividen en bloques espaciales
+CHUNK_FEATURES = int(os.environ.get("CRUCES_PARALLEL_CHUNK", "20000"))
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+# Función para obtener el grupo de procesos compartido (forkserver: seguro aunque el proceso tenga hilos)
+def get_process_pool():
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _process_pool = ProcessPoolExecutor(max_workers=PROCESS_WORKERS, mp_context=multiprocessing.get_context(method))
+        return _process_pool
+
+# Función para empaquetar geometrías como un solo búfer WKB más un arreglo de desplazamientos
+def pack_geometries(geometries):
+    wkbs = shapely.to_wkb(np.asarray(geometries))
+    lengths = np.fromiter((len(wkb) if wkb is not None else 0 for wkb in wkbs), dtype=np.int64, count=len(wkbs))
+    offsets = np.zeros(len(wkbs) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return b''.join(wkb for wkb in wkbs if wkb is not None), offsets
+
+# Función para reconstruir las geometrías a partir del búfer WKB
+def unpack_geometries(buffer, offsets):
+    view = memoryview(buffer)
+    return shapely.from_wkb([bytes(view[start:end]) if end > start else None for start, end in zip(offsets[:-1], offsets[1:])])
+
+# Función para empaquetar un subconjunto de filas (posiciones) de un GeoDataFrame con las columnas indicadas
+def pack_frame(gdf, positions, columns):
+    subset = gdf.iloc[positions]
+    buffer, offsets = pack_geometries(subset.geometry.values)
+    return {
+        'positions': np.asarray(positions, dtype=np.int64),
+        'wkb': buffer,
+        'offsets': offsets,
+        'columns': {column: subset[column].tolist() for column in columns if column in gdf.columns},
+        'crs': gdf.crs.to_string() if gdf.crs is not None else None
+    }
+
+def unpack_frame(pack):
+    return gpd.GeoDataFrame(pack['columns'], geometry=unpack_geometries(pack['wkb'], pack['offsets']), crs=pack['crs'])
+
+# Tarea de un proceso: cruza un bloque de polígonos con un bloque de la capa y devuelve posiciones globales,
+# registros y segundos de cruce de cada capa (el cálculo de los pares, compartido, se cuenta en todas)
+def _intersect_chunk(polygons_pack, layer_pack, targets):
+    start = time.perf_counter()
+    polygons_gdf = unpack_frame(polygons_pack)
+    layer = unpack_frame(layer_pack)
+    pairs = intersection_pairs(polygons_gdf, layer)
+    pairs_seconds = time.perf_counter() - start
+    records = []
+    seconds = []
+    for layer_name, fields, tipo_ordenamiento in targets:
+        start = time.perf_counter()
+        records.append(intersection_records(polygons_gdf, layer, pairs, layer_name, fields, tipo_ordenamiento))
+        seconds.append(pairs_seconds + time.perf_counter() - start)
+    return polygons_pack['positions'][pairs[0]], layer_pack['positions'][pairs[1]], records, seconds
+
+# Función para dividir una capa en bloques espaciales contiguos según la curva de Hilbert
+def _layer_chunks(layer):
+    if len(layer) <= CHUNK_FEATURES:
+        return [np.arange(len(layer))]
+    order = np.argsort(layer.geometry.hilbert_distance(), kind='stable')
+    n_chunks = math.ceil(len(layer) / CHUNK_FEATURES)
+    return [np.sort(chunk) for chunk in np.array_split(order, n_chunks)]
+
+# Función para cruzar varias capas en un grupo de procesos. layer_requests es un diccionario
+# clave -> (layer, layer_name, fields, tipo_ordenamiento); las claves que comparten el mismo GeoDataFrame
+# se cruzan en las mismas tareas. Los registros son idénticos a los de calculate_intersections en serie.
+# Devuelve clave -> registros y clave -> segundos de cruce sumados entre los bloques de todos los procesos.
+def intersect_layers_parallel(polygons_gdf, layer_requests):
+    groups = {}
+    for key, (layer, layer_name, fields, tipo_ordenamiento) in layer_requests.items():
+        group = groups.setdefault(id(layer), {'layer': layer, 'keys': [], 'targets': [], 'fields': set()})
+        group['keys'].append(key)
+        group['targets'].append((layer_name, fields, tipo_ordenamiento))
+        group['fields'].update(fields)
+
+    polygon_columns = ['id', 'predio_id', 'subpoligono_id']
+    pool = get_process_pool()
+    for group in groups.values():
+        layer = group['layer']
+        group['futures'] = []
+        if polygons_gdf.empty or layer.empty:
+            continue
+        logger.info("Procesando intersecciones en paralelo con %d características para: %s", len(layer), ', '.join(t[0] for t in group['targets']))
+        layer_columns = ['id'] + sorted(group['fields'])
+        for chunk in _layer_chunks(layer):
+            # Solo se envían los polígonos que tocan la extensión del bloque
+            chunk_bounds = box(*layer.geometry.values[chunk].total_bounds)
+            polygon_positions = np.sort(polygons_gdf.sindex.query(chunk_bounds, predicate='intersects'))
+            if len(polygon_positions) == 0:
+                continue
+            group['futures'].append(pool.submit(
+                _intersect_chunk,
+                pack_frame(polygons_gdf, polygon_positions, polygon_columns),
+                pack_frame(layer, chunk, layer_columns),
+                group['targets']
+            ))
+
+    intersections = {}
+    seconds = {}
+    for group in groups.values():
+        results = [future.result() for future in group.get('futures', [])]
+        for k, key in enumerate(group['keys']):
+            seconds[key] = sum(result[3][k] for result in results)
+        if not results:
+            for key in group['keys']:
+                intersections[key] = []
+            continue
+        poly_pos = np.concatenate([result[0] for result in results])
+        feature_pos = np.concatenate([result[1] for result in results])
+        # Mismo orden que el cruce en serie: por polígono y luego por característica
+        order = np.lexsort((feature_pos, poly_pos))
+        for k, key in enumerate(group['keys']):
+            # Cada bloque devuelve un registro por par; si no, el orden por posición no correspondería a los registros
+            for result in results:
+                if len(result[2][k]) != len(result[0]):
+                    raise RuntimeError(f"El bloque devolvió {len(result[2][k])} registros de {key} para {len(result[0])} pares")
+            records = [record for result in results for record in result[2][k]]
+            intersections[key] = [records[i] for i in order]
+    return intersections, seconds
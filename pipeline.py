@@ -0,0 +1,612 @@
+from cruces import load_geojson_features, ensure_same_crs, plan_query_bboxes, merge_layer_parts, query_wfs_layer, submit_layer_fetch, stream_layer_intersections, calculate_intersections, generate_map_image, save_json, detect_overlaps, overlap_clusters
+from report import generate_pdf
+from parallel import intersect_layers_parallel
+from validator import parse_request_body, REPAIR_GEOMETRIES
+from wfs_cache import WFSTileCache
+from artifact_store import ArtifactStore, analysis_key, feature_hashes
+from layer_registry import LayerRegistry
+from capas import CAPAS
+from export import INTERSECTION_COLUMNS, OVERLAP_COLUMNS, export_name, parse_export_name, write_export
+from metrics import STAGE_SECONDS, INTERSECTIONS, OVERLAPS, POLYGONS
+import os
+import json
+import logging
+import threading
+import time
+import uuid
+import geopandas as gpd
+import numpy as np
+import shapely
+
+logger = logging.getLogger(__name__)
+
+# Capas de referencia descritas en capas.json; cada solicitud puede elegir un subconjunto (select_layers)
+CAPAS_WFS = CAPAS
+
+# Ingesta paginada: cada página descargada se cruza de inmediato (CRUCES_WFS_STREAMING=1)
+WFS_STREAMING = os.environ.get("CRUCES_WFS_STREAMING", "0") == "1"
+
+# Cruce de las capas en un grupo de procesos (CRUCES_PARALLEL=1); ver parallel.py
+PARALLEL_ENABLED = os.environ.get("CRUCES_PARALLEL", "0") == "1"
+
+# El mapa y el PDF se generan la primera vez que se descargan; CRUCES_EAGER_ARTIFACTS=1 los genera al terminar el análisis
+EAGER_ARTIFACTS = os.environ.get("CRUCES_EAGER_ARTIFACTS", "0") == "1"
+
+# Candados por ruta para que las descargas simultáneas de un artefacto lo generen una sola vez
+_render_locks = {}
+_render_lock = threading.Lock()
+
+# Manifiesto con lo necesario para generar el mapa y el PDF de un resultado
+MANIFEST_FILE = "artefactos.json"
+# Versión del formato de resultados; se incrementa cuando cambia el cálculo para no reutilizar resultados anteriores
+ANALYSIS_VERSION = 2
+
+# Almacén de resultados direccionado por contenido (clave: geometrías normalizadas y versiones de las capas).
+# Los JSON de resultados se guardan también comprimidos con gzip (y brotli si está instalado) para /download/.
+artifact_store = ArtifactStore(
+    root=os.environ.get("CRUCES_ARTIFACT_DIR", "/tmp/cruces_resultados"),
+    max_bytes=int(os.environ.get("CRUCES_ARTIFACT_MAX_MB", "2048")) * 1024 * 1024,
+    max_age=int(os.environ.get("CRUCES_ARTIFACT_MAX_AGE", str(7 * 24 * 3600))),
+    compress_level=int(os.environ.get("CRUCES_PRECOMPRESS_LEVEL", "6")),
+    compress_min_bytes=int(os.environ.get("CRUCES_PRECOMPRESS_MIN_BYTES", "1024"))
+)
+
+# Caché en disco de las capas WFS (se desactiva con CRUCES_WFS_CACHE=0)
+WFS_CACHE_ENABLED = os.environ.get("CRUCES_WFS_CACHE", "1") != "0"
+WFS_CACHE_TTL_POR_CAPA = {capa["layer_name"]: capa["ttl"] for capa in CAPAS_WFS if "ttl" in capa}
+wfs_cache = WFSTileCache(
+    cache_dir=os.environ.get("CRUCES_WFS_CACHE_DIR", "/tmp/cruces_wfs_cache"),
+    tile_size=float(os.environ.get("CRUCES_WFS_CACHE_TILE_SIZE", "0.25")),
+    max_bytes=int(os.environ.get("CRUCES_WFS_CACHE_MAX_MB", "2048")) * 1024 * 1024,
+    default_ttl=int(os.environ.get("CRUCES_WFS_CACHE_TTL", str(24 * 3600))),
+    layer_ttl=WFS_CACHE_TTL_POR_CAPA,
+    max_tiles=int(os.environ.get("CRUCES_WFS_CACHE_MAX_TILES", "64"))
+) if WFS_CACHE_ENABLED else None
+
+# Función para consultar una capa remota, pasando por la caché de teselas si está activa
+def fetch_remote_layer(wfs_url, layer_name, bbox, crs):
+    if wfs_cache is not None:
+        return wfs_cache.query(wfs_url, layer_name, bbox, crs)
+    return query_wfs_layer(wfs_url, layer_name, bbox, crs)
+
+# Capas residentes en memoria a partir de instantáneas nacionales (CRUCES_LAYER_SNAPSHOT_DIR); las capas
+# sin instantánea se consultan con la caché de teselas o el WFS. Se cargan con layer_registry.load().
+layer_registry = LayerRegistry(
+    os.environ.get("CRUCES_LAYER_SNAPSHOT_DIR"),
+    [(capa["wfs_url"], capa["layer_name"]) for capa in CAPAS_WFS],
+    fallback=fetch_remote_layer
+)
+
+# Función para consultar una capa: desde memoria si es residente y si no, de la caché de teselas o el WFS
+def fetch_layer(wfs_url, layer_name, bbox, crs):
+    return layer_registry.query(wfs_url, layer_name, bbox, crs)
+
+# Función de ingesta: decodifica el cuerpo de la solicitud una sola vez y construye el GeoDataFrame
+# de polígonos válidos por lotes, listo para run_analysis. Con repair=True las geometrías inválidas se reparan.
+def load_polygons(body, repair=REPAIR_GEOMETRIES):
+    with STAGE_SECONDS.time(stage="parseo"):
+        geojson_dict = parse_request_body(body)
+    with STAGE_SECONDS.time(stage="validacion"):
+        polygons_gdf = load_geojson_features(geojson_dict, repair=repair)
+    logger.info("Polígonos válidos cargados: %d de %d features", len(polygons_gdf), len(geojson_dict["features"]))
+    return polygons_gdf
+
+# Función para obtener la huella de una capa: cualquier cambio de fuente, campos o versión (clave "version"
+# en capas.json; por defecto el nombre de la capa) o de la instantánea residente cargada la modifica
+def layer_fingerprint(capa):
+    return [capa["clave"], capa["wfs_url"], capa["layer_name"], capa["campos"], capa.get("tipo"), capa.get("version", capa["layer_name"]),
+            layer_registry.version(capa["wfs_url"], capa["layer_name"])]
+
+# Función para obtener la huella de las capas consultadas; un cambio en cualquiera produce otra clave de
+# resultados. capas es la selección de la solicitud (por defecto todas).
+def layers_fingerprint(capas=None):
+    return {
+        "analisis": ANALYSIS_VERSION,
+        "capas": [layer_fingerprint(capa) for capa in (capas or CAPAS_WFS)]
+    }
+
+# Función para calcular la clave de resultados de un GeoDataFrame de polígonos y una selección de capas
+def result_key(polygons_gdf, capas=None):
+    return analysis_key(polygons_gdf, layers_fingerprint(capas))
+
+# Función para agregar a un resultado las rutas de sus archivos en un formato de exportación (export.py):
+# intersections_<clave>_<formato> y overlaps_<formato>. Los archivos se generan en la primera descarga.
+def add_exports(result, export_format):
+    if export_format in (None, "json"):
+        return result
+    for name, value in list(result.items()):
+        if isinstance(value, str) and value.endswith('.json') and (name.startswith('intersections_') or name == 'overlaps'):
+            result[f"{name}_{export_format}"] = os.path.join(os.path.dirname(value), export_name(os.path.basename(value), export_format))
+    return result
+
+# Prefijo del archivo de grupos de superposiciones (overlap_clusters), derivado del JSON de superposiciones
+CLUSTERS_PREFIX = "grupos_"
+
+# Función para agregar a un resultado la ruta de sus grupos de superposiciones (overlap_clusters): los polígonos
+# que se superponen entre sí, directa o indirectamente, resumidos por predio. El archivo se genera en la primera descarga.
+def add_overlap_clusters(result, overlaps=None):
+    if overlaps == "clusters":
+        result["overlap_clusters"] = os.path.join(os.path.dirname(result["overlaps"]), CLUSTERS_PREFIX + os.path.basename(result["overlaps"]))
+    return result
+
+# Función que ejecuta el análisis completo sobre el GeoDataFrame de polígonos de load_polygons.
+# report_stage recibe el nombre de cada etapa al iniciarla, para informar el avance del trabajo;
+# run_id identifica el directorio de trabajo mientras el análisis está en curso. Los resultados se publican
+# en el almacén bajo la clave de contenido (key); si ya existen, se devuelven sin recalcular. Con eager=False
+# el mapa y el PDF se generan en la primera descarga (render_artifact). capas limita el análisis a una
+# selección de capas (select_layers); por defecto se consultan todas. base es la clave de un resultado
+# anterior: solo se recalculan los polígonos que cambiaron respecto a él y el resultado incluye las diferencias.
+# export_format agrega las rutas de los resultados en ese formato (add_exports); los JSON se conservan siempre.
+# overlaps="clusters" agrega además los grupos de superposiciones (add_overlap_clusters).
+def run_analysis(polygons_gdf, report_stage=lambda stage: None, run_id=None, eager=EAGER_ARTIFACTS, key=None, capas=None, base=None, export_format=None, overlaps=None):
+    capas = capas or CAPAS_WFS
+    key = key or result_key(polygons_gdf, capas)
+    result = artifact_store.lookup(key, count=False)
+    if result is None:
+        work_dir = artifact_store.begin(key, run_id or uuid.uuid4().hex)
+        try:
+            result = _run_analysis(polygons_gdf, work_dir, report_stage, capas, base)
+        except Exception:
+            artifact_store.abort(work_dir)
+            raise
+        result = artifact_store.commit(key, work_dir, result)
+    if base is not None:
+        report_stage("diferencias")
+        with STAGE_SECONDS.time(stage="diferencias"):
+            result["diff"], result["diff_summary"] = write_analysis_diff(base, key)
+    add_exports(result, export_format)
+    add_overlap_clusters(result, overlaps)
+    if eager:
+        result["report_stats"] = render_artifacts(result, report_stage, export_format)
+    return result
+
+# Función para generar el mapa, el PDF, los archivos exportados y los grupos de superposiciones de un resultado de inmediato
+def render_artifacts(result, report_stage=lambda stage: None, export_format=None):
+    if export_format not in (None, "json"):
+        report_stage("exportacion")
+        for name, path in result.items():
+            if name.endswith(f"_{export_format}"):
+                render_artifact(path)
+    if "overlap_clusters" in result:
+        render_artifact(result["overlap_clusters"])
+    report_stage("mapa")
+    render_artifact(result["map_image"])
+    report_stage("reporte_pdf")
+    return render_artifact(result["report_pdf"])
+
+# Función para obtener las capas de cada fuente: las residentes se consultan en memoria con todos los bbox
+# a la vez y las demás se descargan en paralelo, una vez por fuente y bbox. Devuelve fuente -> GeoDataFrame
+# y fuente -> segundos hasta tener la capa completa.
+def _load_layers(sources, bboxes, crs):
+    layers = {}
+    seconds = {}
+    for source in sources:
+        start = time.perf_counter()
+        resident = layer_registry.query_many(source[0], source[1], bboxes)
+        if resident is not None:
+            layers[source] = resident
+            seconds[source] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    finished = {}
+    futures = {}
+    for source in sources:
+        if source in layers:
+            continue
+        for k, bbox in enumerate(bboxes):
+            future = submit_layer_fetch(source[0], source[1], bbox, crs, fetch=fetch_remote_layer)
+            future.add_done_callback(lambda done, source=source: finished.__setitem__(source, max(finished.get(source, 0), time.perf_counter())))
+            futures[(source, k)] = future
+    for source in sources:
+        if source not in layers:
+            parts = [futures[(source, k)].result() for k in range(len(bboxes))]
+            layers[source] = ensure_same_crs(merge_layer_parts(parts, crs), crs)
+            seconds[source] = finished.get(source, time.perf_counter()) - start
+    return layers, seconds
+
+# Función para cruzar los polígonos con las capas de capas. Devuelve clave -> registros y clave -> costo
+# (características consideradas, segundos de descarga y de cruce)
+def _intersect_layers(polygons_gdf, capas, crs, report_stage):
+    costs = {capa["clave"]: {"features": None, "fetch_seconds": None, "intersect_seconds": None} for capa in capas}
+    if polygons_gdf.empty or not capas:
+        return {capa["clave"]: [] for capa in capas}, costs
+
+    # Una consulta por grupo de polígonos cercanos en lugar de un solo bbox global
+    bboxes = plan_query_bboxes(polygons_gdf)
+
+    # Con CRUCES_WFS_STREAMING=1 las capas remotas se recorren por páginas y cada página se cruza antes de
+    # descargar la siguiente; las residentes se consultan en memoria como en el modo normal
+    streamed = [capa for capa in capas if WFS_STREAMING and not layer_registry.is_resident(capa["wfs_url"], capa["layer_name"])]
+    intersections = {}
+    if streamed:
+        start = time.perf_counter()
+        streamed_intersections, streamed_costs = stream_layer_intersections(
+            polygons_gdf,
+            {capa["clave"]: (capa["wfs_url"], capa["layer_name"], capa["nombre"], capa["campos"], capa.get("tipo")) for capa in streamed},
+            bboxes, crs
+        )
+        intersections.update(streamed_intersections)
+        for clave, cost in streamed_costs.items():
+            costs[clave].update(features=cost["features"], fetch_seconds=round(cost["fetch_seconds"], 3), intersect_seconds=round(cost["intersect_seconds"], 3))
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage="descarga_y_cruces")
+    loaded = [capa for capa in capas if capa not in streamed]
+
+    # Las capas con la misma fuente (estatales y municipales) comparten una sola descarga
+    sources = sorted({(capa["wfs_url"], capa["layer_name"]) for capa in loaded})
+    layers, fetch_seconds = _load_layers(sources, bboxes, crs) if loaded else ({}, {})
+    for capa in loaded:
+        source = (capa["wfs_url"], capa["layer_name"])
+        costs[capa["clave"]].update(features=len(layers[source]), fetch_seconds=round(fetch_seconds[source], 3))
+        STAGE_SECONDS.observe(fetch_seconds[source], stage="descarga_capa", capa=capa["clave"])
+    if loaded:
+        report_stage("cruces")
+    if PARALLEL_ENABLED and loaded:
+        # Las capas se cruzan a la vez en otros procesos: se mide el total, y cada capa informa la suma de sus bloques
+        with STAGE_SECONDS.time(stage="cruces"):
+            parallel_intersections, intersect_seconds = intersect_layers_parallel(
+                polygons_gdf,
+                {capa["clave"]: (layers[(capa["wfs_url"], capa["layer_name"])], capa["nombre"], capa["campos"], capa.get("tipo")) for capa in loaded}
+            )
+        intersections.update(parallel_intersections)
+        for clave, seconds in intersect_seconds.items():
+            costs[clave]["intersect_seconds"] = round(seconds, 3)
+    else:
+        for capa in loaded:
+            start = time.perf_counter()
+            layer = layers[(capa["wfs_url"], capa["layer_name"])]
+            intersections[capa["clave"]] = calculate_intersections(polygons_gdf, layer, capa["nombre"], capa["campos"], tipo_ordenamiento=capa.get("tipo"))
+            costs[capa["clave"]]["intersect_seconds"] = round(time.perf_counter() - start, 3)
+            STAGE_SECONDS.observe(time.perf_counter() - start, stage="cruce_capa", capa=capa["clave"])
+    intersections = {capa["clave"]: intersections[capa["clave"]] for capa in capas}
+    _count_intersections(intersections)
+    return intersections, costs
+
+# Función para sumar los registros de intersección de cada capa a las métricas
+def _count_intersections(intersections):
+    for clave, records in intersections.items():
+        INTERSECTIONS.inc(len(records), capa=clave)
+
+# Función para leer los polígonos guardados de un resultado en su orden original (FlatGeobuf con índice
+# espacial guarda las características en otro orden, así que se ordenan por id)
+def _read_polygons(directory, manifest):
+    return gpd.read_file(os.path.join(directory, manifest["polygons"])).sort_values('id').reset_index(drop=True)
+
+# Función para leer el manifiesto y los polígonos de un resultado publicado en el almacén
+def _load_result(key):
+    if artifact_store.lookup(key, count=False) is None:
+        raise ValueError(f"No existe el resultado {key}")
+    directory = artifact_store.path(key)
+    with open(os.path.join(directory, MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+    if "hashes" not in manifest:
+        manifest["hashes"] = feature_hashes(_read_polygons(directory, manifest))
+    return directory, manifest
+
+# Función para recuperar de un resultado anterior (base) lo que sigue siendo válido. Un polígono se reutiliza
+# si su huella (geometría y predio) aparece en la base; sus registros se renumeran con su nueva posición y
+# subpolígono. Los cruces de una capa solo se reutilizan si la huella de la capa no cambió, y las
+# superposiciones solo entre polígonos reutilizados. Devuelve la máscara de polígonos a recalcular,
+# clave -> registros reutilizados por capa y las superposiciones reutilizadas.
+def _reuse_base(polygons_gdf, hashes, capas, base):
+    directory, manifest = _load_result(base)
+    if manifest.get("analisis") != ANALYSIS_VERSION:
+        logger.info("El resultado base %s es de otra versión del análisis; se recalcula todo", base)
+        return np.ones(len(polygons_gdf), dtype=bool), {}, []
+    old_rows = {}
+    for row, feature_hash in enumerate(manifest["hashes"]):
+        old_rows.setdefault(feature_hash, row)
+    new_row = {}
+    for row, feature_hash in enumerate(hashes):
+        if feature_hash in old_rows and old_rows[feature_hash] not in new_row:
+            new_row[old_rows[feature_hash]] = row
+    recompute = np.ones(len(polygons_gdf), dtype=bool)
+    recompute[list(new_row.values())] = False
+    ids = polygons_gdf['id'].tolist()
+    subpoligono_ids = polygons_gdf['subpoligono_id'].tolist()
+
+    reused = {}
+    base_layers = manifest.get("capas", {})
+    for capa in capas:
+        clave = capa["clave"]
+        if clave not in manifest["intersections"] or base_layers.get(clave) != layer_fingerprint(capa):
+            continue
+        with open(os.path.join(directory, manifest["intersections"][clave])) as f:
+            records = json.load(f)
+        reused[clave] = []
+        for record in records:
+            row = new_row.get(record["Polygon_ID"] - 1)
+            if row is not None:
+                reused[clave].append({**record, "Polygon_ID": ids[row], "Subpoligono_ID": subpoligono_ids[row]})
+
+    with open(os.path.join(directory, manifest["overlaps"])) as f:
+        records = json.load(f)
+    overlaps = []
+    for record in records:
+        row1, row2 = new_row.get(record["Polygon1_ID"] - 1), new_row.get(record["Polygon2_ID"] - 1)
+        if row1 is None or row2 is None:
+            continue
+        # El polígono con la posición menor va primero, como en detect_overlaps
+        renumbered = dict(record)
+        for (row, prefix), target in zip(sorted([(row1, "Polygon1_"), (row2, "Polygon2_")]), ("Polygon1_", "Polygon2_")):
+            renumbered[target + "ID"] = ids[row]
+            renumbered[target + "Predio_ID"] = record[prefix + "Predio_ID"]
+            renumbered[target + "Subpoligono_ID"] = subpoligono_ids[row]
+        overlaps.append(renumbered)
+    logger.info("Análisis incremental sobre %s: %d de %d polígonos sin cambios", base, len(new_row), len(polygons_gdf))
+    return recompute, reused, overlaps
+
+# Análisis dentro de un directorio de trabajo; devuelve el resultado con rutas relativas a ese directorio.
+# Solo se consultan, cruzan y guardan las capas de capas; el resultado incluye el costo de cada capa
+# (características consideradas, segundos de descarga y de cruce, registros y bytes guardados).
+# Con base se reutilizan los registros de los polígonos sin cambios (ver _reuse_base).
+def _run_analysis(polygons_gdf, work_dir, report_stage, capas, base=None):
+    output_image = "mapa.png"
+    output_pdf = "reporte.pdf"
+    json_superposiciones = "superposiciones.json"
+    polygons_file = "poligonos.fgb"
+
+    crs_target = 'EPSG:4326'
+    polygons_gdf = ensure_same_crs(polygons_gdf, crs_target)
+    hashes = feature_hashes(polygons_gdf)
+    report_stage("descarga_capas")
+
+    if base is None:
+        intersections, costs = _intersect_layers(polygons_gdf, capas, crs_target, report_stage)
+        report_stage("superposiciones")
+        with STAGE_SECONDS.time(stage="superposiciones"):
+            overlaps = detect_overlaps(polygons_gdf)
+    else:
+        # Los polígonos nuevos o modificados se cruzan con las capas reutilizables; las demás capas se
+        # cruzan completas
+        recompute, reused, reused_overlaps = _reuse_base(polygons_gdf, hashes, capas, base)
+        intersections, costs = _intersect_layers(polygons_gdf[recompute], [capa for capa in capas if capa["clave"] in reused], crs_target, report_stage)
+        full, full_costs = _intersect_layers(polygons_gdf, [capa for capa in capas if capa["clave"] not in reused], crs_target, report_stage)
+        intersections.update(full)
+        costs.update(full_costs)
+        for clave, records in reused.items():
+            intersections[clave] = sorted(records + intersections[clave], key=lambda record: record["Polygon_ID"])
+            costs[clave]["reused_records"] = len(records)
+        report_stage("superposiciones")
+        with STAGE_SECONDS.time(stage="superposiciones"):
+            overlaps = reused_overlaps + detect_overlaps(polygons_gdf, positions=np.flatnonzero(recompute))
+        overlaps.sort(key=lambda record: (record["Polygon1_ID"], record["Polygon2_ID"]))
+
+    report_stage("guardado")
+    POLYGONS.inc(len(polygons_gdf))
+    OVERLAPS.inc(len(overlaps))
+    start = time.perf_counter()
+    json_files = {}
+    for capa in capas:
+        json_files[capa["clave"]] = f"intersecciones_{capa['clave']}.json"
+        save_json(intersections[capa["clave"]], os.path.join(work_dir, json_files[capa["clave"]]))
+        artifact_store.precompress(os.path.join(work_dir, json_files[capa["clave"]]))
+        costs[capa["clave"]].update(records=len(intersections[capa["clave"]]), bytes=os.path.getsize(os.path.join(work_dir, json_files[capa["clave"]])))
+    save_json(overlaps, os.path.join(work_dir, json_superposiciones))
+    artifact_store.precompress(os.path.join(work_dir, json_superposiciones))
+    # Lo necesario para generar el mapa y el PDF después (polígonos, resultados y nombres de salida) y para
+    # reutilizar este resultado en un análisis incremental (huellas de polígonos y capas)
+    polygons_gdf.astype({'predio_id': str, 'subpoligono_id': str}).to_file(os.path.join(work_dir, polygons_file), driver='FlatGeobuf')
+    save_json({
+        "polygons": polygons_file,
+        "intersections": json_files,
+        "overlaps": json_superposiciones,
+        "map_image": output_image,
+        "report_pdf": output_pdf,
+        "analisis": ANALYSIS_VERSION,
+        "capas": {capa["clave"]: layer_fingerprint(capa) for capa in capas},
+        "subpoligonos": polygons_gdf['subpoligono_id'].astype(str).tolist(),
+        "hashes": hashes
+    }, os.path.join(work_dir, MANIFEST_FILE))
+    STAGE_SECONDS.observe(time.perf_counter() - start, stage="guardado")
+    for clave, cost in costs.items():
+        logger.info("Costo de la capa %s: %s", clave, cost)
+
+    return {
+        "map_image": output_image,
+        "report_pdf": output_pdf,
+        **{f"intersections_{clave}": json_file for clave, json_file in json_files.items()},
+        "overlaps": json_superposiciones,
+        "layer_costs": costs
+    }
+
+# Función para comparar dos listas de registros. key identifica cada registro entre los dos resultados
+# (las posiciones de los polígonos pueden cambiar) y value lo que se compara de él.
+def _diff_records(old, new, key, value):
+    def index(records):
+        indexed = {}
+        for record in records:
+            k = key(record)
+            occurrence = 0
+            while (k, occurrence) in indexed:
+                occurrence += 1
+            indexed[(k, occurrence)] = record
+        return indexed
+
+    old, new = index(old), index(new)
+    return {
+        "added": [record for k, record in new.items() if k not in old],
+        "removed": [record for k, record in old.items() if k not in new],
+        "modified": [{"before": old[k], "after": record} for k, record in new.items() if k in old and value(old[k]) != value(record)]
+    }
+
+# Función para escribir las diferencias entre un resultado anterior (base) y uno nuevo (key): polígonos
+# agregados, eliminados y modificados (por subpolígono), y registros de cruces y superposiciones agregados,
+# eliminados o con otros valores. Devuelve la ruta del archivo y un resumen con el número de cambios.
+def write_analysis_diff(base, key):
+    base_dir, base_manifest = _load_result(base)
+    directory, manifest = _load_result(key)
+    if "subpoligonos" not in base_manifest:
+        base_manifest["subpoligonos"] = _read_polygons(base_dir, base_manifest)['subpoligono_id'].tolist()
+
+    old_features = dict(zip(base_manifest["subpoligonos"], base_manifest["hashes"]))
+    new_features = dict(zip(manifest["subpoligonos"], manifest["hashes"]))
+    diff = {
+        "base": base,
+        "features": {
+            "added": [feature for feature in new_features if feature not in old_features],
+            "removed": [feature for feature in old_features if feature not in new_features],
+            "modified": [feature for feature, feature_hash in new_features.items() if feature in old_features and old_features[feature] != feature_hash],
+            "unchanged": sum(1 for feature, feature_hash in new_features.items() if old_features.get(feature) == feature_hash)
+        },
+        "intersections": {},
+        "overlaps": None
+    }
+
+    def load(result_dir, name):
+        if name is None:
+            return []
+        with open(os.path.join(result_dir, name)) as f:
+            return json.load(f)
+
+    for clave, json_file in manifest["intersections"].items():
+        diff["intersections"][clave] = _diff_records(
+            load(base_dir, base_manifest["intersections"].get(clave)), load(directory, json_file),
+            key=lambda record: (record["Subpoligono_ID"], record["Feature_ID"]),
+            value=lambda record: {field: value for field, value in record.items() if field != "Polygon_ID"}
+        )
+    diff["overlaps"] = _diff_records(
+        load(base_dir, base_manifest["overlaps"]), load(directory, manifest["overlaps"]),
+        key=lambda record: tuple(sorted((record["Polygon1_Subpoligono_ID"], record["Polygon2_Subpoligono_ID"]))),
+        value=lambda record: (record["Overlap_Area_Degrees"], record["Overlap_Area_M2"])
+    )
+
+    # El archivo depende de la base, así que se guarda junto al resultado con su nombre; se escribe de forma atómica
+    path = os.path.join(directory, f"diferencias_{base[:16]}.json")
+    tmp_path = os.path.join(directory, f".{threading.get_ident()}.diferencias_{base[:16]}.json")
+    save_json(diff, tmp_path)
+    os.replace(tmp_path, path)
+    artifact_store.precompress(path)
+    artifact_store.add_file(path)
+    summary = {
+        "features": {name: len(value) if isinstance(value, list) else value for name, value in diff["features"].items()},
+        "intersections": {clave: {name: len(records) for name, records in changes.items()} for clave, changes in diff["intersections"].items()},
+        "overlaps": {name: len(records) for name, records in diff["overlaps"].items()}
+    }
+    return path, summary
+
+# Función para leer el manifiesto del directorio de una ruta, o None si no es un resultado
+def _read_manifest(directory):
+    try:
+        with open(os.path.join(directory, MANIFEST_FILE)) as f:
+            return json.load(f)
+    except (FileNotFoundError, NotADirectoryError, json.JSONDecodeError):
+        return None
+
+# Función para leer el manifiesto del directorio de un artefacto, o None si la ruta no es un mapa o PDF de un resultado
+def _artifact_manifest(path):
+    directory, name = os.path.split(path)
+    manifest = _read_manifest(directory)
+    if manifest is None or name not in (manifest["map_image"], manifest["report_pdf"]):
+        return None
+    return manifest
+
+# Función para reconocer un archivo exportado de un resultado: devuelve (manifiesto, archivo JSON de origen,
+# formato, clave de la capa o None para las superposiciones), o None si la ruta no es un archivo exportado
+def _export_source(path):
+    directory, name = os.path.split(path)
+    parsed = parse_export_name(name)
+    if parsed is None:
+        return None
+    json_name, export_format = parsed
+    manifest = _read_manifest(directory)
+    if manifest is None:
+        return None
+    if json_name == manifest["overlaps"]:
+        return manifest, json_name, export_format, None
+    for clave, json_file in manifest["intersections"].items():
+        if json_file == json_name:
+            return manifest, json_name, export_format, clave
+    return None
+
+# Función para reconocer el archivo de grupos de superposiciones de un resultado: devuelve el manifiesto, o None
+def _clusters_manifest(path):
+    directory, name = os.path.split(path)
+    manifest = _read_manifest(directory)
+    if manifest is None or name != CLUSTERS_PREFIX + manifest["overlaps"]:
+        return None
+    return manifest
+
+# Función para saber si una ruta corresponde a un mapa, PDF, archivo exportado o grupos de superposiciones de un
+# resultado que aún no se genera
+def is_pending_artifact(path):
+    return not os.path.exists(path) and (_artifact_manifest(path) is not None or _export_source(path) is not None
+                                         or _clusters_manifest(path) is not None)
+
+# Función para escribir un archivo exportado a partir del JSON de un resultado. En geoparquet se incluye la
+# geometría de cada intersección: la de los dos polígonos en las superposiciones, y la del polígono con la
+# característica de la capa (consultada de nuevo, normalmente desde memoria o la caché de teselas) en los cruces.
+def _render_export(directory, manifest, json_name, export_format, clave, output_path):
+    with open(os.path.join(directory, json_name)) as f:
+        records = json.load(f)
+    columns = OVERLAP_COLUMNS if clave is None else INTERSECTION_COLUMNS
+    geometries = None
+    if export_format == "geoparquet":
+        polygons = _read_polygons(directory, manifest).geometry.values
+        if clave is None:
+            geometries = shapely.intersection(
+                polygons[np.array([record["Polygon1_ID"] - 1 for record in records], dtype=np.intp)],
+                polygons[np.array([record["Polygon2_ID"] - 1 for record in records], dtype=np.intp)]
+            )
+        else:
+            capa = next((capa for capa in CAPAS_WFS if capa["clave"] == clave), None)
+            if capa is None:
+                raise ValueError(f"La capa {clave} ya no está en capas.json")
+            positions = np.array([record["Polygon_ID"] - 1 for record in records], dtype=np.intp)
+            features = np.full(len(records), None, dtype=object)
+            if len(records):
+                source = (capa["wfs_url"], capa["layer_name"])
+                involved = gpd.GeoDataFrame(geometry=polygons[np.unique(positions)], crs='EPSG:4326')
+                layers, _ = _load_layers([source], plan_query_bboxes(involved), 'EPSG:4326')
+                by_id = dict(zip(layers[source]['id'], layers[source].geometry.values))
+                features[:] = [by_id.get(record["Feature_ID"]) for record in records]
+            geometries = shapely.intersection(polygons[positions], features)
+    write_export(records, output_path, export_format, columns, geometries)
+
+# Función para generar un artefacto pendiente (mapa, PDF, archivo exportado o grupos de superposiciones) a partir del manifiesto de su
+# directorio. Las descargas simultáneas del mismo archivo esperan a una sola generación; el archivo se escribe
+# de forma atómica. Devuelve las estadísticas del PDF, o None para los demás o si el artefacto ya estaba generado.
+def render_artifact(path):
+    with _render_lock:
+        lock = _render_locks.setdefault(path, threading.Lock())
+    with lock:
+        try:
+            if not is_pending_artifact(path):
+                return None
+            directory, name = os.path.split(path)
+            manifest = _artifact_manifest(path)
+            tmp_path = os.path.join(directory, f".{threading.get_ident()}.{name}")
+            stats = None
+            start = time.perf_counter()
+            try:
+                clusters_manifest = _clusters_manifest(path) if manifest is None else None
+                if clusters_manifest is not None:
+                    with open(os.path.join(directory, clusters_manifest["overlaps"])) as f:
+                        save_json(overlap_clusters(json.load(f)), tmp_path)
+                elif manifest is None:
+                    _render_export(directory, *_export_source(path), tmp_path)
+                elif name == manifest["map_image"]:
+                    generate_map_image(_read_polygons(directory, manifest), tmp_path)
+                else:
+                    # El PDF incluye el mapa, que se genera primero si aún no existe
+                    polygons_gdf = _read_polygons(directory, manifest)
+                    output_image = os.path.join(directory, manifest["map_image"])
+                    render_artifact(output_image)
+                    start = time.perf_counter()
+                    intersections = {}
+                    for clave, json_file in manifest["intersections"].items():
+                        with open(os.path.join(directory, json_file)) as f:
+                            intersections[clave] = json.load(f)
+                    with open(os.path.join(directory, manifest["overlaps"])) as f:
+                        overlaps = json.load(f)
+                    stats = generate_pdf(polygons_gdf, tmp_path, output_image, intersections, overlaps)
+                os.replace(tmp_path, path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            artifact_store.add_file(path)
+            STAGE_SECONDS.observe(time.perf_counter() - start, stage="exportacion" if manifest is None else "mapa" if name == manifest["map_image"] else "reporte_pdf")
+            logger.info("Artefacto generado bajo demanda: %s", path)
+            return stats
+        finally:
+            with _render_lock:
+                _render_locks.pop(path, None)
@@ -0,0 +1,250 @@
+import logging
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import shapely
+from fpdf import FPDF
+
+from areas import area_m2, perimeter_m, format_area_m2, format_length_m
+from capas import CAPAS, report_sections
+
+logger = logging.getLogger(__name__)
+
+# Coordenadas en el reporte: 'apendice' (tabla compacta al final) o 'ninguna'
+PDF_COORDINATES = os.environ.get("CRUCES_PDF_COORDENADAS", "apendice")
+# Vértices por subpolígono que se listan en el apéndice; el resto se resume en una fila
+PDF_VERTEX_CAP = int(os.environ.get("CRUCES_PDF_MAX_VERTICES", "20"))
+VERTICES_PER_ROW = 4
+# Filas por tabla; las demás se resumen en una fila final (el detalle completo está en los archivos JSON)
+PDF_MAX_ROWS = int(os.environ.get("CRUCES_PDF_MAX_FILAS", "20000"))
+
+# Tamaño de letra y alto de fila de las tablas
+TABLE_FONT_SIZE = 7
+ROW_HEIGHT = 4
+# Ancho medio aproximado de un carácter (mm) con TABLE_FONT_SIZE, para recortar textos sin medirlos uno por uno
+CHAR_WIDTH = 1.35
+
+# Descripción de las secciones de intersecciones: clave del resultado, título y campos (campo, etiqueta), según capas.json
+REPORT_SECTIONS = report_sections(CAPAS)
+
+# Función para sanitizar el texto
+def sanitize_text(text):
+    return text.encode('latin-1', 'replace').decode('latin-1')
+
+# Búfer del documento para FPDF: fpdf 1.7 concatena cada objeto a una sola cadena (self.buffer += ...),
+# lo que vuelve cuadrática la escritura de reportes con cientos de páginas. Se acumulan los fragmentos
+# en una lista y solo se unen al guardar el archivo.
+class _DocumentBuffer:
+    def __init__(self):
+        self.chunks = []
+        self.length = 0
+
+    def __iadd__(self, text):
+        self.chunks.append(text)
+        self.length += len(text)
+        return self
+
+    def __len__(self):
+        return self.length
+
+    def __str__(self):
+        return ''.join(self.chunks)
+
+    def encode(self, encoding):
+        return str(self).encode(encoding)
+
+# Clase personalizada para el PDF
+class PDF(FPDF):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if isinstance(getattr(self, 'buffer', None), str):
+            self.buffer = _DocumentBuffer()
+
+    def header(self):
+        self.set_font('Arial', 'B', 12)
+        self.cell(0, 10, sanitize_text('Reporte de Polígonos GeoJSON y Cruce Espacial'), 0, 1, 'C')
+
+    def footer(self):
+        self.set_y(-15)
+        self.set_font('Arial', 'I', 8)
+        self.cell(0, 10, sanitize_text(f'Página {self.page_no()}'), 0, 0, 'C')
+
+    # Título de sección en una página nueva
+    def section_title(self, title, orientation='P'):
+        self.add_page(orientation)
+        self.set_font('Arial', 'B', 12)
+        self.cell(0, 10, sanitize_text(title), 0, 1, 'C')
+        self.ln(2)
+
+    def _table_header(self, columns, widths):
+        self.set_font('Arial', 'B', TABLE_FONT_SIZE)
+        for label, width in zip(columns, widths):
+            self.cell(width, ROW_HEIGHT + 1, _fit(label, width), border=1, align='C')
+        self.ln()
+        self.set_font('Arial', size=TABLE_FONT_SIZE)
+
+    # Tabla de ancho fijo: una celda por columna y fila, sin multi_cell; el encabezado se repite en cada página.
+    # rows es un iterable de tuplas de textos ya formateados; total permite resumir las filas omitidas.
+    def table(self, columns, widths, rows, total=None):
+        bottom = self.h - self.b_margin
+        self._table_header(columns, widths)
+        written = 0
+        for row in rows:
+            if written >= PDF_MAX_ROWS:
+                break
+            if self.get_y() + ROW_HEIGHT > bottom:
+                self.add_page(self.cur_orientation)
+                self._table_header(columns, widths)
+            for text, width in zip(row, widths):
+                self.cell(width, ROW_HEIGHT, _fit(text, width), border=1)
+            self.ln()
+            written += 1
+        if total is not None and total > written:
+            self.set_font('Arial', 'I', TABLE_FONT_SIZE)
+            self.cell(sum(widths), ROW_HEIGHT, sanitize_text(f"... {total - written} filas omitidas; el detalle completo está en los archivos JSON."), border=1, ln=1)
+            self.set_font('Arial', size=TABLE_FONT_SIZE)
+        return written
+
+# Función para recortar un texto al ancho de su columna sin medirlo con la fuente
+def _fit(text, width):
+    max_chars = max(1, int(width / CHAR_WIDTH))
+    if len(text) > max_chars:
+        text = text[:max(1, max_chars - 3)] + '...'
+    return sanitize_text(text)
+
+# Función para repartir el ancho disponible: las columnas fijas conservan su ancho y las demás se reparten el resto
+def _column_widths(fixed, n_flexible, total_width):
+    remaining = max(total_width - sum(fixed), 0)
+    return list(fixed) + [remaining / n_flexible] * n_flexible if n_flexible else list(fixed)
+
+def _format_values(values, formatter=str):
+    return [formatter(value) if value is not None else 'N/A' for value in values]
+
+# Función para escribir la tabla de resumen de predios y subpolígonos (áreas y perímetros en un solo cálculo)
+def _polygons_section(pdf, polygons_gdf):
+    geometries = polygons_gdf.geometry.values
+    summary = pd.DataFrame({
+        'predio_id': polygons_gdf['predio_id'].astype(str).values,
+        'subpoligono_id': polygons_gdf['subpoligono_id'].astype(str).values,
+        'area': shapely.area(geometries),
+        'area_m2': area_m2(geometries),
+        'perimeter_m': perimeter_m(geometries),
+        'vertices': shapely.get_num_coordinates(geometries)
+    }).sort_values('predio_id', kind='stable')
+
+    pdf.section_title("Resumen de Predios")
+    predios = summary.groupby('predio_id', sort=True).agg(subpoligonos=('subpoligono_id', 'size'), area_m2=('area_m2', 'sum'), perimeter_m=('perimeter_m', 'sum'))
+    rows = zip(predios.index, _format_values(predios['subpoligonos']), _format_values(predios['area_m2'], format_area_m2), _format_values(predios['perimeter_m'], format_length_m))
+    pdf.table(["Predio", "Subpolígonos", "Área total (m²)", "Suma de perímetros"], _column_widths([], 4, pdf.w - pdf.l_margin - pdf.r_margin), rows, total=len(predios))
+
+    pdf.section_title("Subpolígonos")
+    rows = zip(summary['predio_id'], summary['subpoligono_id'], _format_values(summary['area'], lambda value: f"{value:.6f}"),
+               _format_values(summary['area_m2'], format_area_m2), _format_values(summary['perimeter_m'], format_length_m), _format_values(summary['vertices']))
+    pdf.table(["Predio", "Subpolígono", "Área (grados cuadrados)", "Área (m²)", "Perímetro", "Vértices"],
+              _column_widths([], 6, pdf.w - pdf.l_margin - pdf.r_margin), rows, total=len(summary))
+
+# Función para escribir una sección de intersecciones según su descripción en REPORT_SECTIONS
+def _intersections_section(pdf, section, records):
+    pdf.section_title(section['titulo'], orientation='L')
+    frame = pd.DataFrame.from_records(records[:PDF_MAX_ROWS])
+    fields = section['campos']
+    columns = ["Polígono", "Predio", "Subpolígono", "Característica", "Área (grados cuadrados)", "Área (m²)"] + [label for _, label in fields]
+    widths = _column_widths([14, 28, 28, 28, 24, 28], len(fields), pdf.w - pdf.l_margin - pdf.r_margin)
+    values = [
+        _format_values(frame['Polygon_ID']),
+        _format_values(frame['Predio_ID']),
+        _format_values(frame['Subpoligono_ID']),
+        _format_values(frame['Feature_ID']),
+        _format_values(frame['Intersection_Area_Degrees'], lambda value: f"{value:.6f}"),
+        _format_values(frame['Intersection_Area_M2'], format_area_m2)
+    ] + [_format_values(frame[field]) if field in frame.columns else ['N/A'] * len(frame) for field, _ in fields]
+    pdf.table(columns, widths, zip(*values), total=len(records))
+
+# Función para escribir la tabla de superposiciones entre polígonos
+def _overlaps_section(pdf, overlaps):
+    pdf.section_title("Superposiciones entre Polígonos", orientation='L')
+    frame = pd.DataFrame.from_records(overlaps[:PDF_MAX_ROWS])
+    columns = ["Polígono 1", "Predio 1", "Subpolígono 1", "Polígono 2", "Predio 2", "Subpolígono 2", "Área (grados cuadrados)", "Área (m²)"]
+    values = [
+        _format_values(frame['Polygon1_ID']), _format_values(frame['Polygon1_Predio_ID']), _format_values(frame['Polygon1_Subpoligono_ID']),
+        _format_values(frame['Polygon2_ID']), _format_values(frame['Polygon2_Predio_ID']), _format_values(frame['Polygon2_Subpoligono_ID']),
+        _format_values(frame['Overlap_Area_Degrees'], lambda value: f"{value:.6f}"),
+        _format_values(frame['Overlap_Area_M2'], format_area_m2)
+    ]
+    pdf.table(columns, _column_widths([], len(columns), pdf.w - pdf.l_margin - pdf.r_margin), zip(*values), total=len(overlaps))
+
+# Función para escribir el apéndice de coordenadas: anillo exterior de cada parte en filas de
+# VERTICES_PER_ROW vértices, con a lo más PDF_VERTEX_CAP vértices por subpolígono
+def _coordinates_appendix(pdf, polygons_gdf):
+    pdf.section_title("Apéndice: Coordenadas de los Subpolígonos")
+    parts, geom_index = shapely.get_parts(polygons_gdf.geometry.values, return_index=True)
+    coords, ring_index = shapely.get_coordinates(shapely.get_exterior_ring(parts), return_index=True)
+    geom_of_vertex = geom_index[ring_index]
+    # Número de vértice dentro de su subpolígono y dentro de su anillo
+    vertex_number = np.arange(len(coords)) - np.searchsorted(geom_of_vertex, geom_of_vertex, side='left')
+    ring_position = np.arange(len(coords)) - np.searchsorted(ring_index, ring_index, side='left')
+    part_number = np.arange(len(parts)) - np.searchsorted(geom_index, geom_index, side='left')
+
+    subpoligonos = polygons_gdf['subpoligono_id'].astype(str).values
+    counts = np.bincount(geom_of_vertex, minlength=len(polygons_gdf))
+    kept = np.flatnonzero(vertex_number < PDF_VERTEX_CAP)
+    # Cada fila agrupa vértices consecutivos de un mismo anillo
+    row_key = ring_index[kept] * (PDF_VERTEX_CAP + 1) + ring_position[kept] // VERTICES_PER_ROW
+    row_starts = np.flatnonzero(np.r_[True, row_key[1:] != row_key[:-1]])
+    row_ends = np.r_[row_starts[1:], len(kept)]
+
+    def omitted(geom):
+        return (subpoligonos[geom], '', '', f"... {counts[geom] - PDF_VERTEX_CAP} vértices más") + ('',) * (VERTICES_PER_ROW - 1)
+
+    def rows():
+        last_geom = -1
+        for start, end in zip(row_starts, row_ends):
+            vertices = kept[start:end]
+            geom = geom_of_vertex[vertices[0]]
+            if geom != last_geom and last_geom >= 0 and counts[last_geom] > PDF_VERTEX_CAP:
+                yield omitted(last_geom)
+            last_geom = geom
+            texts = [f"{coords[k, 0]:.7f}, {coords[k, 1]:.7f}" for k in vertices]
+            yield (subpoligonos[geom], str(part_number[ring_index[vertices[0]]] + 1),
+                   f"{vertex_number[vertices[0]] + 1}-{vertex_number[vertices[-1]] + 1}",
+                   *texts, *([''] * (VERTICES_PER_ROW - len(texts))))
+        if last_geom >= 0 and counts[last_geom] > PDF_VERTEX_CAP:
+            yield omitted(last_geom)
+
+    columns = ["Subpolígono", "Parte", "Vértices"] + ["Longitud, latitud" for _ in range(VERTICES_PER_ROW)]
+    widths = _column_widths([36, 10, 16], VERTICES_PER_ROW, pdf.w - pdf.l_margin - pdf.r_margin)
+    pdf.table(columns, widths, rows(), total=len(row_starts) + int((counts > PDF_VERTEX_CAP).sum()))
+
+# Función para generar el PDF a partir de la descripción de secciones; intersections es un diccionario
+# clave -> registros. Devuelve el tiempo de generación y el número de páginas.
+def generate_pdf(polygons_gdf, output_pdf, output_image, intersections, overlaps, sections=REPORT_SECTIONS):
+    start = time.perf_counter()
+    pdf = PDF()
+    pdf.set_auto_page_break(auto=True, margin=10)
+    pdf.set_font("Arial", size=10)
+
+    # Verificar si el archivo de imagen existe antes de agregarlo
+    if os.path.exists(output_image):
+        pdf.add_page()
+        pdf.image(output_image, x=10, y=20, w=180)
+    else:
+        print(f"Error: El archivo de imagen '{output_image}' no se encontró.")
+
+    # Las tablas controlan sus propios saltos de página para repetir el encabezado
+    pdf.set_auto_page_break(auto=False, margin=15)
+    _polygons_section(pdf, polygons_gdf)
+    for section in sections:
+        records = intersections.get(section['clave'])
+        if records:
+            _intersections_section(pdf, section, records)
+    if overlaps:
+        _overlaps_section(pdf, overlaps)
+    if PDF_COORDINATES == 'apendice':
+        _coordinates_appendix(pdf, polygons_gdf)
+
+    pdf.output(output_pdf)
+    stats = {'pages': pdf.page_no(), 'seconds': round(time.perf_counter() - start, 3)}
+    logger.info("Reporte PDF %s: %d páginas en %.2f s", output_pdf, stats['pages'], stats['seconds'])
+    return stats
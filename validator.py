@@ -1,8 +1,13 @@
+import itertools
 import json
 import logging
+import os
+from typing import Union
+import numpy as np
+import shapely
 from pydantic import BaseModel, field_validator, ValidationError as PydanticValidationError
 from shapely.geometry import shape, Polygon, MultiPolygon
-from jsonschema import validate, ValidationError as JsonSchemaValidationError
+from jsonschema import Draft7Validator
 
 # Configuración básica del logger
 logging.basicConfig(level=logging.INFO)
@@ -36,59 +41,113 @@ geojson_schema = {
     "required": ["type", "features"]
 }
 
-# Función para validar GeoJSON
+# Validador del esquema compilado una sola vez al importar el módulo
+Draft7Validator.check_schema(geojson_schema)
+geojson_validator = Draft7Validator(geojson_schema)
+
+# Número máximo de errores por feature que se registran en el log o se devuelven en un reporte
+MAX_ERROR_REPORTS = int(os.environ.get("CRUCES_MAX_ERROR_REPORTS", "20"))
+MAX_ERROR_LENGTH = 200
+# Reparación de geometrías inválidas con make_valid en lugar de descartarlas (CRUCES_REPAIR_GEOMETRIES=1)
+REPAIR_GEOMETRIES = os.environ.get("CRUCES_REPAIR_GEOMETRIES", "0") == "1"
+
+def _truncate(text):
+    return text if len(text) <= MAX_ERROR_LENGTH else text[:MAX_ERROR_LENGTH] + "..."
+
+# Función para validar GeoJSON con el esquema compilado; el mensaje incluye a lo más MAX_ERROR_REPORTS errores
 def validate_geojson(geojson):
     try:
         if isinstance(geojson, str):
             geojson_dict = json.loads(geojson)
         else:
             geojson_dict = geojson
-        
-        validate(instance=geojson_dict, schema=geojson_schema)
-        logger.info("GeoJSON es válido.")
-        return geojson_dict
-    except (json.JSONDecodeError, JsonSchemaValidationError) as e:
+    except json.JSONDecodeError as e:
         logger.error(f"GeoJSON no es válido: {e}")
         raise ValueError(f"GeoJSON no es válido: {e}")
 
+    errors = list(itertools.islice(geojson_validator.iter_errors(geojson_dict), MAX_ERROR_REPORTS))
+    if errors:
+        messages = [f"{'/'.join(str(p) for p in e.absolute_path) or '(raíz)'}: {_truncate(e.message)}" for e in errors]
+        logger.error("GeoJSON no es válido: %s", "; ".join(messages))
+        raise ValueError(f"GeoJSON no es válido: {'; '.join(messages)}")
+    logger.info("GeoJSON es válido.")
+    return geojson_dict
+
 # Función para verificar la topología de los polígonos
 def check_topology(geometry):
     if isinstance(geometry, (Polygon, MultiPolygon)):
         if not geometry.is_valid:
-            logger.error(f"Geometría no válida: {geometry}")
+            logger.error(f"Geometría no válida: {_truncate(shapely.is_valid_reason(geometry))}")
             return False
         return True
     else:
         logger.error("Tipo de geometría no soportado para la validación.")
         return False
 
-# Clase para la validación del input
-class GeoJSONInput(BaseModel):
-    geojson: str
+# Función para verificar la topología de un arreglo de geometrías con una sola llamada vectorizada.
+# Con repair=True las inválidas se reparan por lotes con make_valid (solo se conserva la parte poligonal).
+# Devuelve las geometrías (reparadas o no), la máscara de las que se conservan y un reporte acotado
+# a MAX_ERROR_REPORTS errores; positions indica el número de feature de cada geometría para el reporte.
+def check_topology_bulk(geometries, repair=False, positions=None):
+    geometries = np.array(geometries, dtype=object)
+    positions = np.arange(len(geometries)) if positions is None else np.asarray(positions)
+    valid = shapely.is_valid(geometries)
+    invalid = np.flatnonzero(~valid)
+    report = {'invalid': int(len(invalid)), 'repaired': 0, 'errors': []}
+    if len(invalid) == 0:
+        return geometries, valid, report
 
-    @field_validator('geojson')
-    def validate_geojson_input(cls, value):
-        try:
-            # Intenta cargar el JSON para validar su formato
-            geojson_data = json.loads(value)
-            
-            if not isinstance(geojson_data, dict) or 'type' not in geojson_data or geojson_data['type'] != 'FeatureCollection':
-                raise ValueError('El GeoJSON debe ser de tipo FeatureCollection.')
+    reported = invalid[:MAX_ERROR_REPORTS]
+    for k, reason in zip(reported, shapely.is_valid_reason(geometries[reported])):
+        report['errors'].append({'feature': int(positions[k]), 'reason': _truncate(reason)})
+
+    if repair:
+        repaired = shapely.make_valid(geometries[invalid], method='structure', keep_collapsed=False)
+        ok = ~shapely.is_empty(repaired) & shapely.is_valid(repaired)
+        geometries[invalid[ok]] = repaired[ok]
+        valid[invalid[ok]] = True
+        report['repaired'] = int(ok.sum())
 
-            if 'features' not in geojson_data or not isinstance(geojson_data['features'], list):
-                raise ValueError('El GeoJSON debe contener una lista de features.')
+    logger.error("Geometrías no válidas: %d (%d reparadas, %d descartadas). Primeros errores: %s",
+                 len(invalid), report['repaired'], len(invalid) - report['repaired'],
+                 "; ".join(f"feature {e['feature']}: {e['reason']}" for e in report['errors']))
+    return geometries, valid, report
 
-            # Validación del esquema GeoJSON
-            validate_geojson(geojson_data)
+# Función para verificar que los datos decodificados sean un FeatureCollection con el esquema esperado
+def check_feature_collection(geojson_data):
+    if not isinstance(geojson_data, dict) or 'type' not in geojson_data or geojson_data['type'] != 'FeatureCollection':
+        raise ValueError('El GeoJSON debe ser de tipo FeatureCollection.')
 
-            return value
-        except json.JSONDecodeError:
-            raise ValueError('El GeoJSON no es válido.')
+    if 'features' not in geojson_data or not isinstance(geojson_data['features'], list):
+        raise ValueError('El GeoJSON debe contener una lista de features.')
+
+    # Validación del esquema GeoJSON
+    return validate_geojson(geojson_data)
+
+# Función para decodificar el cuerpo de una solicitud con una sola lectura del JSON. Acepta el
+# FeatureCollection como JSON nativo o el formato anterior {"geojson": "<FeatureCollection como texto>"}
+def parse_request_body(body):
+    try:
+        data = json.loads(body)
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        raise ValueError('El GeoJSON no es válido.')
+    if isinstance(data, dict) and 'geojson' in data and 'features' not in data:
+        return GeoJSONInput.parse_geojson(GeoJSONInput(geojson=data['geojson']))
+    return check_feature_collection(data)
+
+# Clase para la validación del input en el formato anterior; geojson puede ser texto o el objeto ya decodificado
+class GeoJSONInput(BaseModel):
+    geojson: Union[dict, str]
+
+    @field_validator('geojson')
+    def validate_geojson_input(cls, value):
+        if isinstance(value, str):
+            try:
+                value = json.loads(value)
+            except json.JSONDecodeError:
+                raise ValueError('El GeoJSON no es válido.')
+        return check_feature_collection(value)
 
     @classmethod
     def parse_geojson(cls, data):
-        try:
-            geojson_data = json.loads(data.geojson)
-            return geojson_data
-        except json.JSONDecodeError:
-            raise ValueError('El GeoJSON no es válido.')
+        return data.geojson
@@ -0,0 +1,72 @@
+import io
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Precalentamiento al iniciar la API (CRUCES_WARMUP=0 lo limita a cargar las capas residentes)
+WARMUP_ENABLED = os.environ.get("CRUCES_WARMUP", "1") != "0"
+
+_warmed = False
+_warm_lock = threading.Lock()
+
+# Función para preparar matplotlib sin pantalla: backend Agg, caché de fuentes y un primer dibujo con texto
+def _warm_matplotlib():
+    import matplotlib
+    matplotlib.use("Agg")
+    from matplotlib import font_manager
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    font_manager.findfont(font_manager.FontProperties())
+    fig = Figure(figsize=(1, 1))
+    FigureCanvasAgg(fig)
+    ax = fig.subplots()
+    ax.plot([0, 1], [0, 1])
+    ax.set_title('Mapa')
+    fig.savefig(io.BytesIO(), format='png')
+
+# Función para cargar la base de datos de CRS de pyproj y las transformaciones del cálculo de áreas
+def _warm_pyproj():
+    import pyproj
+    import shapely
+    from areas import area_m2
+    pyproj.CRS.from_user_input('EPSG:4326')
+    # Un polígono pequeño (factor de escala local) y uno extenso (reproyección equivalente)
+    area_m2([shapely.box(-99.1, 19.4, -99.09, 19.41), shapely.box(-104.0, 18.0, -100.0, 22.0)])
+
+# Función para preparar la generación del PDF (fuentes base de fpdf)
+def _warm_pdf():
+    from report import PDF
+    pdf = PDF()
+    pdf.add_page()
+    pdf.set_font("Arial", size=10)
+    pdf.cell(0, 10, "Reporte", 0, 1)
+    pdf.output(os.devnull)
+
+def _warm_owslib():
+    import owslib.wfs
+
+# Función para cargar en el proceso todo lo que la primera solicitud pagaría: las capas residentes, pyproj,
+# matplotlib y sus fuentes, fpdf y owslib. Se ejecuta una sola vez por proceso; si se llama en el proceso
+# principal antes de crear los procesos de trabajo (gunicorn.conf.py), estos heredan todo ya cargado y
+# comparten esa memoria (copy-on-write). full=False solo carga las capas residentes. Devuelve los segundos
+# de cada paso, o None si el proceso ya estaba precalentado.
+def warm_up(full=WARMUP_ENABLED):
+    global _warmed
+    with _warm_lock:
+        if _warmed:
+            return None
+        from pipeline import layer_registry
+        steps = [('capas', layer_registry.load)]
+        if full:
+            steps += [('pyproj', _warm_pyproj), ('matplotlib', _warm_matplotlib), ('pdf', _warm_pdf), ('owslib', _warm_owslib)]
+        timings = {}
+        for name, step in steps:
+            start = time.perf_counter()
+            step()
+            timings[name] = round(time.perf_counter() - start, 3)
+        _warmed = True
+        logger.info("Proceso %d precalentado: %s", os.getpid(), timings)
+        return timings
@@ -0,0 +1,208 @@
+import hashlib
+import logging
+import math
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import geopandas as gpd
+from shapely.geometry import box
+
+from cruces import query_wfs_layer, merge_layer_parts
+
+logger = logging.getLogger(__name__)
+
+# Tamaño de la celda de la malla de teselas (grados) y extensión de los archivos en disco
+DEFAULT_TILE_SIZE = 0.25
+# Teselas a partir de las cuales un bbox se consulta directo al WFS, sin pasar por la caché
+DEFAULT_MAX_TILES = 64
+TILE_EXTENSION = '.fgb'
+EMPTY_EXTENSION = '.empty'
+
+# Función para calcular las teselas de la malla fija que cubren un bbox
+def tiles_for_bbox(bbox, tile_size=DEFAULT_TILE_SIZE):
+    minx, miny, maxx, maxy = bbox
+    x0, y0 = math.floor(minx / tile_size), math.floor(miny / tile_size)
+    # Un borde máximo que cae justo en el límite de una tesela no agrega la fila o columna siguiente
+    x1, y1 = max(x0, math.ceil(maxx / tile_size) - 1), max(y0, math.ceil(maxy / tile_size) - 1)
+    return [(ix, iy) for iy in range(y0, y1 + 1) for ix in range(x0, x1 + 1)]
+
+# Función para obtener el bbox de una tesela de la malla
+def tile_bbox(tile, tile_size=DEFAULT_TILE_SIZE):
+    ix, iy = tile
+    return (ix * tile_size, iy * tile_size, (ix + 1) * tile_size, (iy + 1) * tile_size)
+
+# Función para agrupar teselas en rectángulos: primero tramos contiguos de cada fila y después los tramos
+# iguales de filas consecutivas. Devuelve una lista de (bbox en índices de tesela, teselas del rectángulo)
+def tile_runs(tiles):
+    runs = []
+    for iy in sorted({tile[1] for tile in tiles}):
+        columns = sorted(ix for ix, row in tiles if row == iy)
+        start = previous = columns[0]
+        for ix in columns[1:] + [None]:
+            if ix is not None and ix == previous + 1:
+                previous = ix
+                continue
+            runs.append((start, previous, iy))
+            if ix is not None:
+                start = previous = ix
+    rectangles = {}
+    for x0, x1, iy in runs:
+        rectangle = rectangles.pop((x0, x1, iy - 1), None)
+        y0 = rectangle[1] if rectangle else iy
+        rectangles[(x0, x1, iy)] = (x0, y0, x1, iy)
+    return [
+        (rectangle, [(ix, iy) for iy in range(rectangle[1], rectangle[3] + 1) for ix in range(rectangle[0], rectangle[2] + 1)])
+        for rectangle in sorted(rectangles.values(), key=lambda r: (r[1], r[0]))
+    ]
+
+# Caché persistente de capas WFS organizada en teselas de una malla fija
+class WFSTileCache:
+    def __init__(self, cache_dir, tile_size=DEFAULT_TILE_SIZE, max_bytes=2 * 1024 ** 3,
+                 default_ttl=24 * 3600, layer_ttl=None, fetch=query_wfs_layer, max_tiles=DEFAULT_MAX_TILES):
+        self.cache_dir = cache_dir
+        self.tile_size = tile_size
+        self.max_tiles = max_tiles
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.layer_ttl = dict(layer_ttl or {})
+        self.fetch = fetch
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.total_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_index()
+
+    # Reconstruye el índice LRU a partir de los archivos existentes, del más antiguo al más reciente
+    def _load_index(self):
+        found = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith((TILE_EXTENSION, EMPTY_EXTENSION)) and not name.startswith('.'):
+                    path = os.path.join(root, name)
+                    stat = os.stat(path)
+                    found.append((stat.st_mtime, os.path.relpath(path, self.cache_dir), stat.st_size))
+        for mtime, key, size in sorted(found):
+            self._entries[key] = {'created': mtime, 'size': size}
+            self.total_bytes += size
+        self._evict()
+
+    def ttl(self, layer_name):
+        return self.layer_ttl.get(layer_name, self.default_ttl)
+
+    def _tile_key(self, wfs_url, layer_name, tile, empty=False):
+        layer_dir = re.sub(r'[^A-Za-z0-9_.-]', '_', layer_name)
+        url_hash = hashlib.sha1(wfs_url.encode('utf-8')).hexdigest()[:12]
+        return os.path.join(layer_dir, f"{url_hash}_{self.tile_size:g}_{tile[0]}_{tile[1]}{EMPTY_EXTENSION if empty else TILE_EXTENSION}")
+
+    # Busca una tesela vigente en el índice y la marca como usada recientemente
+    def _lookup(self, wfs_url, layer_name, tile):
+        now = time.time()
+        with self._lock:
+            for empty in (False, True):
+                key = self._tile_key(wfs_url, layer_name, tile, empty)
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                if now - entry['created'] > self.ttl(layer_name):
+                    self._remove(key)
+                    continue
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return key
+            self.misses += 1
+        return None
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.total_bytes -= entry['size']
+        try:
+            os.remove(os.path.join(self.cache_dir, key))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self._entries:
+            key = next(iter(self._entries))
+            self._remove(key)
+            self.evictions += 1
+
+    # Guarda una tesela en disco (FlatGeobuf) de forma atómica y la registra en el índice
+    def _store(self, wfs_url, layer_name, tile, gdf):
+        key = self._tile_key(wfs_url, layer_name, tile, empty=gdf.empty)
+        path = os.path.join(self.cache_dir, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        directory, name = os.path.split(path)
+        tmp_path = os.path.join(directory, f".{threading.get_ident()}.{name}")
+        if gdf.empty:
+            open(tmp_path, 'wb').close()
+        else:
+            gdf.to_file(tmp_path, driver='FlatGeobuf')
+        os.replace(tmp_path, path)
+        size = os.path.getsize(path)
+        with self._lock:
+            if key in self._entries:
+                self.total_bytes -= self._entries.pop(key)['size']
+            self._entries[key] = {'created': time.time(), 'size': size}
+            self.total_bytes += size
+            self._evict()
+
+    # Consulta una capa a través de la caché: las teselas vigentes se leen de disco y las faltantes se agrupan en
+    # rectángulos que se descargan con una sola consulta cada uno y se reparten en teselas. Un bbox que cubre más
+    # de max_tiles teselas se consulta directo al WFS.
+    def query(self, wfs_url, layer_name, bbox, crs):
+        tiles = tiles_for_bbox(bbox, self.tile_size)
+        if self.max_tiles and len(tiles) > self.max_tiles:
+            logger.info("Caché WFS %s: el bbox cubre %d teselas (máximo %d); consulta directa", layer_name, len(tiles), self.max_tiles)
+            return self.fetch(wfs_url, layer_name, bbox, crs)
+
+        parts = []
+        missing = []
+        for tile in tiles:
+            key = self._lookup(wfs_url, layer_name, tile)
+            if key is not None and key.endswith(EMPTY_EXTENSION):
+                continue
+            if key is not None:
+                try:
+                    parts.append(gpd.read_file(os.path.join(self.cache_dir, key)))
+                    continue
+                except Exception as e:
+                    # La tesela pudo ser desalojada por otra petición; se vuelve a descargar
+                    logger.warning("No se pudo leer la tesela %s de la caché: %s", key, e)
+            missing.append(tile)
+
+        for (x0, y0, x1, y1), run in tile_runs(missing):
+            run_bbox = (x0 * self.tile_size, y0 * self.tile_size, (x1 + 1) * self.tile_size, (y1 + 1) * self.tile_size)
+            gdf = self.fetch(wfs_url, layer_name, run_bbox, crs)
+            if not gdf.empty:
+                parts.append(gdf)
+            for tile in run:
+                if gdf.empty:
+                    self._store(wfs_url, layer_name, tile, gdf)
+                    continue
+                positions = sorted(gdf.sindex.query(box(*tile_bbox(tile, self.tile_size)), predicate='intersects').tolist())
+                self._store(wfs_url, layer_name, tile, gdf.iloc[positions].reset_index(drop=True))
+
+        merged = merge_layer_parts(parts, crs)
+        if merged.empty:
+            return merged
+        # Se conservan solo las características que tocan el bbox solicitado
+        positions = sorted(merged.sindex.query(box(*bbox), predicate='intersects').tolist())
+        result = merged.iloc[positions].reset_index(drop=True)
+        logger.info("Caché WFS %s: %d características (aciertos=%d, fallos=%d)", layer_name, len(result), self.hits, self.misses)
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'tiles': len(self._entries),
+                'bytes': self.total_bytes
+            }
@@ -0,0 +1,155 @@
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from xml.sax.saxutils import escape
+
+from shapely.geometry import box
+
+# Plantilla mínima de GetCapabilities WFS 1.1.0 suficiente para owslib
+CAPABILITIES_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<wfs:WFS_Capabilities version="1.1.0"
+    xmlns:wfs="http://www.opengis.net/wfs"
+    xmlns:ows="http://www.opengis.net/ows"
+    xmlns:ogc="http://www.opengis.net/ogc"
+    xmlns:xlink="http://www.w3.org/1999/xlink">
+  <ows:ServiceIdentification>
+    <ows:Title>WFS local de pruebas</ows:Title>
+    <ows:ServiceType>WFS</ows:ServiceType>
+    <ows:ServiceTypeVersion>1.1.0</ows:ServiceTypeVersion>
+  </ows:ServiceIdentification>
+  <ows:OperationsMetadata>
+    <ows:Operation name="GetCapabilities">
+      <ows:DCP><ows:HTTP><ows:Get xlink:href="{url}"/></ows:HTTP></ows:DCP>
+    </ows:Operation>
+    <ows:Operation name="GetFeature">
+      <ows:DCP><ows:HTTP><ows:Get xlink:href="{url}"/></ows:HTTP></ows:DCP>
+      <ows:Parameter name="outputFormat"><ows:Value>application/json</ows:Value></ows:Parameter>
+    </ows:Operation>
+  </ows:OperationsMetadata>
+  <wfs:FeatureTypeList>
+{feature_types}
+  </wfs:FeatureTypeList>
+</wfs:WFS_Capabilities>
+"""
+
+FEATURE_TYPE_TEMPLATE = """    <wfs:FeatureType>
+      <wfs:Name>{name}</wfs:Name>
+      <wfs:Title>{name}</wfs:Title>
+      <wfs:DefaultSRS>EPSG:4326</wfs:DefaultSRS>
+      <ows:WGS84BoundingBox>
+        <ows:LowerCorner>{minx} {miny}</ows:LowerCorner>
+        <ows:UpperCorner>{maxx} {maxy}</ows:UpperCorner>
+      </ows:WGS84BoundingBox>
+    </wfs:FeatureType>"""
+
+# Función para interpretar el parámetro bbox de GetFeature (x,y o y,x según el SRS)
+def parse_bbox_param(value):
+    parts = value.split(',')
+    minx, miny, maxx, maxy = (float(v) for v in parts[:4])
+    if len(parts) > 4 and parts[4].startswith('urn:') and parts[4].endswith('4326'):
+        minx, miny, maxx, maxy = miny, minx, maxy, maxx
+    return minx, miny, maxx, maxy
+
+# Servidor WFS local que responde GetCapabilities y GetFeature desde GeoDataFrames en memoria. max_features
+# limita las características de cada respuesta, como el límite por consulta de GeoServer.
+class LocalWFSServer:
+    def __init__(self, layers, host='127.0.0.1', port=0, max_features=None):
+        self.max_features = max_features
+        self.layers = {}
+        for name, gdf in layers.items():
+            self.layers[name] = self._prepare_layer(name, gdf)
+        self.requests = []
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._thread = None
+
+    @staticmethod
+    def _prepare_layer(name, gdf):
+        gdf = gdf.reset_index(drop=True)
+        features = json.loads(gdf.to_json(drop_id=True))['features']
+        ids = gdf['id'].tolist() if 'id' in gdf.columns else [f"{name}.{k + 1}" for k in range(len(gdf))]
+        for feature, feature_id in zip(features, ids):
+            feature['id'] = feature_id
+            feature['properties'].pop('id', None)
+        return {'gdf': gdf, 'features': features}
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/wfs"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def capabilities(self):
+        feature_types = []
+        for name, layer in self.layers.items():
+            minx, miny, maxx, maxy = layer['gdf'].total_bounds if len(layer['gdf']) else (-180, -90, 180, 90)
+            feature_types.append(FEATURE_TYPE_TEMPLATE.format(name=escape(name), minx=minx, miny=miny, maxx=maxx, maxy=maxy))
+        return CAPABILITIES_TEMPLATE.format(url=escape(self.url), feature_types="\n".join(feature_types))
+
+    def get_feature(self, params):
+        layer = self.layers[params.get('typename', params.get('typenames'))]
+        positions = range(len(layer['features']))
+        if 'bbox' in params:
+            positions = sorted(layer['gdf'].sindex.query(box(*parse_bbox_param(params['bbox'])), predicate='intersects').tolist())
+        if params.get('sortby'):
+            name = params['sortby'].split()[0]
+            positions = sorted(positions, key=lambda k: str(layer['features'][k]['id'] if name == 'id' else layer['features'][k]['properties'].get(name)))
+        matched = len(positions)
+        start = int(params.get('startindex', 0))
+        count = params.get('count', params.get('maxfeatures'))
+        if self.max_features is not None:
+            count = min(int(count), self.max_features) if count is not None else self.max_features
+        positions = positions[start:start + int(count)] if count is not None else positions[start:]
+        return {
+            'type': 'FeatureCollection',
+            'features': [layer['features'][k] for k in positions],
+            'totalFeatures': matched,
+            'numberReturned': len(positions)
+        }
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                params = {k.lower(): v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+                server.requests.append(params)
+                request = params.get('request', '').lower()
+                try:
+                    if request == 'getcapabilities':
+                        self._reply(200, server.capabilities().encode('utf-8'), 'text/xml')
+                    elif request == 'getfeature':
+                        body = json.dumps(server.get_feature(params)).encode('utf-8')
+                        self._reply(200, body, 'application/json')
+                    else:
+                        self._reply(400, b'Solicitud WFS no soportada', 'text/plain')
+                except KeyError:
+                    self._reply(404, b'Capa no encontrada', 'text/plain')
+
+            def _reply(self, status, body, content_type):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler